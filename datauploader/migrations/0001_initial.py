@@ -0,0 +1,34 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('open_humans', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadPart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=128)),
+                ('part', models.IntegerField()),
+                ('basename', models.CharField(max_length=160)),
+                ('size', models.BigIntegerField()),
+                ('md5', models.CharField(max_length=32)),
+                ('file_id', models.IntegerField(blank=True, null=True)),
+                ('uploaded_at', models.DateTimeField(auto_now=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='open_humans.OpenHumansMember')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='uploadpart',
+            unique_together={('member', 'source', 'part')},
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations
+from django.db.models import F
+
+
+def drop_parts(apps, schema_editor):
+    # files sent in parts go up again, as one object
+    UploadPart = apps.get_model('datauploader', 'UploadPart')
+    UploadPart.objects.exclude(basename=F('source')).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datauploader', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_parts, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='uploadpart',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='uploadpart',
+            name='part',
+        ),
+        migrations.RemoveField(
+            model_name='uploadpart',
+            name='basename',
+        ),
+        migrations.RenameModel(
+            old_name='UploadPart',
+            new_name='UploadedFile',
+        ),
+        migrations.AlterUniqueTogether(
+            name='uploadedfile',
+            unique_together={('member', 'source')},
+        ),
+    ]
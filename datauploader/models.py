@@ -0,0 +1,22 @@
+from django.db import models
+
+from open_humans.models import OpenHumansMember
+
+
+class UploadedFile(models.Model):
+    """
+    A member's file uploaded to Open Humans, with the md5 of its bytes, so
+    a retried upload skips a file that is already there.
+    """
+    member = models.ForeignKey(OpenHumansMember, on_delete=models.CASCADE)
+    source = models.CharField(max_length=128)
+    size = models.BigIntegerField()
+    md5 = models.CharField(max_length=32)
+    file_id = models.IntegerField(null=True, blank=True)
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('member', 'source')
+
+    def __str__(self):
+        return '{} {} {}'.format(self.member_id, self.source, self.md5)
@@ -2,39 +2,91 @@
 Asynchronous tasks that update data in Open Humans.
 These tasks:
   1. delete any current files in OH if they match the planned upload filename
-  2. adds a data file
+  2. adds a data file, streamed in one PUT
 """
+import hashlib
 import logging
 import os
 from django.conf import settings
 from open_humans.models import OpenHumansMember
 from datetime import datetime
-from ohapi import api
+from open_humans.client import OpenHumansError, get_client
+from datauploader.models import UploadedFile
 
 # Set up logging.
 logger = logging.getLogger('oh')
 
+READ_SIZE = 8 * 1024 * 1024
 
-def process_source(oh_id):
+
+def _md5(filepath):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as source:
+        for block in iter(lambda: source.read(READ_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _delete(client, access_token, oh_member, basename):
+    """Delete the member's file basename, if Open Humans has one."""
+    try:
+        client.delete_file(access_token, oh_member.oh_id,
+                           file_basename=basename)
+    except OpenHumansError as error:
+        # anything but "no such file" must not pass for a new file
+        if error.status != 404:
+            raise
+        logger.info('New Source File')
+
+
+def _sent_file(client, access_token, oh_member, basename):
+    """
+    The UploadedFile of basename if it is still on Open Humans. The record
+    of a file the member deleted there is dropped, so it is sent again.
+    """
+    upload = UploadedFile.objects.filter(member=oh_member,
+                                         source=basename).first()
+    if upload is None:
+        return None
+    present = {data_file['id'] for data_file in
+               client.exchange_member(access_token)['data']}
+    if upload.file_id in present:
+        return upload
+    logger.info('{}: {} is gone from Open Humans'.format(oh_member.oh_id,
+                                                         basename))
+    upload.delete()
+    return None
+
+
+def process_source(oh_id, basename='member.imputed.vcf.bz2',
+                   description='Imputed genotypes from Imputer'):
+    """
+    Upload OUT_DIR/<oh_id>/<basename> as one object, streamed from disk.
+    The upload is recorded with the file's md5, so when the task is retried
+    a file Open Humans already has is not sent again.
+    """
     oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
     OUT_DIR = os.environ.get('OUT_DIR')
+    filepath = '{}/{}/{}'.format(OUT_DIR, oh_id, basename)
     metadata = {
-        'description':
-        'Imputed genotypes from Imputer',
+        'description': description,
         'tags': ['genomics'],
         'updated_at': str(datetime.utcnow()),
     }
     oh_access_token = oh_member.get_access_token(
         client_id=settings.OPENHUMANS_CLIENT_ID,
         client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+    client = get_client()
 
-    # this works below
-    try:
-        api.delete_file(oh_member.access_token,
-                        oh_member.oh_id,
-                        file_basename="member.imputed.vcf.bz2")
-    except FileNotFoundError:
-        logger.info('New Source File')
-    api.upload_aws('{}/{}/member.imputed.vcf.bz2'.format(OUT_DIR, oh_id), metadata,
-                   oh_access_token,
-                   project_member_id=oh_member.oh_id, max_bytes=256000000)
+    size = os.path.getsize(filepath)
+    md5 = _md5(filepath)
+    sent = _sent_file(client, oh_access_token, oh_member, basename)
+    if sent is not None and (sent.size, sent.md5) == (size, md5):
+        logger.info('{}: {} is already up'.format(oh_id, basename))
+        return
+    _delete(client, oh_access_token, oh_member, basename)
+    file_id = client.upload(filepath, metadata, oh_access_token,
+                            oh_member.oh_id)
+    UploadedFile.objects.update_or_create(
+        member=oh_member, source=basename,
+        defaults={'size': size, 'md5': md5, 'file_id': file_id})
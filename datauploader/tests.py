@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import arrow
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from datauploader.models import UploadedFile
+from datauploader.tasks import _delete, process_source
+from open_humans import client
+from open_humans.client import OpenHumansClient, OpenHumansError
+from open_humans.models import OpenHumansMember
+from open_humans.tests import StandIn
+
+API = '/api/direct-sharing/project/'
+DELETE = API + 'files/delete/'
+EXCHANGE = API + 'exchange-member/'
+UPLOAD = API + 'files/upload/direct/'
+COMPLETE = API + 'files/upload/complete/'
+S3_KEY = '/s3/member/upload'
+
+
+class DeleteTests(SimpleTestCase):
+    """Only a missing file passes for a new one."""
+
+    def delete(self, status):
+        server = StandIn({('POST', DELETE): [(status, '{}')]})
+        self.addCleanup(server.close)
+        oh = OpenHumansClient(server.url, timeout=5, retries=0, backoff=0)
+        _delete(oh, 'token', SimpleNamespace(oh_id='1'), 'member.vcf.bz2')
+
+    def test_deleted(self):
+        self.delete(200)
+
+    def test_missing(self):
+        self.delete(404)
+
+    def test_errors_raised(self):
+        for status in [400, 401, 500]:
+            with self.subTest(status=status), \
+                    self.assertRaises(OpenHumansError):
+                self.delete(status)
+
+
+class ProcessSourceTests(TestCase):
+    """Uploads through a local stand-in for Open Humans and S3."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.out_dir = tmp.name
+        os.makedirs(os.path.join(self.out_dir, '1'))
+        self.write(b'imputed genotypes\n' * 100)
+        self.stand_in({})
+        client._clients.clear()
+        self.addCleanup(client._clients.clear)
+        user = User.objects.create(username='1_openhumans')
+        self.member = OpenHumansMember.objects.create(
+            user=user, oh_id='1', access_token='token', refresh_token='r',
+            token_expires=(arrow.now() + timedelta(hours=1)).datetime)
+
+    def stand_in(self, files):
+        """Open Humans holding files ({id: basename}) for the member."""
+        self.server = StandIn({
+            ('GET', EXCHANGE): [(200, json.dumps({'data': [
+                {'id': file_id, 'basename': basename}
+                for file_id, basename in files.items()]}))],
+            ('POST', DELETE): [(200, '{}')],
+            ('PUT', S3_KEY): [(200, '')],
+            ('POST', COMPLETE): [(200, '{}')],
+        })
+        # the presigned S3 url is on the same stand-in
+        self.server.answers[('POST', UPLOAD)] = [(201, json.dumps({
+            'id': 7, 'url': self.server.url + S3_KEY}))]
+        self.addCleanup(self.server.close)
+
+    def write(self, data):
+        self.data = data
+        with open(os.path.join(self.out_dir, '1', 'member.vcf.bz2'),
+                  'wb') as out:
+            out.write(data)
+
+    def upload(self):
+        client._clients.clear()
+        with mock.patch.dict(os.environ, OUT_DIR=self.out_dir), \
+                override_settings(OPENHUMANS_OH_BASE_URL=self.server.url):
+            process_source('1', 'member.vcf.bz2')
+
+    def test_resent_when_deleted_on_open_humans(self):
+        self.upload()
+        self.assertEqual(self.server.calls('PUT', S3_KEY), [self.data])
+        # the same file again, still on Open Humans: nothing to send
+        self.stand_in({7: 'member.vcf.bz2'})
+        self.upload()
+        self.assertEqual(self.server.calls('PUT', S3_KEY), [])
+        # the member deleted it meanwhile
+        self.stand_in({})
+        self.upload()
+        self.assertEqual(self.server.calls('PUT', S3_KEY), [self.data])
+        self.assertEqual(UploadedFile.objects.get().file_id, 7)
+
+    def test_one_object_resent_on_failure(self):
+        # S3 fails the first PUT: the same bytes go again to the same key
+        self.server.answers[('PUT', S3_KEY)] = [(503, ''), (200, '')]
+        self.upload()
+        self.assertEqual(self.server.calls('PUT', S3_KEY),
+                         [self.data, self.data])
+        registered = self.server.calls('POST', UPLOAD)
+        self.assertEqual(len(registered), 1)
+        self.assertIn(b'filename=member.vcf.bz2', registered[0])
+
+    def test_one_object_up_to_single_put_limit(self):
+        self.write(b'0123456789' * 250)
+        with mock.patch.object(client, 'S3_PUT_LIMIT', 2500):
+            self.upload()
+        self.assertEqual(self.server.calls('PUT', S3_KEY), [self.data])
+        self.write(self.data + b'0')
+        with mock.patch.object(client, 'S3_PUT_LIMIT', 2500), \
+                self.assertRaises(OpenHumansError):
+            self.upload()
+        self.assertEqual(len(self.server.calls('PUT', S3_KEY)), 1)
@@ -0,0 +1,13 @@
+from django.contrib import admin
+
+from .models import TaskMetric
+
+
+@admin.register(TaskMetric)
+class TaskMetricAdmin(admin.ModelAdmin):
+    list_display = ('task', 'oh_id', 'chrom', 'state', 'started_at',
+                    'queue_seconds', 'wall_seconds', 'cpu_seconds',
+                    'child_cpu_seconds', 'peak_rss', 'child_peak_rss')
+    list_filter = ('task', 'state', 'chrom')
+    search_fields = ('oh_id', 'task_id')
+    date_hierarchy = 'started_at'
@@ -0,0 +1,83 @@
+"""
+Admission control for member pipelines.
+
+With settings.ADMISSION_CONTROL a launched member waits (step 'waiting'),
+and one resumed from its checkpoints (step 'resume'), until the cpu, memory
+and scratch disk its chromosomes are expected to need fit in what the
+admitted members have left of the node's budget.
+
+A member's demand comes from the cost model's inputs:
+
+cpus    the chromosome tasks it can run at once (settings.ADMISSION_PARALLEL)
+        times the cores a chromosome task was measured to keep busy
+memory  the sum of the largest peak RSS of those tasks, measured per
+        chromosome in TaskMetric, settings.ADMISSION_TASK_MEMORY until then
+disk    the panel variants of its chromosomes times
+        settings.ADMISSION_DISK_PER_VARIANT
+
+Waiting members are admitted in launch order. One that does not fit can be
+passed by later, smaller members, but only settings.ADMISSION_MAX_SKIPS
+times; after that nobody is admitted before it, so large members are never
+starved by a stream of small ones.
+"""
+import os
+import shutil
+from collections import namedtuple
+
+from imputer.scheduling import PANEL_VARIANTS
+
+Demand = namedtuple('Demand', ['cpus', 'memory', 'disk'])
+
+
+def capacity(cpus, memory, disk, scratch_dir):
+    """The node's budget, detecting the resources configured as 0."""
+    if not cpus:
+        cpus = os.cpu_count() or 1
+    if not memory:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    if not disk:
+        disk = shutil.disk_usage(scratch_dir).total
+    return Demand(float(cpus), int(memory), int(disk))
+
+
+def demand(chroms, peaks, cores, parallel, task_memory, disk_per_variant):
+    """
+    The Demand of a member imputing chroms. peaks maps chromosome to the
+    largest measured peak RSS of its imputation task, cores is the measured
+    cores per task or None.
+    """
+    memory = sorted((peaks.get(chrom) or task_memory for chrom in chroms),
+                    reverse=True)
+    running = min(parallel, len(chroms))
+    return Demand(running * (cores or 1.0),
+                  sum(memory[:running]),
+                  sum(PANEL_VARIANTS.get(chrom, 0)
+                      for chrom in chroms) * disk_per_variant)
+
+
+def _fits(needed, free):
+    return all(n <= f for n, f in zip(needed, free))
+
+
+def admit(waiting, free, idle, max_skips):
+    """
+    Pick the members to admit. waiting is a list of (member, Demand,
+    skips) in launch order, free the Demand still available and idle
+    whether no member is admitted at all, in which case the first member
+    goes in even when it needs more than the whole budget.
+    Returns (admitted, skipped): the members to start and the ones a later
+    member was admitted ahead of.
+    """
+    admitted, passed, skipped = [], [], []
+    for member, needed, skips in waiting:
+        if _fits(needed, free) or (idle and not admitted and not passed):
+            admitted.append(member)
+            skipped.extend(passed)
+            passed = []
+            free = Demand(*(f - n for f, n in zip(free, needed)))
+            continue
+        passed.append(member)
+        if skips >= max_skips:
+            # keep its place: nobody behind it goes first any more
+            break
+    return admitted, skipped
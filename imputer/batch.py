@@ -0,0 +1,159 @@
+"""
+Split the output of a multi-member impute2 run back into one set of
+final_impute2 files per member, as a single-member run would have written
+them.
+
+With settings.BATCH_IMPUTATION members are queued for a batch instead of
+waiting for admission: a batch runs one genipe-launcher per chromosome for
+all of them, which settings.py does not allow together with
+ADMISSION_CONTROL or SEGMENT_FANOUT. The batch's chromosomes follow
+COST_ORDERING like a single member's, and each member gets the same stage
+checkpoints, so resume_imputation can finish a member on its own.
+"""
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from imputer.merge_join import merge_sorted
+from imputer.vcf import IMPUTE_COLS
+
+# chr, name, position, a0, a1 lead every .impute2 row
+SITE_COLS = 5
+COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
+# impute2_info columns impute2 fills from its masking experiments on typed
+# sites across the study samples, and writes as -1 where it has none
+MASKED_COLS = ['info_type0', 'concord_type0', 'r2_type0']
+
+
+def sample_ids(sample_fp):
+    """IIDs of a .sample file in column order."""
+    with open(sample_fp) as sample:
+        return [line.split()[1] for line in sample.readlines()[2:]]
+
+
+def split_sample(sample_fp, outputs, ids):
+    """
+    Write each member's .sample: the two header lines and their row, with
+    the batch IID put back to the member's own (FID, IID) from ids.
+    """
+    with open(sample_fp) as sample:
+        lines = sample.readlines()
+    rows = {line.split()[1]: line.split() for line in lines[2:]}
+    for iid, sample_out in outputs.items():
+        row = list(ids[iid]) + rows[iid][2:]
+        with open(sample_out, 'w') as out:
+            out.writelines(lines[:2] + [' '.join(row) + '\n'])
+
+
+def _bim_alleles(bim_fp, names):
+    """{variant name: set of its called alleles} of names in a plink .bim."""
+    alleles = {}
+    with open(bim_fp) as bim:
+        for line in bim:
+            fields = line.split()
+            if fields[1] in names:
+                alleles[fields[1]] = frozenset(fields[4:6]) - {'0'}
+    return alleles
+
+
+def reconcile_alleles(bims, names):
+    """
+    bims maps a member to its plink .bim, names are the variants plink
+    could not merge (its .missnp). For each, the allele pair most members
+    have is kept: a member with the complementary pair gets the variant
+    flipped and one whose alleles fit neither has it excluded, instead of
+    the variant being dropped for everyone.
+    Returns {member: (names to flip, names to exclude)}.
+    """
+    alleles = {member: _bim_alleles(bim_fp, names)
+               for member, bim_fp in bims.items()}
+    votes = {}
+    for found in alleles.values():
+        for name, pair in found.items():
+            if len(pair) == 2:
+                votes.setdefault(name, Counter())[pair] += 1
+    lists = {}
+    for member, found in alleles.items():
+        flip, exclude = [], []
+        for name, pair in sorted(found.items()):
+            kept = votes[name].most_common(1)[0][0] if name in votes \
+                else frozenset()
+            if pair <= kept:
+                continue
+            if kept and all(a in COMPLEMENT for a in pair) and \
+                    {COMPLEMENT[a] for a in pair} <= kept:
+                flip.append(name)
+            else:
+                exclude.append(name)
+        lists[member] = (flip, exclude)
+    return lists
+
+
+def split_impute2(impute2_fp, sample_fp, outputs, chunksize):
+    """
+    outputs maps a member's IID to the .impute2 to write for them. Values
+    are copied as text, so every member's file holds exactly the digits
+    impute2 wrote.
+    """
+    columns = {iid: list(range(SITE_COLS)) +
+               [SITE_COLS + 3 * i + j for j in range(3)]
+               for i, iid in enumerate(sample_ids(sample_fp))}
+    handles = {iid: open(impute2_fp_out, 'w')
+               for iid, impute2_fp_out in outputs.items()}
+    try:
+        for chunk in pd.read_csv(impute2_fp, sep=' ', header=None, dtype=str,
+                                 na_filter=False, chunksize=chunksize):
+            for iid, out in handles.items():
+                chunk.iloc[:, columns[iid]].to_csv(
+                    out, sep=' ', header=False, index=False)
+    finally:
+        for out in handles.values():
+            out.close()
+
+
+def site_stats(p_het, p_hom):
+    """
+    impute2's exp_freq_a1, info and certainty of one sample's genotype
+    probabilities (a0a1 and a1a1), rounded as impute2 writes them.
+    """
+    p_ref = 1 - p_het - p_hom
+    expected = p_het + 2 * p_hom
+    theta = expected / 2
+    variance = p_het + 4 * p_hom - expected ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        info = np.where((theta > 0) & (theta < 1),
+                        1 - variance / (2 * theta * (1 - theta)), 1.0)
+    certainty = np.maximum(np.maximum(p_ref, p_het), p_hom)
+    return [np.char.mod('%.3f', values)
+            for values in [theta, info, certainty]]
+
+
+def member_info(info_fp, impute2_fp, info_out, chunksize):
+    """
+    Write a member's .impute2_info from the batch's: the batch's sites the
+    member has probabilities for in impute2_fp, with exp_freq_a1, info and
+    certainty computed from those and the masking columns at -1, so nothing
+    in the file depends on the other members of the batch.
+    """
+    info = (chunk.astype({'position': np.int64}) for chunk in pd.read_csv(
+        info_fp, sep='\t', dtype=str, na_filter=False, chunksize=chunksize))
+    impute = pd.read_csv(impute2_fp, sep=' ', header=None, names=IMPUTE_COLS,
+                         dtype={'chr': str, 'a0': str, 'a1': str,
+                                'a0a1_p': float, 'a1a1_p': float},
+                         usecols=['chr', 'position', 'a0', 'a1', 'a0a1_p',
+                                  'a1a1_p'], chunksize=chunksize)
+    header = True
+    with open(info_out, 'w') as out:
+        # sites without the member's probabilities would keep batch values
+        for df in merge_sorted(info, impute, 'position', 'position',
+                               on=['chr', 'position', 'a0', 'a1'],
+                               how='inner'):
+            stats = site_stats(df['a0a1_p'].values, df['a1a1_p'].values)
+            for column, values in zip(
+                    ['exp_freq_a1', 'info', 'certainty'], stats):
+                df[column] = values
+            df[[c for c in MASKED_COLS if c in df]] = '-1'
+            df.drop(columns=['a0a1_p', 'a1a1_p']).to_csv(
+                out, sep='\t', header=header, index=False)
+            header = False
@@ -0,0 +1,181 @@
+"""
+Block-parallel compression of the member's output file.
+
+The stream is cut into fixed-size blocks and each block is compressed as a
+complete stream of its own. bzip2, gzip and xz all allow streams to be
+concatenated, so the result is a normal file for bunzip2, gunzip or unxz.
+Blocks are compressed on a thread pool: the bz2, zlib and lzma modules
+release the GIL while compressing, and celery's prefork workers are daemon
+processes, which may not start a process pool of their own.
+
+bgzf is gzip cut the way the SAM/BAM specification (section 4.1) asks for:
+blocks of at most 64 KB, each a gzip member whose BC extra field holds its
+compressed size. Any gunzip reads it, and a tabix index (imputer.tabix)
+can point into it.
+"""
+import bz2
+import gzip
+import lzma
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _gzip(data, level):
+    return gzip.compress(data, compresslevel=level)
+
+
+def _xz(data, level):
+    return lzma.compress(data, preset=level)
+
+
+# uncompressed bytes per bgzf block, as htslib writes them; compressed,
+# even stored, a block stays within the 64 KB the BSIZE field can hold
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_BLOCK = 0x10000
+# gzip header with the BC extra field, then BSIZE, the block size - 1
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def _deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bgzf_block(data, level):
+    """One bgzf block of data, at most BGZF_BLOCK_SIZE bytes."""
+    deflated = _deflate(data, level)
+    if len(deflated) + 26 > BGZF_MAX_BLOCK:
+        deflated = _deflate(data, 0)
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                              len(deflated) + 25)
+    return (header + deflated +
+            struct.pack('<II', zlib.crc32(data), len(data)))
+
+
+# codec name: (file suffix, compress(data, level))
+CODECS = {
+    'bz2': ('.bz2', bz2.compress),
+    'gzip': ('.gz', _gzip),
+    'xz': ('.xz', _xz),
+    'bgzf': ('.gz', bgzf_block),
+}
+
+
+def suffix(codec):
+    return CODECS[codec][0]
+
+
+class ParallelCompressor:
+    """
+    A write-only binary file that compresses blocks on a thread pool and
+    writes them to fileobj in order. At most two blocks per worker are held
+    in memory at once.
+    """
+
+    def __init__(self, fileobj, codec='bz2', level=9, workers=None,
+                 block_size=8 * 1024 * 1024):
+        self.fileobj = fileobj
+        self.compress = CODECS[codec][1]
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.blocks = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        self.blocks += 1
+        self.pending.append(
+            self.pool.submit(self.compress, block, self.level))
+        while len(self.pending) > 2 * self.workers:
+            self._write_block(self.pending.popleft().result())
+
+    def _write_block(self, compressed):
+        self.fileobj.write(compressed)
+
+    def _finish(self):
+        """Write whatever the format needs after the last block."""
+
+    def close(self):
+        if self.pool is None:
+            return
+        if self.buffer or not self.blocks:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_block(self.pending.popleft().result())
+        self._finish()
+        self.pool.shutdown()
+        self.pool = None
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # leave a failed file unfinished rather than flushing partial data
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown()
+        self.pool = None
+        self.fileobj.close()
+
+
+class BgzfCompressor(ParallelCompressor):
+    """
+    ParallelCompressor for bgzf. position is the number of uncompressed
+    bytes written so far; virtual_offset turns such a position into the
+    (block offset << 16 | offset in block) that bgzf readers seek to.
+    """
+
+    def __init__(self, fileobj, level=9, workers=None):
+        super().__init__(fileobj, codec='bgzf', level=level, workers=workers,
+                         block_size=BGZF_BLOCK_SIZE)
+        self.position = 0
+        # file offset of every block written, then of the end-of-file block
+        self.offsets = [0]
+
+    def write(self, data):
+        self.position += len(data)
+        return super().write(data)
+
+    def _write_block(self, compressed):
+        self.fileobj.write(compressed)
+        self.offsets.append(self.offsets[-1] + len(compressed))
+
+    def _finish(self):
+        self.fileobj.write(BGZF_EOF)
+
+    def virtual_offset(self, position):
+        """Only valid for positions in blocks already written."""
+        block, within = divmod(position, BGZF_BLOCK_SIZE)
+        return self.offsets[block] << 16 | within
+
+
+def open_compressed(path, codec='bz2', level=9, workers=None,
+                    block_size=8 * 1024 * 1024):
+    """
+    Open path for block-parallel compressed writing. bgzf ignores
+    block_size, its blocks are always BGZF_BLOCK_SIZE.
+    """
+    if codec == 'bgzf':
+        return BgzfCompressor(open(path, 'wb'), level=level, workers=workers)
+    return ParallelCompressor(open(path, 'wb'), codec=codec, level=level,
+                              workers=workers, block_size=block_size)
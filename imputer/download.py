@@ -0,0 +1,152 @@
+"""
+Streaming download of a member's source vcf.
+
+The file is decompressed chunk by chunk as it arrives, picking bzip2, gzip
+or plain text from its first bytes, and written to a .part file that is
+moved into place only once it is complete, verified and on disk.
+"""
+import bz2
+import hashlib
+import logging
+import os
+import re
+import zlib
+from itertools import chain
+
+import requests
+
+logger = logging.getLogger('oh')
+
+CHUNK_SIZE = 1024 * 1024
+# S3 ETags are the md5 of the body for objects not uploaded in parts
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _Streams:
+    """
+    Incremental decompressor for concatenated bzip2 or gzip streams, as
+    written by bzip2/pbzip2 and by gzip -c a b.
+    """
+
+    def __init__(self, new_decompressor):
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        self.at_end = False
+
+    def decompress(self, data):
+        out = []
+        while data:
+            self.at_end = False
+            out.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            self.at_end = True
+            data = self.decompressor.unused_data
+            self.decompressor = self.new_decompressor()
+        return b''.join(out)
+
+    def finished(self):
+        """Whether the data so far ended exactly at the end of a stream."""
+        return self.at_end
+
+
+class _Plain:
+    def decompress(self, data):
+        return data
+
+    def finished(self):
+        return True
+
+
+class _GzipStream:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self.decompressor.unused_data
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+def sniff(head):
+    """Pick a decompressor from the first bytes of a file."""
+    if head.startswith(b'BZh'):
+        return 'bz2', _Streams(bz2.BZ2Decompressor)
+    if head.startswith(b'\x1f\x8b'):
+        return 'gzip', _Streams(_GzipStream)
+    return 'plain', _Plain()
+
+
+def _expected_md5(response, md5):
+    if md5:
+        return md5
+    if 'Content-Encoding' in response.headers:
+        return None
+    match = MD5_ETAG.match(response.headers.get('ETag', ''))
+    return match.group(1) if match else None
+
+
+def download_vcf(url, dest, md5=None, session=requests, timeout=60,
+                 chunk_size=CHUNK_SIZE):
+    """
+    Download url into dest, decompressing bzip2 or gzip on the fly.
+    The bytes received are checked against Content-Length and against md5,
+    or the ETag when it is a plain md5. dest only appears once the data is
+    fsynced. Returns the detected format.
+    """
+    part = dest + '.part'
+    digest = hashlib.md5()
+    received = 0
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        chunks = response.iter_content(chunk_size)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 3:
+                break
+        kind, decompressor = sniff(head)
+        try:
+            with open(part, 'wb') as out:
+                for chunk in chain([head], chunks):
+                    received += len(chunk)
+                    digest.update(chunk)
+                    out.write(decompressor.decompress(chunk))
+                out.flush()
+                os.fsync(out.fileno())
+
+            if not decompressor.finished():
+                raise DownloadError('{} stream ended early'.format(kind))
+            length = response.headers.get('Content-Length')
+            if (length and 'Content-Encoding' not in response.headers and
+                    int(length) != received):
+                raise DownloadError('received {} of {} bytes'.format(
+                    received, length))
+            expected = _expected_md5(response, md5)
+            if expected and expected != digest.hexdigest():
+                raise DownloadError('md5 {} does not match {}'.format(
+                    digest.hexdigest(), expected))
+        except (DownloadError, OSError, EOFError, zlib.error):
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+
+    os.replace(part, dest)
+    directory = os.open(os.path.dirname(os.path.abspath(dest)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    logger.info('downloaded {} bytes of {} data to {}'.format(
+        received, kind, dest))
+    return kind
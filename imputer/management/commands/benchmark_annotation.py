@@ -0,0 +1,49 @@
+import io
+import time
+
+from django.core.management.base import BaseCommand
+
+from imputer.formatting import format_annotated_records, rewrite_ids
+from imputer.synthetic import annotated_vcf_frame
+from imputer.tasks import _annotate, _rreplace
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = ('Time the pandas and NumPy GP/INFO annotation paths on a '
+            'synthetic chromosome.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        self.stdout.write('building {} synthetic rows'.format(rows))
+        df = annotated_vcf_frame(rows, seed=options['seed'])
+        names = df.index.to_series().str.replace('_', ':')
+
+        _, ids_apply = _timed(
+            lambda: names.apply(_rreplace, args=(':', '_', 2)))
+        _, ids_bulk = _timed(rewrite_ids, names)
+
+        def pandas_path():
+            out = io.StringIO()
+            _annotate(df.copy()).to_csv(out, sep='\t', header=None,
+                                        index=False)
+            return out.getvalue()
+        pandas_text, pandas_time = _timed(pandas_path)
+        numpy_text, numpy_time = _timed(format_annotated_records, df)
+
+        if pandas_text != numpy_text:
+            self.stderr.write('annotated output differs between paths')
+        for label, old, new in [('id rewrite', ids_apply, ids_bulk),
+                                ('annotation', pandas_time, numpy_time)]:
+            self.stdout.write(
+                '{:<12} pandas {:8.2f}s  numpy {:8.2f}s  {:5.1f}x'.format(
+                    label, old, new, old / new))
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from imputer.compression import CODECS, open_compressed
+from imputer.formatting import format_annotated_records
+from imputer.synthetic import annotated_vcf_frame
+
+
+class Command(BaseCommand):
+    help = ('Measure block-parallel compression throughput of synthetic '
+            'vcf text for increasing worker counts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=256)
+        parser.add_argument('--codec', choices=sorted(CODECS), default='bz2')
+        parser.add_argument('--level', type=int, default=9)
+        parser.add_argument('--block-mb', type=int, default=8)
+        parser.add_argument('--max-workers', type=int,
+                            default=os.cpu_count() or 1)
+
+    def handle(self, *args, **options):
+        sample = format_annotated_records(
+            annotated_vcf_frame(200000)).encode()
+        size = options['size_mb'] * 1024 * 1024
+        data = (sample * (size // len(sample) + 1))[:size]
+
+        workers = [1]
+        while workers[-1] * 2 <= options['max_workers']:
+            workers.append(workers[-1] * 2)
+        if workers[-1] != options['max_workers']:
+            workers.append(options['max_workers'])
+
+        self.stdout.write('{} MB of vcf text, codec {} level {}'.format(
+            options['size_mb'], options['codec'], options['level']))
+        baseline = None
+        with tempfile.TemporaryDirectory() as tmp:
+            out_fp = os.path.join(tmp, 'member.imputed.vcf')
+            for count in workers:
+                start = time.perf_counter()
+                with open_compressed(out_fp, codec=options['codec'],
+                                     level=options['level'], workers=count,
+                                     block_size=options['block_mb'] << 20) \
+                        as output:
+                    for offset in range(0, size, 1 << 20):
+                        output.write(data[offset:offset + (1 << 20)])
+                elapsed = time.perf_counter() - start
+                baseline = baseline or elapsed
+                self.stdout.write(
+                    'workers {:>3}  {:8.1f} MB/s  speedup {:5.2f}x  '
+                    'ratio {:5.2f}'.format(
+                        count, options['size_mb'] / elapsed,
+                        baseline / elapsed, size / os.path.getsize(out_fp)))
@@ -0,0 +1,342 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import imputer.tasks as tasks
+from imputer import synthetic
+from imputer.download import download_vcf
+from imputer.vcf import Reference, write_annotated_vcf
+
+OH_ID = 'benchmark'
+PROCESS_MODES = {
+    'in_memory': lambda chrom: tasks._process_chrom_in_memory(chrom, OH_ID),
+    'streaming': lambda chrom: tasks._process_chrom_streaming(
+        chrom, OH_ID, settings.PROCESS_CHUNK_SIZE),
+    'native': lambda chrom: tasks._process_chrom_native(chrom, OH_ID),
+}
+STAGES = ['process', 'upload', 'download']
+# settings that change what the stages do, stored with every result
+RECORDED_SETTINGS = ['VECTORIZED_ANNOTATION', 'PROCESS_CHUNK_SIZE',
+                     'OUTPUT_CODEC', 'OUTPUT_COMPRESSLEVEL',
+                     'COMPRESS_WORKERS', 'COMPRESS_BLOCK_SIZE']
+
+
+def _in_child(func):
+    """
+    Run func in a forked process. Returns its wall time and result, with
+    the cpu time and peak RSS of the process, which starts from this one.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 0
+        try:
+            start = time.perf_counter()
+            result = func()
+            report = {'seconds': time.perf_counter() - start,
+                      'result': result}
+        except BaseException:
+            report = {'error': traceback.format_exc()}
+            code = 1
+        with os.fdopen(write_fd, 'w') as out:
+            json.dump(report, out)
+        os._exit(code)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as report_in:
+        report = json.loads(report_in.read() or '{}')
+    _, _, usage = os.wait4(pid, 0)
+    if 'error' in report:
+        raise CommandError(report['error'])
+    report['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+    report['peak_rss'] = usage.ru_maxrss * 1024
+    return report
+
+
+class _FileResponse:
+    """A streamed response whose body is a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = {'Content-Length': str(os.path.getsize(path))}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        with open(self.path, 'rb') as body:
+            yield from iter(lambda: body.read(chunk_size), b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _FileSession:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, url, stream=True, timeout=None):
+        return _FileResponse(self.path)
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd=settings.BASE_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Command(BaseCommand):
+    help = ('Time and memory-profile process_chrom, the combine and '
+            'compress step of upload_to_oh and the get_vcf decompression '
+            'on synthetic data, each in a fresh process, with plink2 and '
+            'the network stubbed out. Results are appended to a JSON lines '
+            'file keyed by git commit, and --compare checks them against '
+            'an earlier commit.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chrom', action='append',
+                            help='chromosome to generate, repeatable '
+                                 '(default: 22)')
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='fraction of the panel sites to generate '
+                                 '(default: all, 6.2M rows for chr1)')
+        parser.add_argument('--stage', action='append', choices=STAGES,
+                            help='stage to run, repeatable (default: all)')
+        parser.add_argument('--mode', action='append',
+                            choices=sorted(PROCESS_MODES),
+                            help='process_chrom path, repeatable '
+                                 '(default: all)')
+        parser.add_argument('--member-sites', type=int, default=600000,
+                            help='sites in the member vcf get_vcf reads')
+        parser.add_argument('--results', default='benchmark_results.jsonl',
+                            help='JSON lines file the results go to')
+        parser.add_argument('--label', default='',
+                            help='free text stored with the results')
+        parser.add_argument('--compare', metavar='COMMIT',
+                            help='compare with the latest results of COMMIT')
+        parser.add_argument('--threshold', type=float, default=0.15,
+                            help='relative slowdown or RSS growth counted '
+                                 'as a regression')
+        parser.add_argument('--keep', action='store_true',
+                            help='keep the generated data')
+
+    def handle(self, *args, **options):
+        chroms = options['chrom'] or ['22']
+        stages = options['stage'] or STAGES
+        modes = options['mode'] or sorted(PROCESS_MODES)
+        baseline = self._baseline(options) if options['compare'] else None
+        work = tempfile.mkdtemp(prefix='imputer-benchmark-')
+        try:
+            results = self._run(work, chroms, stages, modes, options)
+        finally:
+            if options['keep']:
+                self.stdout.write('data kept in {}'.format(work))
+            else:
+                shutil.rmtree(work, ignore_errors=True)
+
+        commit = _git('rev-parse', '--short', 'HEAD') or 'unknown'
+        dirty = bool(_git('status', '--porcelain', '--untracked-files=no'))
+        common = {
+            'commit': commit,
+            'dirty': dirty,
+            'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'label': options['label'],
+            'scale': options['scale'],
+            'settings': {name: getattr(settings, name)
+                         for name in RECORDED_SETTINGS},
+        }
+        with open(options['results'], 'a') as out:
+            for result in results:
+                out.write(json.dumps(dict(common, **result)) + '\n')
+        self.stdout.write('{} results for {}{} appended to {}'.format(
+            len(results), commit, ' (dirty)' if dirty else '',
+            options['results']))
+        if baseline is not None:
+            self._compare(results, baseline, options)
+
+    def _setup(self, work, chroms, scale, member_sites):
+        """Generate every input, outside of the timed processes."""
+        tasks.OUT_DIR = os.path.join(work, 'out')
+        tasks.REF_FA = os.path.join(work, 'ref')
+        tasks.CHROMOSOMES = chroms
+        os.makedirs(tasks.REF_FA)
+        fixtures = os.path.join(work, 'fixtures')
+        os.makedirs(fixtures)
+
+        def generate(chrom):
+            fasta = os.path.join(tasks.REF_FA, 'hg19.fasta')
+            reference = synthetic.write_reference(fasta, chrom)
+            rows = synthetic.chrom_rows(chrom, scale)
+            sites, swap = synthetic.impute2_sites(chrom, rows, reference)
+            del reference
+            tasks._scratch_dir(OH_ID, 'chr{}'.format(chrom),
+                               'chr{}'.format(chrom), 'final_impute2')
+            pristine = os.path.join(fixtures, 'chr{}.'.format(chrom))
+            synthetic.write_impute2(pristine + 'impute2', sites)
+            kept = synthetic.write_impute2_info(
+                tasks._final_impute2(OH_ID, chrom, 'imputed.impute2_info'),
+                sites)
+            synthetic.write_sample(
+                tasks._final_impute2(OH_ID, chrom, 'imputed.sample'))
+            synthetic.write_plink2_vcf(pristine + 'plink2.vcf', sites[kept],
+                                       swap[kept], chrom)
+            # the upload stage's input: process_chrom's output
+            shutil.copyfile(pristine + 'impute2', tasks._final_impute2(
+                OH_ID, chrom, 'imputed.impute2'))
+            write_annotated_vcf(
+                pristine + 'impute2',
+                tasks._final_impute2(OH_ID, chrom, 'imputed.impute2_info'),
+                tasks._final_impute2(OH_ID, chrom, 'imputed.sample'),
+                pristine + 'member.imputed.vcf', chrom, Reference(fasta),
+                settings.PROCESS_CHUNK_SIZE)
+            return {'rows': rows, 'kept': int(kept.sum())}
+
+        rows = {}
+        for chrom in chroms:
+            self.stdout.write('generating chr{}'.format(chrom))
+            rows[chrom] = _in_child(lambda: generate(chrom))['result']
+        member_sizes = {}
+        for codec in ['bz2', 'gzip']:
+            member_sizes[codec] = _in_child(
+                lambda: synthetic.write_member_vcf(
+                    os.path.join(fixtures, 'member.vcf.' + codec),
+                    member_sites, codec))['result']
+        return fixtures, rows, member_sizes
+
+    def _restore(self, fixtures, chrom):
+        """Put back the files process_chrom rewrites in place."""
+        pristine = os.path.join(fixtures, 'chr{}.'.format(chrom))
+        shutil.copyfile(pristine + 'impute2', tasks._final_impute2(
+            OH_ID, chrom, 'imputed.impute2'))
+        for name in ['imputed.impute2.GP', 'member.imputed.vcf']:
+            path = tasks._final_impute2(OH_ID, chrom, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _run(self, work, chroms, stages, modes, options):
+        fixtures, rows, member_sizes = self._setup(
+            work, chroms, options['scale'], options['member_sites'])
+        results = []
+
+        def report(stage, chrom, count, size, measured):
+            result = {'stage': stage, 'chrom': chrom, 'rows': count,
+                      'bytes': size, 'seconds': measured['seconds'],
+                      'cpu_seconds': measured['cpu_seconds'],
+                      'peak_rss': measured['peak_rss'],
+                      'rows_per_second': count / measured['seconds'],
+                      'mb_per_second': size / 1024 ** 2 /
+                      measured['seconds']}
+            results.append(result)
+            self.stdout.write(
+                '{:<22} chr{:<3} {:>9} rows {:8.2f}s {:9.0f} rows/s '
+                '{:7.1f} MB/s  peak {:7.0f} MB'.format(
+                    stage, chrom or '-', count, result['seconds'],
+                    result['rows_per_second'], result['mb_per_second'],
+                    result['peak_rss'] / 1024 ** 2))
+
+        if 'process' in stages:
+            # plink2 --export vcf, replaced by its precomputed output
+            def output_vcf(oh_id, chrom):
+                shutil.copyfile(
+                    os.path.join(fixtures, 'chr{}.plink2.vcf'.format(chrom)),
+                    tasks._final_impute2(oh_id, chrom, 'member.imputed.vcf'))
+            tasks._output_vcf = output_vcf
+            for mode in modes:
+                for chrom in chroms:
+                    self._restore(fixtures, chrom)
+                    size = os.path.getsize(tasks._final_impute2(
+                        OH_ID, chrom, 'imputed.impute2'))
+                    measured = _in_child(
+                        lambda: PROCESS_MODES[mode](chrom))
+                    report('process_chrom:' + mode, chrom,
+                           rows[chrom]['rows'], size, measured)
+
+        if 'upload' in stages:
+            for chrom in chroms:
+                shutil.copyfile(
+                    os.path.join(fixtures,
+                                 'chr{}.member.imputed.vcf'.format(chrom)),
+                    tasks._final_impute2(OH_ID, chrom, 'member.imputed.vcf'))
+            header_fp = '{}/{}/header.txt'.format(tasks.OUT_DIR, OH_ID)
+            tasks._capture_header(tasks._final_impute2(
+                OH_ID, chroms[0], 'member.imputed.vcf'), OH_ID, chroms[0])
+            shutil.copyfile(tasks._final_impute2(OH_ID, chroms[0],
+                                                 'header.txt'), header_fp)
+            basename = 'member.imputed.vcf' + tasks.suffix(
+                settings.OUTPUT_CODEC)
+            size = sum(os.path.getsize(tasks._final_impute2(
+                OH_ID, chrom, 'member.imputed.vcf')) for chrom in chroms)
+
+            def combine():
+                header = tasks._member_header(header_fp)
+                with tasks._compressed_output(OH_ID, basename) as output:
+                    tasks._write_member_vcf(OH_ID, header, output)
+            measured = _in_child(combine)
+            report('upload_to_oh:combine', '',
+                   sum(count['kept'] for count in rows.values()), size,
+                   measured)
+
+        if 'download' in stages:
+            dest = os.path.join(work, 'member.vcf')
+            for codec, size in sorted(member_sizes.items()):
+                source = os.path.join(fixtures, 'member.vcf.' + codec)
+                measured = _in_child(lambda: download_vcf(
+                    'file://' + source, dest,
+                    session=_FileSession(source)))
+                report('get_vcf:' + codec, '', options['member_sites'],
+                       size, measured)
+        return results
+
+    def _baseline(self, options):
+        """The latest results of the --compare commit, by stage and data."""
+        baseline = {}
+        if not os.path.exists(options['results']):
+            raise CommandError('{} does not exist'.format(options['results']))
+        with open(options['results']) as lines:
+            for line in lines:
+                old = json.loads(line)
+                if old['commit'].startswith(options['compare']):
+                    # the latest run of the commit wins
+                    baseline[(old['stage'], old['chrom'], old['rows'])] = old
+        if not baseline:
+            raise CommandError('no results for {} in {}'.format(
+                options['compare'], options['results']))
+        return baseline
+
+    def _compare(self, results, baseline, options):
+        regressions = []
+        for result in results:
+            old = baseline.get((result['stage'], result['chrom'],
+                                result['rows']))
+            if old is None:
+                continue
+            speed = old['seconds'] / result['seconds']
+            memory = result['peak_rss'] / old['peak_rss']
+            self.stdout.write('{:<22} chr{:<3} speed {:5.2f}x  peak RSS '
+                              '{:5.2f}x'.format(result['stage'],
+                                                result['chrom'] or '-',
+                                                speed, memory))
+            if (speed < 1 - options['threshold'] or
+                    memory > 1 + options['threshold']):
+                regressions.append('{} chr{}'.format(result['stage'],
+                                                     result['chrom']))
+        if regressions:
+            raise CommandError('regressions against {}: {}'.format(
+                options['compare'], ', '.join(regressions)))
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from imputer.panel_cache import PanelCache
+from imputer.segments import chrom_segments, panel, regions
+from imputer.tasks import REF_PANEL, REF_PANEL_X, panel_cache_budget
+from openhumansimputer.settings import CHROMOSOMES
+
+
+class Command(BaseCommand):
+    help = ('Decompress the reference panel into PANEL_CACHE_DIR and cut '
+            'the per-segment slices used with SEGMENT_FANOUT.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chrom', action='append',
+                            help='chromosome to cache, repeatable '
+                                 '(default: all)')
+        parser.add_argument('--whole-only', action='store_true',
+                            help='skip the per-segment slices')
+        parser.add_argument('--evict', action='store_true',
+                            help='only evict entries over the budget')
+
+    def handle(self, *args, **options):
+        if not settings.PANEL_CACHE_DIR:
+            raise CommandError('PANEL_CACHE_DIR is not set')
+        budget = panel_cache_budget()
+        cache = PanelCache(settings.PANEL_CACHE_DIR, settings.PANEL_VERSION,
+                           budget)
+        if not options['evict']:
+            for chrom in options['chrom'] or CHROMOSOMES:
+                for region, _, _, _ in regions(chrom):
+                    files = panel(chrom, region, REF_PANEL, REF_PANEL_X)
+                    cache.whole(files)
+                    self.stdout.write('chr{} {}'.format(chrom, region))
+                    if options['whole_only']:
+                        continue
+                    for name, start, end in chrom_segments(
+                            chrom, settings.SEGMENT_LENGTH):
+                        if name == region:
+                            cache.segment(files, start, end)
+                    # built entries are there to be evicted like any other
+                    cache.release()
+        total = cache.trim()
+        self.stdout.write('{} entries, {:.1f} GB of {:.1f} GB'.format(
+            len(cache.entries()), total / 1024 ** 3,
+            budget / 1024 ** 3))
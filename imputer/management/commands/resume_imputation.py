@@ -0,0 +1,34 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from imputer.models import ImputerMember
+from imputer.tasks import resume_pipeline
+
+
+class Command(BaseCommand):
+    help = ('Resume interrupted imputation runs from their checkpoints, '
+            'scheduling only the stages and chromosomes that are missing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('oh_ids', nargs='*', type=int)
+        parser.add_argument('--stale-hours', type=float,
+                            help='resume every active single-member run '
+                                 'not updated for this many hours')
+
+    def handle(self, *args, **options):
+        oh_ids = list(options['oh_ids'])
+        if options['stale_hours'] is not None:
+            cutoff = timezone.now() - datetime.timedelta(
+                hours=options['stale_hours'])
+            oh_ids += list(ImputerMember.objects.filter(
+                active=True, batch__isnull=True,
+                updated_at__lt=cutoff).exclude(
+                step__in=['queued', 'waiting', 'resume']).values_list(
+                'oh_id', flat=True))
+        for oh_id in oh_ids:
+            plan = resume_pipeline(oh_id)
+            self.stdout.write('{}: {}'.format(oh_id, ', '.join(
+                '{} {}'.format(stage, ','.join(chroms) or '-')
+                for stage, chroms in plan)))
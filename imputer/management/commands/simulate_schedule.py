@@ -0,0 +1,40 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from imputer.models import ChromosomeRuntime
+from imputer.scheduling import (estimated_costs, order_by_cost,
+                                simulate_makespan)
+from openhumansimputer.settings import CHROMOSOMES
+
+
+class Command(BaseCommand):
+    help = ('Simulate the submit_chrom makespan of N queued members on W '
+            'workers, numeric order against longest-expected-job first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=10)
+        parser.add_argument('--workers', type=int, default=3)
+        parser.add_argument('--jitter', type=float, default=0.1,
+                            help='relative spread of actual runtimes '
+                                 'around the estimate')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        costs = estimated_costs(CHROMOSOMES, ChromosomeRuntime.runtimes())
+        actual = [{chrom: cost * rng.uniform(1 - options['jitter'],
+                                             1 + options['jitter'])
+                   for chrom, cost in costs.items()}
+                  for _ in range(options['members'])]
+        orders = [('numeric', CHROMOSOMES),
+                  ('cost', order_by_cost(CHROMOSOMES, costs))]
+        self.stdout.write('{} members, {} workers'.format(
+            options['members'], options['workers']))
+        for label, order in orders:
+            makespan, mean_done = simulate_makespan(
+                [[runtimes[chrom] for chrom in order] for runtimes in actual],
+                options['workers'])
+            self.stdout.write(
+                '{:<8} makespan {:14.1f}  mean member completion {:14.1f}'
+                .format(label, makespan, mean_done))
@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# merge the plink filesets of a batch of members into one. Every member
+# gets its oh_id as FID and IID. Variants plink cannot merge (allele or
+# strand conflicts) are left in batch.plink.gt-merge.missnp; merge_batch
+# then writes each member's <oh_id>.flip and <oh_id>.exclude lists and
+# runs the merge again.
+batch_dir="$1"
+shift
+rm -f "$batch_dir"/merge_list.txt
+for oh_id in "$@"
+do
+awk -v id="$oh_id" '{print $1, $2, id, id}' \
+"$DATA_DIR"/"$oh_id"/member."$oh_id".plink.gt.fam > "$batch_dir"/"$oh_id".ids
+lists=()
+if [[ -s "$batch_dir"/"$oh_id".flip ]]
+then
+lists+=(--flip "$batch_dir"/"$oh_id".flip)
+fi
+if [[ -s "$batch_dir"/"$oh_id".exclude ]]
+then
+lists+=(--exclude "$batch_dir"/"$oh_id".exclude)
+fi
+"$IMP_BIN"/plink \
+--bfile "$DATA_DIR"/"$oh_id"/member."$oh_id".plink.gt \
+--update-ids "$batch_dir"/"$oh_id".ids \
+"${lists[@]}" \
+--make-bed \
+--out "$batch_dir"/"$oh_id"
+echo "$batch_dir"/"$oh_id" >> "$batch_dir"/merge_list.txt
+done
+"$IMP_BIN"/plink \
+--merge-list "$batch_dir"/merge_list.txt \
+--make-bed \
+--out "$batch_dir"/batch.plink.gt
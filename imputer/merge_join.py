@@ -0,0 +1,70 @@
+"""
+Streaming merge-join of position-sorted tables.
+
+impute2, impute2_info and the plink2 VCF are all written in chromosome
+position order, so two of them can be joined by walking both files once in
+fixed-size chunks instead of loading them whole and hash-merging.
+Each window handed to pandas only holds complete position groups, which means
+a pandas merge of one window gives exactly the rows that the full-table merge
+would give for those positions, in the same order.
+"""
+import pandas as pd
+
+
+def _take_below(frame, column, cutoff):
+    """Split a frame into rows with column < cutoff and the rest."""
+    below = frame[column] < cutoff
+    return frame[below], frame[~below]
+
+
+def merge_sorted(left_chunks, right_chunks, left_on, right_on, **merge_kwargs):
+    """
+    Merge two iterators of DataFrame chunks that are sorted by position.
+
+    left_on and right_on name the position column in each side. The remaining
+    keyword arguments are passed to DataFrame.merge for every window, so the
+    join keys, how= and index options behave as they would on full tables.
+    Only positions that fall inside the current window are held in memory.
+    """
+    left_chunks = iter(left_chunks)
+    left_buf = None
+    left_done = False
+    right_carry = None
+
+    def fill_left(cutoff):
+        # read left chunks until everything below cutoff is buffered
+        nonlocal left_buf, left_done
+        while not left_done and (
+                left_buf is None or left_buf.empty or
+                left_buf[left_on].iloc[-1] < cutoff):
+            try:
+                chunk = next(left_chunks)
+            except StopIteration:
+                left_done = True
+                break
+            left_buf = chunk if left_buf is None else pd.concat(
+                [left_buf, chunk])
+
+    def window(right, cutoff):
+        nonlocal left_buf
+        fill_left(cutoff)
+        if left_buf is None:
+            raise ValueError('left side of the merge has no chunks')
+        left, left_buf = _take_below(left_buf, left_on, cutoff)
+        return left.merge(right, **merge_kwargs)
+
+    for chunk in right_chunks:
+        right = chunk if right_carry is None else pd.concat(
+            [right_carry, chunk])
+        if right.empty:
+            right_carry = right
+            continue
+        # the last position may continue in the next chunk, hold it back
+        cutoff = right[right_on].iloc[-1]
+        right, right_carry = _take_below(right, right_on, cutoff)
+        if right.empty:
+            continue
+        yield window(right, cutoff)
+
+    if right_carry is not None:
+        yield window(right_carry, float('inf'))
@@ -0,0 +1,172 @@
+"""
+Timing and resource usage of every task run, stored as TaskMetric rows.
+
+Publishing a task stamps its message with the time it was queued. Around
+each run the worker takes the thread's cpu time and the process's peak RSS,
+and imputer.runner adds the cpu time and peak RSS of every program it
+waits for, which genipe, impute2 and plink report through wait4.
+"""
+import inspect
+import logging
+import resource
+import threading
+import time
+from datetime import timedelta
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.utils import timezone
+
+from imputer.models import TaskMetric
+
+logger = logging.getLogger('oh')
+
+# the running task of each thread, and all running tasks of this process
+_local = threading.local()
+_running = {}
+_running_lock = threading.Lock()
+
+# ru_maxrss is in kilobytes on linux
+RSS_UNIT = 1024
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def add_child_usage(usage):
+    """Count a finished program's rusage, from wait4, to the running task."""
+    metric = getattr(_local, 'metric', None)
+    if metric is not None:
+        metric['child_cpu_seconds'] += _cpu_seconds(usage)
+        metric['child_peak_rss'] = max(metric['child_peak_rss'],
+                                       usage.ru_maxrss * RSS_UNIT)
+
+
+def _reset_peak_rss():
+    """Restart the process's VmHWM, where linux allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * RSS_UNIT
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+def _task_arguments(task, args, kwargs):
+    try:
+        return inspect.signature(task.run).bind_partial(
+            *(args or ()), **(kwargs or {})).arguments
+    except (TypeError, ValueError):
+        return {}
+
+
+@before_task_publish.connect
+def stamp_queued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault('queued_at', time.time())
+
+
+@task_prerun.connect
+def start_metric(task_id=None, task=None, args=None, kwargs=None, **extra):
+    if task is None or task.name.startswith('celery.'):
+        return
+    with _running_lock:
+        # a peak reset would hide the peak of another running task
+        reset = not _running and _reset_peak_rss()
+        _running[task_id] = task.name
+    arguments = _task_arguments(task, args, kwargs)
+    _local.metric = {
+        'task_id': task_id,
+        'queued_at': getattr(task.request, 'queued_at', None),
+        'started': time.time(),
+        'cpu': _cpu_seconds(resource.getrusage(RUSAGE_THREAD)),
+        'peak_reset': reset,
+        'oh_id': arguments.get('oh_id'),
+        'chrom': arguments.get('chrom', ''),
+        'child_cpu_seconds': 0.0,
+        'child_peak_rss': 0,
+    }
+
+
+@task_postrun.connect
+def record_metric(task_id=None, task=None, state=None, **extra):
+    metric = getattr(_local, 'metric', None)
+    if metric is None or metric['task_id'] != task_id:
+        return
+    _local.metric = None
+    with _running_lock:
+        _running.pop(task_id, None)
+    finished = time.time()
+    queued_at = metric['queued_at']
+    try:
+        TaskMetric.objects.create(
+            task=task.name.rsplit('.', 1)[-1],
+            task_id=task_id,
+            oh_id=metric['oh_id'],
+            chrom=str(metric['chrom'] or ''),
+            state=state or '',
+            started_at=timezone.now() - timedelta(
+                seconds=finished - metric['started']),
+            queue_seconds=(metric['started'] - float(queued_at)
+                           if queued_at else None),
+            wall_seconds=finished - metric['started'],
+            cpu_seconds=_cpu_seconds(resource.getrusage(RUSAGE_THREAD)) -
+            metric['cpu'],
+            child_cpu_seconds=metric['child_cpu_seconds'],
+            peak_rss=_peak_rss() if metric['peak_reset'] else None,
+            child_peak_rss=metric['child_peak_rss'] or None)
+    except Exception:
+        # metrics must never fail the pipeline
+        logger.exception('{}: could not record metrics'.format(task_id))
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def exposition(rows):
+    """
+    The Prometheus text format of TaskMetric aggregates, rows as returned
+    by TaskMetric.aggregates().
+    """
+    families = [
+        ('imputer_task_runs_total', 'counter', 'Finished task runs.',
+         'runs'),
+        ('imputer_task_queue_seconds_total', 'counter',
+         'Seconds tasks waited in the queue.', 'total_queue_seconds'),
+        ('imputer_task_wall_seconds_total', 'counter',
+         'Seconds tasks ran.', 'total_wall_seconds'),
+        ('imputer_task_cpu_seconds_total', 'counter',
+         'Cpu seconds of the worker thread running tasks.',
+         'total_cpu_seconds'),
+        ('imputer_task_child_cpu_seconds_total', 'counter',
+         'Cpu seconds of the programs tasks ran.', 'total_child_cpu_seconds'),
+        ('imputer_task_peak_rss_bytes', 'gauge',
+         'Largest worker peak RSS seen during a task.', 'max_peak_rss'),
+        ('imputer_task_child_peak_rss_bytes', 'gauge',
+         'Largest peak RSS of a program a task ran.',
+         'max_child_peak_rss'),
+    ]
+    lines = []
+    for name, kind, help_text, field in families:
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for row in rows:
+            if row[field] is None:
+                continue
+            lines.append('{}{{task="{}",chrom="{}",state="{}"}} {}'.format(
+                name, _label(row['task']), _label(row['chrom']),
+                _label(row['state']), row[field]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imputer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChromosomeRuntime',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chrom', models.CharField(max_length=2, unique=True)),
+                ('runs', models.IntegerField(default=0)),
+                ('mean_seconds', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imputer', '0003_imputationbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=20)),
+                ('chrom', models.CharField(blank=True, default='', max_length=2)),
+                ('checksum', models.CharField(blank=True, default='', max_length=32)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='imputer.ImputerMember')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='pipelinecheckpoint',
+            unique_together={('member', 'stage', 'chrom')},
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imputer', '0004_pipelinecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imputermember',
+            name='oh_id',
+            field=models.IntegerField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='imputermember',
+            index=models.Index(fields=['active', 'id'], name='imputer_queue_idx'),
+        ),
+    ]
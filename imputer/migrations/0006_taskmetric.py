@@ -0,0 +1,31 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imputer', '0005_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=64)),
+                ('task_id', models.CharField(blank=True, default='', max_length=36)),
+                ('oh_id', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('chrom', models.CharField(blank=True, default='', max_length=2)),
+                ('state', models.CharField(blank=True, default='', max_length=10)),
+                ('started_at', models.DateTimeField(db_index=True)),
+                ('queue_seconds', models.FloatField(blank=True, null=True)),
+                ('wall_seconds', models.FloatField()),
+                ('cpu_seconds', models.FloatField()),
+                ('child_cpu_seconds', models.FloatField(default=0)),
+                ('peak_rss', models.BigIntegerField(blank=True, null=True)),
+                ('child_peak_rss', models.BigIntegerField(blank=True, null=True)),
+            ],
+        ),
+    ]
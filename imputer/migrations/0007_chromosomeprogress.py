@@ -0,0 +1,30 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imputer', '0006_taskmetric'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChromosomeProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chrom', models.CharField(max_length=2)),
+                ('stage', models.CharField(max_length=20)),
+                ('segments_done', models.IntegerField(default=0)),
+                ('segments_total', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='imputer.ImputerMember')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='chromosomeprogress',
+            unique_together={('member', 'chrom')},
+        ),
+    ]
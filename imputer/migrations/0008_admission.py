@@ -0,0 +1,38 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imputer', '0007_chromosomeprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imputermember',
+            name='admitted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imputermember',
+            name='reserved_cpus',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='imputermember',
+            name='reserved_memory',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='imputermember',
+            name='reserved_disk',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='imputermember',
+            name='admission_skips',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,13 +1,232 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+from imputer.scheduling import smoothed
 
 
 class ImputerMember(models.Model):
-    oh_id = models.IntegerField()
+    oh_id = models.IntegerField(db_index=True)
     step = models.CharField(max_length=10)
     active = models.BooleanField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # the Open Humans data source, kept for members waiting for a batch
+    data_source_id = models.CharField(max_length=64, blank=True, default='')
+    batch = models.ForeignKey('ImputationBatch', null=True, blank=True,
+                              on_delete=models.SET_NULL)
+    # what admission control set aside for the member's pipeline
+    admitted_at = models.DateTimeField(null=True, blank=True)
+    reserved_cpus = models.FloatField(default=0)
+    reserved_memory = models.BigIntegerField(default=0)
+    reserved_disk = models.BigIntegerField(default=0)
+    admission_skips = models.IntegerField(default=0)
+
+    class Meta:
+        # the queue: active jobs in launch order
+        indexes = [models.Index(fields=['active', 'id'],
+                                name='imputer_queue_idx')]
+
+    @classmethod
+    def queue_position(cls, oh_id):
+        """
+        Number of active jobs launched before the member's, None when the
+        member has no active job.
+        """
+        own = cls.objects.filter(oh_id=oh_id, active=True).order_by(
+            '-id').values_list('id', flat=True).first()
+        if own is None:
+            return None
+        return cls.objects.filter(active=True, id__lt=own).count()
+
+    @classmethod
+    def admitted(cls, since):
+        """
+        Active admitted members whose pipeline was heard from after since;
+        older ones are taken for failed runs and hold nothing.
+        """
+        return cls.objects.filter(active=True, admitted_at__isnull=False,
+                                  updated_at__gte=since)
+
+    @classmethod
+    def touch(cls, oh_id):
+        """Note that the member's run is making progress, see admitted."""
+        cls.objects.filter(oh_id=oh_id, active=True).update(
+            updated_at=timezone.now())
+
+    @classmethod
+    def reserved(cls, since):
+        """Sum of the admitted members' reservations."""
+        totals = cls.admitted(since).aggregate(
+            cpus=models.Sum('reserved_cpus'),
+            memory=models.Sum('reserved_memory'),
+            disk=models.Sum('reserved_disk'))
+        return (totals['cpus'] or 0.0, totals['memory'] or 0,
+                totals['disk'] or 0)
 
     def __str__(self):
         return 'id: {}\noh_id: {}\nstep: {}\nactive: {}\ncreated_at: {}\nupdated_at: {}'.format(self.id,
             self.oh_id, self.step, self.active, self.created_at, self.updated_at)
+
+
+class ChromosomeRuntime(models.Model):
+    """Smoothed submit_chrom runtime, the cost model for task ordering."""
+    chrom = models.CharField(max_length=2, unique=True)
+    runs = models.IntegerField(default=0)
+    mean_seconds = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def record(cls, chrom, seconds):
+        cls.objects.get_or_create(chrom=chrom)
+        # members' runs of a chromosome finish concurrently, the row lock
+        # keeps one from overwriting another's update
+        with transaction.atomic():
+            runtime = cls.objects.select_for_update().get(chrom=chrom)
+            runtime.mean_seconds = smoothed(runtime.mean_seconds, seconds,
+                                            runtime.runs)
+            runtime.runs += 1
+            runtime.save()
+
+    @classmethod
+    def runtimes(cls):
+        return {runtime.chrom: runtime.mean_seconds
+                for runtime in cls.objects.filter(runs__gt=0)}
+
+    def __str__(self):
+        return 'chr{}: {:.0f}s over {} runs'.format(
+            self.chrom, self.mean_seconds, self.runs)
+
+
+class ImputationBatch(models.Model):
+    """Members imputed together in one multi-sample run per chromosome."""
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def members(self):
+        return list(self.imputermember_set.filter(active=True).order_by('id'))
+
+    def __str__(self):
+        return 'batch {} of {} members'.format(
+            self.id, self.imputermember_set.count())
+
+
+class PipelineCheckpoint(models.Model):
+    """
+    A finished stage of a member's pipeline run, per chromosome where the
+    stage is, with an md5 over the size and mtime of the files it wrote.
+    """
+    member = models.ForeignKey(ImputerMember, on_delete=models.CASCADE)
+    stage = models.CharField(max_length=20)
+    chrom = models.CharField(max_length=2, blank=True, default='')
+    checksum = models.CharField(max_length=32, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('member', 'stage', 'chrom')
+
+    @classmethod
+    def record(cls, member, stage, checksum, chrom=''):
+        cls.objects.update_or_create(member=member, stage=stage, chrom=chrom,
+                                     defaults={'checksum': checksum})
+
+    def __str__(self):
+        return '{} {} chr{} {}'.format(self.member.oh_id, self.stage,
+                                       self.chrom, self.checksum)
+
+
+class TaskMetric(models.Model):
+    """
+    Queue wait, wall and cpu time and peak memory of one task run. peak_rss
+    is the worker's, left empty when another task ran in the same process;
+    the child fields cover the programs the task ran.
+    """
+    task = models.CharField(max_length=64)
+    task_id = models.CharField(max_length=36, blank=True, default='')
+    oh_id = models.IntegerField(null=True, blank=True, db_index=True)
+    chrom = models.CharField(max_length=2, blank=True, default='')
+    state = models.CharField(max_length=10, blank=True, default='')
+    started_at = models.DateTimeField(db_index=True)
+    queue_seconds = models.FloatField(null=True, blank=True)
+    wall_seconds = models.FloatField()
+    cpu_seconds = models.FloatField()
+    child_cpu_seconds = models.FloatField(default=0)
+    peak_rss = models.BigIntegerField(null=True, blank=True)
+    child_peak_rss = models.BigIntegerField(null=True, blank=True)
+
+    @classmethod
+    def aggregates(cls):
+        """Totals and peaks per task, chromosome and final state."""
+        return cls.objects.values('task', 'chrom', 'state').annotate(
+            runs=models.Count('id'),
+            total_queue_seconds=models.Sum('queue_seconds'),
+            total_wall_seconds=models.Sum('wall_seconds'),
+            total_cpu_seconds=models.Sum('cpu_seconds'),
+            total_child_cpu_seconds=models.Sum('child_cpu_seconds'),
+            max_peak_rss=models.Max('peak_rss'),
+            max_child_peak_rss=models.Max('child_peak_rss'),
+        ).order_by('task', 'chrom', 'state')
+
+    @classmethod
+    def chrom_profile(cls, tasks=('submit_chrom', 'impute_segment')):
+        """
+        Largest peak RSS of the programs per chromosome, and the cores a
+        chromosome task keeps busy (None before any run), over successful
+        runs of tasks.
+        """
+        runs = cls.objects.filter(task__in=tasks, state='SUCCESS')
+        peaks = {row['chrom']: row['peak']
+                 for row in runs.values('chrom').annotate(
+                     peak=models.Max('child_peak_rss'))}
+        totals = runs.aggregate(cpu=models.Sum('child_cpu_seconds'),
+                                wall=models.Sum('wall_seconds'))
+        cores = None
+        if totals['wall']:
+            cores = totals['cpu'] / totals['wall']
+        return peaks, cores
+
+    def __str__(self):
+        return '{} {} chr{}: {:.0f}s'.format(self.task, self.oh_id,
+                                             self.chrom, self.wall_seconds)
+
+
+class ChromosomeProgress(models.Model):
+    """Where a member's chromosome is in imputation, for the dashboard."""
+    member = models.ForeignKey(ImputerMember, on_delete=models.CASCADE)
+    chrom = models.CharField(max_length=2)
+    stage = models.CharField(max_length=20)
+    segments_done = models.IntegerField(default=0)
+    segments_total = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('member', 'chrom')
+
+    @classmethod
+    def record(cls, oh_id, chrom, stage, done=None, total=None):
+        member = ImputerMember.objects.filter(
+            oh_id=oh_id, active=True).order_by('-id').first()
+        if member is None:
+            return
+        defaults = {'stage': stage}
+        if done is not None:
+            defaults['segments_done'] = done
+        if total is not None:
+            defaults['segments_total'] = total
+        cls.objects.update_or_create(member=member, chrom=chrom,
+                                     defaults=defaults)
+        ImputerMember.touch(oh_id)
+
+    @classmethod
+    def segment_done(cls, oh_id, chrom):
+        """Count one more finished segment of a fanned-out chromosome."""
+        cls.objects.filter(member__oh_id=oh_id, member__active=True,
+                           chrom=chrom).update(
+            segments_done=models.F('segments_done') + 1)
+        ImputerMember.touch(oh_id)
+
+    def percent(self):
+        if not self.segments_total:
+            return 0
+        return int(100 * self.segments_done / self.segments_total)
+
+    def __str__(self):
+        return 'chr{} {} {}/{}'.format(self.chrom, self.stage,
+                                      self.segments_done, self.segments_total)
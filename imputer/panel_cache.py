@@ -0,0 +1,299 @@
+"""
+Decompressed, sliced copies of the reference panel.
+
+Every imputation used to gunzip the whole 1000GP_Phase3 .hap.gz/.legend.gz
+of its chromosome. The cache keeps one decompressed copy per panel file
+(an entry named "whole") with a row index of positions and byte offsets,
+and cuts per-segment slices out of it with impute2's 250 kb buffer on both
+sides, so an impute_segment task reads only its own window.
+
+Layout: <root>/<version>/<panel name>/{whole,<start>_<end>}/. Every entry
+directory is an LRU unit: its mtime is bumped on use and the least recently
+used entries are removed once the cache is over its byte budget.
+
+A task reading an entry holds a shared lock on its in-use file until it
+leaves the PanelCache's with block (or its process exits), and eviction
+skips every entry it cannot lock exclusively, however long the run.
+"""
+import fcntl
+import gzip
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger('oh')
+
+# impute2's default -buffer, in bp
+SEGMENT_BUFFER = 250000
+COPY_BUFFER = 16 * 1024 * 1024
+# an entry's lock file, shared by the tasks reading it
+IN_USE = '.in_use'
+# bytes per panel variant besides its haplotypes: the legend row and the
+# index's three int64
+LEGEND_ROW_BYTES = 64
+# budget over the panel's whole size, for the segment slices and their
+# impute2 buffers
+SLICE_OVERHEAD = 2.2
+
+
+def panel_budget(sample_file, variants):
+    """
+    A budget holding every decompressed panel file and its segment slices:
+    variants panel rows, each two haplotype columns per sample in the
+    panel's .sample file.
+    """
+    with open(sample_file) as samples:
+        count = sum(1 for line in samples if line.strip()) - 1
+    return int(variants * (count * 2 * 2 + LEGEND_ROW_BYTES) *
+               SLICE_OVERHEAD)
+
+
+def panel_name(files):
+    """Cache key of a panel file set, from its haplotype file name."""
+    name = os.path.basename(files['hap'])
+    for ext in ['.gz', '.hap']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def _decompress(source, dest, header=False):
+    """
+    gunzip source into dest, returning the byte offset of every row and of
+    the end of the file. A header line is copied but not indexed.
+    """
+    offsets = []
+    with gzip.open(source, 'rb') as lines, open(dest, 'wb') as out:
+        if header:
+            out.write(lines.readline())
+        position = out.tell()
+        for line in lines:
+            offsets.append(position)
+            out.write(line)
+            position += len(line)
+    offsets.append(position)
+    return np.array(offsets, dtype=np.int64)
+
+
+def _legend_positions(legend_fp):
+    with open(legend_fp, 'rb') as legend:
+        legend.readline()
+        return np.array([int(line.split(None, 2)[1]) for line in legend],
+                        dtype=np.int64)
+
+
+def _copy_range(source, dest, start, end, prefix=b''):
+    with open(source, 'rb') as src, open(dest, 'wb') as out:
+        out.write(prefix)
+        src.seek(start)
+        remaining = end - start
+        while remaining:
+            block = src.read(min(COPY_BUFFER, remaining))
+            if not block:
+                break
+            out.write(block)
+            remaining -= len(block)
+
+
+def _size(path):
+    total = 0
+    for directory, _, names in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(directory, name))
+                     for name in names)
+    return total
+
+
+class PanelCache:
+    """
+    The panel cache under root for one panel version. budget is in bytes.
+    Lookups return a files dict like imputer.segments.panel, with hap and
+    legend replaced by the cached copies, and keep the entries they return
+    from eviction until release() (or the end of a with block).
+    """
+
+    def __init__(self, root, version, budget, buffer=SEGMENT_BUFFER):
+        self.root = os.path.join(root, version)
+        self.budget = budget
+        self.buffer = buffer
+        # open in-use files of the entries this cache handed out
+        self.holds = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        """Let the entries looked up so far be evicted again."""
+        for holder in self.holds.values():
+            holder.close()
+        self.holds = {}
+
+    def _hold(self, entry):
+        """
+        Take a shared lock on entry, False when it was evicted before the
+        lock was granted.
+        """
+        if entry in self.holds:
+            return True
+        path = os.path.join(entry, IN_USE)
+        try:
+            holder = open(path, 'a')
+        except FileNotFoundError:
+            return False
+        fcntl.flock(holder, fcntl.LOCK_SH)
+        try:
+            current = os.stat(path).st_ino == os.fstat(holder.fileno()).st_ino
+        except FileNotFoundError:
+            current = False
+        if not current:
+            holder.close()
+            return False
+        self.holds[entry] = holder
+        return True
+
+    @contextmanager
+    def _lock(self, files=None):
+        """Per panel file, so chromosomes build their entries in parallel."""
+        name = '.lock.' + panel_name(files) if files else '.lock'
+        with open(os.path.join(self.root, name), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry(self, files, name):
+        return os.path.join(self.root, panel_name(files), name)
+
+    def _use(self, entry, files):
+        os.utime(entry)
+        return dict(files, hap=os.path.join(entry, 'panel.hap'),
+                    legend=os.path.join(entry, 'panel.legend'))
+
+    def _publish(self, building, entry):
+        os.rename(building, entry)
+        self.evict(keep=[entry])
+
+    def _build_whole(self, files, entry):
+        building = entry + '.building'
+        shutil.rmtree(building, ignore_errors=True)
+        os.makedirs(building)
+        started = time.monotonic()
+        hap = _decompress(files['hap'], os.path.join(building, 'panel.hap'))
+        legend = _decompress(files['legend'],
+                             os.path.join(building, 'panel.legend'),
+                             header=True)
+        positions = _legend_positions(os.path.join(building, 'panel.legend'))
+        if len(positions) != len(hap) - 1:
+            shutil.rmtree(building)
+            raise ValueError('{} has {} rows for {} legend rows'.format(
+                files['hap'], len(hap) - 1, len(positions)))
+        np.savez(os.path.join(building, 'index.npz'), positions=positions,
+                 hap=hap, legend=legend)
+        open(os.path.join(building, IN_USE), 'w').close()
+        self._publish(building, entry)
+        logger.info('cached {} in {:.0f}s'.format(
+            panel_name(files), time.monotonic() - started))
+
+    def whole(self, files):
+        """The decompressed panel of a whole chromosome (or chrX region)."""
+        entry = self._entry(files, 'whole')
+        with self._lock(files):
+            while not self._hold(entry):
+                self._build_whole(files, entry)
+            return self._use(entry, files)
+
+    def segment(self, files, start, end):
+        """The panel rows impute2 reads for -int start end."""
+        entry = self._entry(files, '{}_{}'.format(start, end))
+        with self._lock(files):
+            if self._hold(entry):
+                return self._use(entry, files)
+        whole_held = self._entry(files, 'whole') in self.holds
+        whole = self.whole(files)
+        whole_dir = os.path.dirname(whole['hap'])
+        with self._lock(files):
+            if self._hold(entry):
+                return self._use(entry, files)
+            index = np.load(os.path.join(whole_dir, 'index.npz'))
+            positions = index['positions']
+            first = np.searchsorted(positions, start - self.buffer, 'left')
+            last = np.searchsorted(positions, end + self.buffer, 'right')
+            building = entry + '.building'
+            shutil.rmtree(building, ignore_errors=True)
+            os.makedirs(building)
+            with open(whole['legend'], 'rb') as legend:
+                legend_header = legend.readline()
+            open(os.path.join(building, IN_USE), 'w').close()
+            _copy_range(whole['hap'], os.path.join(building, 'panel.hap'),
+                        index['hap'][first], index['hap'][last])
+            _copy_range(whole['legend'],
+                        os.path.join(building, 'panel.legend'),
+                        index['legend'][first], index['legend'][last],
+                        prefix=legend_header)
+            self._publish(building, entry)
+            self._hold(entry)
+            if not whole_held:
+                self.holds.pop(whole_dir).close()
+            return self._use(entry, files)
+
+    def entries(self):
+        """(last used, size, path) of every cache entry."""
+        found = []
+        for name in os.listdir(self.root):
+            panel_dir = os.path.join(self.root, name)
+            if not os.path.isdir(panel_dir):
+                continue
+            for entry in os.listdir(panel_dir):
+                path = os.path.join(panel_dir, entry)
+                if (entry.endswith(('.building', '.evicting')) or
+                        not os.path.isdir(path)):
+                    continue
+                found.append((os.path.getmtime(path), _size(path), path))
+        return found
+
+    def trim(self):
+        """Evict down to the budget, returning the bytes left in use."""
+        with self._lock():
+            return self.evict()
+
+    def _remove(self, path):
+        """Remove an entry unless a task holds it, returning whether it did."""
+        try:
+            holder = open(os.path.join(path, IN_USE), 'a')
+        except FileNotFoundError:
+            return False
+        with holder:
+            try:
+                fcntl.flock(holder, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # out of the way first, so no task can open it any more
+            evicting = path + '.evicting'
+            shutil.rmtree(evicting, ignore_errors=True)
+            os.rename(path, evicting)
+        shutil.rmtree(evicting)
+        return True
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used entries until the cache fits its budget.
+        Entries in keep, and those a task holds, are left alone.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for used, size, path in entries:
+            if total <= self.budget:
+                break
+            if path in keep or path in self.holds or not self._remove(path):
+                continue
+            total -= size
+            logger.info('evicted {} from the panel cache'.format(path))
+        return total
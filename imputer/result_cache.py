@@ -0,0 +1,130 @@
+"""
+Imputation results addressed by their inputs.
+
+A chromosome's key is a sha256 over the member's plink records for that
+chromosome (the .fam line, the .bim rows and their .bed bytes) together
+with a salt naming the reference panel, tool versions and pipeline options.
+The same genotypes uploaded again, through any source, get the same keys,
+so their processed vcfs are copied from the cache instead of re-imputed.
+
+Entries live in <root>/<key>/ and are evicted least recently used first
+once the cache is over its byte budget.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger('oh')
+
+# plink chromosome codes that belong to an imputer chromosome
+PLINK_CHROMS = {'23': ['23', 'X', '25', 'XY']}
+# entries used this recently are never evicted, they may be being copied
+EVICTION_GRACE = 60 * 60
+
+
+def genotype_keys(bfile, chroms, salt):
+    """sha256 per chromosome of the member's genotypes in bfile."""
+    with open(bfile + '.fam', 'rb') as fam:
+        samples = fam.read()
+    bytes_per_variant = (len(samples.splitlines()) + 3) // 4
+    digests = {}
+    codes = {}
+    for chrom in chroms:
+        digest = hashlib.sha256(salt.encode() + b'\0' + chrom.encode() +
+                                b'\0' + samples)
+        digests[chrom] = digest
+        for code in PLINK_CHROMS.get(chrom, [chrom]):
+            codes[code.encode()] = digest
+    with open(bfile + '.bim', 'rb') as bim, open(bfile + '.bed', 'rb') as bed:
+        bed.read(3)
+        for line in bim:
+            genotypes = bed.read(bytes_per_variant)
+            fields = line.split()
+            digest = codes.get(fields[0])
+            if digest is not None:
+                # centimorgans do not reach impute2's input
+                digest.update(b'\t'.join([fields[0], fields[1]] + fields[3:]))
+                digest.update(genotypes)
+    return {chrom: digest.hexdigest() for chrom, digest in digests.items()}
+
+
+def combined_key(keys, *parts):
+    """Key of a file built from several chromosomes' results."""
+    digest = hashlib.sha256()
+    for chrom in sorted(keys, key=int):
+        digest.update('{}={}\0'.format(chrom, keys[chrom]).encode())
+    for part in parts:
+        digest.update('{}\0'.format(part).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """The result cache under root, bounded to budget bytes."""
+
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        os.makedirs(root, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key, destinations):
+        """
+        Copy the entry's files to destinations, a dict of cached name to
+        path. Returns False on a miss.
+        """
+        entry = self._entry(key)
+        try:
+            os.utime(entry)
+            for name, dest in destinations.items():
+                shutil.copyfile(os.path.join(entry, name), dest)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, sources):
+        """Store sources, a dict of cached name to path, under key."""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+        building = '{}.{}.building'.format(entry, os.getpid())
+        os.makedirs(building, exist_ok=True)
+        try:
+            for name, source in sources.items():
+                shutil.copyfile(source, os.path.join(building, name))
+            os.rename(building, entry)
+        except OSError:
+            # another worker stored the same key first
+            shutil.rmtree(building, ignore_errors=True)
+        self.evict(keep=[entry])
+
+    def entries(self):
+        """(last used, size, path) of every entry."""
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.building') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            found.append((os.path.getmtime(path), size, path))
+        return found
+
+    def evict(self, keep=()):
+        """Remove least recently used entries until within the budget."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        recent = time.time() - EVICTION_GRACE
+        for used, size, path in entries:
+            if total <= self.budget:
+                break
+            if path in keep or used > recent:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logger.info('evicted {} from the result cache'.format(path))
+        return total
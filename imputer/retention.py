@@ -0,0 +1,91 @@
+"""
+Removal of a chromosome's intermediate files as soon as its vcf is final.
+
+genipe, shapeit, impute2 and plink2 leave phased haplotypes, per-segment
+impute2 chunks, .GP tables and .bak copies in OUT_DIR/<oh_id>/chrN. Left
+until upload_to_oh, a member's peak disk use is the sum over all
+chromosomes; pruned per chromosome it is the few running at once plus the
+finished vcfs.
+
+settings.SCRATCH_RETENTION picks what a processed chromosome keeps:
+
+all      everything, until upload_to_oh (the old behaviour)
+impute2  the vcf and the merged .impute2/.impute2_info/.sample, so the
+         chromosome can still be processed again without re-imputing
+vcf      only the vcf and its captured header
+"""
+import logging
+import os
+
+logger = logging.getLogger('oh')
+
+POLICIES = ('all', 'impute2', 'vcf')
+# bytes read from the end of a vcf to find its last record
+TAIL_BYTES = 64 * 1024
+
+
+def _fields(line):
+    return line.rstrip(b'\n').split(b'\t')
+
+
+def _record_ok(line, columns):
+    fields = _fields(line)
+    return len(fields) == columns and fields[1].isdigit()
+
+
+def valid_vcf(path):
+    """
+    Whether path is a complete vcf: a #CHROM header, at least one record,
+    and a first and last record with every column, the last one ending in
+    a newline. Reads the head and the tail only.
+    """
+    try:
+        with open(path, 'rb') as vcf:
+            line = vcf.readline()
+            while line.startswith(b'##'):
+                line = vcf.readline()
+            if not line.startswith(b'#CHROM'):
+                return False
+            columns = len(_fields(line))
+            if not _record_ok(vcf.readline(), columns):
+                return False
+            size = vcf.seek(0, os.SEEK_END)
+            vcf.seek(max(0, size - TAIL_BYTES))
+            tail = vcf.read()
+    except OSError:
+        return False
+    if not tail.endswith(b'\n'):
+        return False
+    return _record_ok(tail.rstrip(b'\n').rsplit(b'\n', 1)[-1] + b'\n',
+                      columns)
+
+
+def prune(directory, keep):
+    """
+    Delete everything under directory except the files in keep, and the
+    directories left empty. Returns the number of bytes freed.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    freed = 0
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for name in files:
+            path = os.path.abspath(os.path.join(root, name))
+            if path in keep:
+                continue
+            try:
+                freed += os.lstat(path).st_size
+                os.remove(path)
+            except OSError as error:
+                logger.warning('could not remove {}: {}'.format(path, error))
+        for name in dirs:
+            path = os.path.join(root, name)
+            try:
+                # symlinked directories (panel cache) are unlinked, not
+                # followed; directories holding kept files stay
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    os.rmdir(path)
+            except OSError:
+                pass
+    return freed
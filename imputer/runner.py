@@ -0,0 +1,125 @@
+"""
+Run the pipeline's programs with their output streamed to log files.
+
+stdout and stderr go, line by line as they are written, to a rotating log
+per member and chromosome, step or segment under
+settings.PIPELINE_LOG_DIR, so hours of genipe, shapeit and impute2 output
+never sit in worker memory.
+Only the last lines are kept, for the error raised when a program exits
+non-zero. Each line can also be handed to a progress parser.
+"""
+import logging
+import os
+import re
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from subprocess import PIPE, STDOUT, CompletedProcess, Popen
+
+from django.conf import settings
+
+from imputer.metrics import add_child_usage
+
+# lines of output kept for CommandFailed
+TAIL_LINES = 20
+
+
+class CommandFailed(Exception):
+    def __init__(self, command, returncode, log_path, tail):
+        self.command = command
+        self.returncode = returncode
+        self.log_path = log_path
+        self.tail = tail
+        super().__init__('{} exited with {}, see {}:\n{}'.format(
+            os.path.basename(str(command[0])), returncode, log_path, tail))
+
+
+def log_path(oh_id, name):
+    """
+    The log of one member's chromosome ('chr1'), step ('prepare') or
+    impute2 segment ('chr1.segment.chr1.5000001'). Only one process may
+    write a log at a time: the handler rotates it without a lock.
+    """
+    directory = os.path.join(settings.PIPELINE_LOG_DIR, str(oh_id))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, '{}.log'.format(name))
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run(command, log, progress=None, check=True, **kwargs):
+    """
+    Run command with its output appended to the log file at log. progress
+    is called with every line. Raises CommandFailed on a non-zero exit
+    when check is set; the result's stderr holds the last lines of output.
+    """
+    handler = RotatingFileHandler(log, maxBytes=settings.PIPELINE_LOG_BYTES,
+                                  backupCount=settings.PIPELINE_LOG_BACKUPS)
+
+    def write(line):
+        handler.emit(logging.makeLogRecord({'msg': line}))
+
+    tail = deque(maxlen=TAIL_LINES)
+    try:
+        write('$ {}'.format(' '.join(str(part) for part in command)))
+        process = Popen(command, stdout=PIPE, stderr=STDOUT, **kwargs)
+        with process.stdout:
+            for raw in process.stdout:
+                line = raw.decode('utf-8', 'replace').rstrip('\n')
+                write(line)
+                tail.append(line)
+                if progress is not None:
+                    progress(line)
+        # reaped here rather than by Popen, for the child's rusage
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = _exit_code(status)
+        add_child_usage(usage)
+        write('exit {}'.format(process.returncode))
+    finally:
+        handler.close()
+    text = '\n'.join(tail)
+    if check and process.returncode != 0:
+        raise CommandFailed(command, process.returncode, log, text)
+    return CompletedProcess(command, process.returncode,
+                            stderr=text.encode('utf-8'))
+
+
+# genipe-launcher logs a line per stage and, running its tasks one at a
+# time, "Executing IMPUTE2 chr1 from 1 to 5000000" before and
+# "Task 'IMPUTE2 chr1 from 1 to 5000000': performed in 42 seconds" (or
+# "already performed") after every impute2 segment.
+GENIPE_STAGES = [
+    ('Phasing markers', 'phasing'),
+    ('Imputing markers', 'imputing'),
+    ('Merging impute2 files', 'merging'),
+    ('Done imputing markers', 'merging'),
+]
+GENIPE_SEGMENT_DONE = re.compile(r"Task 'IMPUTE2 chr\S+ from \d+ to \d+': ")
+
+
+class GenipeProgress:
+    """
+    Follows genipe-launcher's log and calls update(stage, done, total) when
+    its stage or number of finished segments changes.
+    """
+
+    def __init__(self, total, update):
+        self.total = total
+        self.update = update
+        self.stage = 'starting'
+        self.done = 0
+
+    def __call__(self, line):
+        stage = self.stage
+        done = self.done
+        for marker, name in GENIPE_STAGES:
+            if marker in line:
+                stage = name
+        if GENIPE_SEGMENT_DONE.search(line):
+            done = min(done + 1, self.total)
+        if (stage, done) != (self.stage, self.done):
+            self.stage, self.done = stage, done
+            self.update(stage, done, self.total)
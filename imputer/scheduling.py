@@ -0,0 +1,83 @@
+"""
+Cost model and ordering for the per-chromosome imputation tasks.
+
+A chromosome's cost starts out proportional to the number of reference
+panel variants on it and is replaced by the measured submit_chrom runtime
+once there are runs to learn from. Enqueuing the expensive chromosomes
+first (longest job first) keeps chr1/chr2 from starting last and
+dominating a member's makespan.
+"""
+import heapq
+
+# variant sites per chromosome in the 1000 Genomes Phase 3 panel
+PANEL_VARIANTS = {
+    '1': 6468094, '2': 7081600, '3': 5832276, '4': 5732585, '5': 5265763,
+    '6': 5024119, '7': 4716715, '8': 4597105, '9': 3560687,
+    '10': 3992219, '11': 4045628, '12': 3868428, '13': 2857916,
+    '14': 2655067, '15': 2424689, '16': 2697949, '17': 2329288,
+    '18': 2267185, '19': 1832506, '20': 1812841, '21': 1105538,
+    '22': 1103547, '23': 3468093,
+}
+# weight of the newest runtime in the moving average
+RUNTIME_SMOOTHING = 0.3
+
+
+def estimated_costs(chroms, runtimes=None):
+    """
+    Expected submit_chrom seconds per chromosome.
+    runtimes maps chromosome to its averaged measured runtime. Chromosomes
+    without one are scaled from their panel size by the seconds per variant
+    seen on the measured chromosomes; with no measurements at all the cost
+    is the panel size itself, which is enough to order them.
+    """
+    runtimes = runtimes or {}
+    measured = [c for c in runtimes if c in PANEL_VARIANTS]
+    rate = 1.0
+    if measured:
+        rate = (sum(runtimes[c] for c in measured) /
+                sum(PANEL_VARIANTS[c] for c in measured))
+    return {chrom: runtimes.get(chrom, PANEL_VARIANTS.get(chrom, 0) * rate)
+            for chrom in chroms}
+
+
+def order_by_cost(chroms, costs):
+    """Most expensive first; ties keep numeric order."""
+    return sorted(chroms, key=lambda chrom: (-costs[chrom], int(chrom)))
+
+
+def priorities(chroms, costs, levels=10, highest=0):
+    """
+    Spread chromosomes over broker priority levels by cost. With the redis
+    broker 0 is the highest priority, with RabbitMQ pass highest=levels - 1.
+    """
+    top = max(costs[chrom] for chrom in chroms) or 1
+    step = 1 if highest == 0 else -1
+    return {chrom: highest + step * int(
+        (levels - 1) * (1 - costs[chrom] / top)) for chrom in chroms}
+
+
+def smoothed(previous, seconds, runs):
+    """Exponential moving average of a chromosome's runtime."""
+    if not runs:
+        return seconds
+    return previous + RUNTIME_SMOOTHING * (seconds - previous)
+
+
+def simulate_makespan(members, workers):
+    """
+    Simulate FIFO workers draining a queue in which each member's
+    chromosome tasks were enqueued back to back.
+    members is a list of per-member task durations in enqueue order.
+    Returns (makespan, mean member completion time).
+    """
+    free = [0.0] * workers
+    heapq.heapify(free)
+    finished = []
+    for durations in members:
+        done = 0.0
+        for duration in durations:
+            start = heapq.heappop(free)
+            heapq.heappush(free, start + duration)
+            done = max(done, start + duration)
+        finished.append(done)
+    return max(finished), sum(finished) / len(finished)
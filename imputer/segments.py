@@ -0,0 +1,255 @@
+"""
+Commands for running a chromosome's imputation as separate tasks:
+phase once with shapeit, impute2 every segment on its own, then merge the
+segments with genipe's impute2-merger into the usual final_impute2 files.
+
+This mirrors what genipe-launcher does in one process. Splitting it lets
+the segments of one chromosome spread over every worker in the fleet.
+"""
+import os
+
+# hg19 chromosome lengths
+CHROM_LENGTHS = {
+    '1': 249250621, '2': 243199373, '3': 198022430, '4': 191154276,
+    '5': 180915260, '6': 171115067, '7': 159138663, '8': 146364022,
+    '9': 141213431, '10': 135534747, '11': 135006516, '12': 133851895,
+    '13': 115169878, '14': 107349540, '15': 102531392, '16': 90354753,
+    '17': 81195210, '18': 78077248, '19': 59128983, '20': 63025520,
+    '21': 48129895, '22': 51304566, '23': 155270560,
+}
+# hg19 pseudo-autosomal regions of chrX
+PAR1_END = 2699520
+PAR2_START = 154931044
+
+# genipe-launcher defaults
+NE = 20000
+FILTER_RULES = ['ALL<0.01', 'ALL>0.99']
+MERGE_PROBABILITY = 0.9
+MERGE_COMPLETION = 0.98
+MERGE_INFO = 0
+# genipe's pre-phasing marker checks
+AMBIGUOUS = {'AT', 'TA', 'GC', 'CG'}
+COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
+# plink codes of chrX markers, nonPAR (23, X) and PAR (25, XY)
+X_CODES = {'23', '25', 'X', 'XY'}
+# impute2 summary lines for a segment with nothing to impute, which genipe
+# skips rather than failing the chromosome
+EMPTY_SEGMENT = ['There are no type 2 SNPs',
+                 'no SNPs in the imputation interval']
+
+
+def regions(chrom):
+    """
+    (name, start, end, plink chromosome codes) of the parts of a chromosome
+    that are phased and imputed separately. Only chrX is split: the
+    pseudo-autosomal regions use their own panels and are coded 25 (XY) in
+    plink.
+    """
+    if chrom != '23':
+        return [('chr{}'.format(chrom), 1, CHROM_LENGTHS[chrom], chrom)]
+    return [('PAR1', 1, PAR1_END, '25'),
+            ('nonPAR', PAR1_END + 1, PAR2_START - 1, '23'),
+            ('PAR2', PAR2_START, CHROM_LENGTHS['23'], '25')]
+
+
+def chrom_segments(chrom, length):
+    """(region, start, end) of every impute2 segment of a chromosome."""
+    found = []
+    for name, region_start, region_end, _ in regions(chrom):
+        for start in range(region_start, region_end + 1, length):
+            found.append((name, start, min(start + length - 1, region_end)))
+    return found
+
+
+def panel(chrom, region, ref_panel, ref_panel_x):
+    """Reference haplotypes, legend, map and sample for one region."""
+    sample = '{}/1000GP_Phase3.sample'.format(ref_panel)
+    if chrom != '23':
+        return {
+            'hap': '{}/1000GP_Phase3_chr{}.hap.gz'.format(ref_panel, chrom),
+            'legend': '{}/1000GP_Phase3_chr{}.legend.gz'.format(ref_panel,
+                                                                chrom),
+            'map': '{}/genetic_map_chr{}_combined_b37.txt'.format(ref_panel,
+                                                                  chrom),
+            'sample': sample,
+        }
+    return {
+        'hap': '{}/1000GP_Phase3_chrX_{}.hap.gz'.format(
+            ref_panel_x, region.upper()),
+        'legend': '{}/1000GP_Phase3_chrX_{}.legend.gz'.format(
+            ref_panel_x, region.upper()),
+        'map': '{}/genetic_map_chrX_{}_combined_b37.txt'.format(
+            ref_panel_x, region),
+        'sample': sample,
+    }
+
+
+def phased_prefix(work_dir, region):
+    return os.path.join(work_dir, 'phased', region)
+
+
+def segment_prefix(work_dir, region, start, end):
+    return os.path.join(work_dir, 'segments',
+                        '{}.{}_{}.impute2'.format(region, start, end))
+
+
+def _complement(allele):
+    return COMPLEMENT.get(allele, '')
+
+
+def prephase_lists(bim, chrom, region, reference):
+    """
+    genipe's marker lists for one region of the member's plink bim, before
+    the shapeit strand checks: 'extract' the region's markers, 'exclude'
+    ambiguous (A/T, C/G) and duplicated ones, 'flip' those on the reverse
+    strand of reference (an imputer.vcf.Reference) and 'update_chr' the
+    chrX markers coded for the other chrX region ('name code' lines for
+    plink --update-map).
+    """
+    _, start, end, plink_chr = [r for r in regions(chrom)
+                                if r[0] == region][0]
+    codes = X_CODES if chrom == '23' else {plink_chr}
+    markers = []
+    with open(bim) as bim_file:
+        for line in bim_file:
+            code, name, _, pos, a1, a2 = line.split()[:6]
+            if code in codes and start <= int(pos) <= end:
+                markers.append((code, name, int(pos), a1.upper(),
+                                a2.upper()))
+    lists = {'extract': [], 'exclude': [], 'flip': [], 'update_chr': []}
+    bases = reference.bases(chrom, [pos for _, _, pos, _, _ in markers])
+    kept = set()
+    for (code, name, pos, a1, a2), base in zip(markers, bases):
+        lists['extract'].append(name)
+        if code != plink_chr:
+            lists['update_chr'].append('{} {}'.format(name, plink_chr))
+        if a1 + a2 in AMBIGUOUS or (code, pos) in kept:
+            lists['exclude'].append(name)
+            continue
+        kept.add((code, pos))
+        base = chr(base)
+        if (a1 not in COMPLEMENT or a2 not in COMPLEMENT or
+                base not in COMPLEMENT or base in (a1, a2)):
+            continue
+        if base in (_complement(a1), _complement(a2)):
+            lists['flip'].append(name)
+        else:
+            # genipe stops the whole run here; one marker matching neither
+            # strand is left out instead
+            lists['exclude'].append(name)
+    return lists
+
+
+def write_list(path, names):
+    """A marker list for plink, written the way genipe writes them."""
+    with open(path, 'w') as list_file:
+        print(*names, sep='\n', file=list_file)
+
+
+def strand_issues(snp_strand):
+    """Markers shapeit -check reports with a 'Strand' problem."""
+    try:
+        with open(snp_strand) as strand_file:
+            header = strand_file.readline().rstrip('\r\n').split('\t')
+            columns = {name: i + 1 for i, name in enumerate(header)}
+            return sorted({row[columns['main_id']] for row in (
+                line.rstrip('\r\n').split('\t') for line in strand_file
+                if line.strip()) if row[columns['type']] == 'Strand'})
+    except FileNotFoundError:
+        return []
+
+
+def extract_command(bfile, prefix, imp_bin, flip=True, update_chr=False):
+    """plink extraction of the region without the excluded markers."""
+    command = ['{}/plink'.format(imp_bin), '--noweb', '--bfile', bfile,
+               '--make-bed', '--extract', prefix + '.extract',
+               '--exclude', prefix + '.exclude']
+    if flip:
+        command += ['--flip', prefix + '.flip']
+    if update_chr:
+        command += ['--update-map', prefix + '.update_chr', '--update-chr']
+    return command + ['--out', prefix + '.input']
+
+
+def _chrx(region):
+    return ['--chrX'] if region == 'nonPAR' else []
+
+
+def check_command(region, bfile, output_log, files, imp_bin):
+    """shapeit -check of bfile against the panel."""
+    return ['{}/shapeit'.format(imp_bin), '-check', '-B', bfile,
+            '-M', files['map'], '--input-ref', files['hap'],
+            files['legend'], files['sample']] + _chrx(region) + [
+            '--output-log', output_log]
+
+
+def flip_command(prefix, imp_bin):
+    return ['{}/plink'.format(imp_bin), '--noweb', '--make-bed',
+            '--bfile', prefix + '.input', '--flip', prefix + '.to_flip',
+            '--out', prefix + '.flipped']
+
+
+def final_command(prefix, imp_bin, region):
+    """
+    plink exclusion of what the second check still finds, and for chrX of
+    the samples of unknown sex.
+    """
+    command = ['{}/plink'.format(imp_bin), '--noweb', '--make-bed',
+               '--bfile', prefix + '.flipped',
+               '--exclude', prefix + '.to_exclude', '--out', prefix + '.final']
+    if region == 'nonPAR' and os.path.exists(prefix + '.flipped.nosex'):
+        command += ['--remove', prefix + '.flipped.nosex']
+    return command
+
+
+def phase_command(region, files, work_dir, imp_bin, threads=1):
+    """
+    shapeit phasing of the final markers with the panel, leaving out what
+    the check of the flipped markers still excluded.
+    """
+    prefix = phased_prefix(work_dir, region)
+    return ['{}/shapeit'.format(imp_bin), '-B', prefix + '.final',
+            '-M', files['map'], '--input-ref', files['hap'],
+            files['legend'], files['sample']] + _chrx(region) + [
+            '--exclude-snp',
+            prefix + '.to_exclude.alignments.snp.strand.exclude',
+            '--thread', str(threads), '-O', prefix + '.haps',
+            prefix + '.sample', '--output-log', prefix + '.phase']
+
+
+def impute_command(region, start, end, files, work_dir, imp_bin, extra=()):
+    """impute2 on one segment of the prephased haplotypes."""
+    prefix = phased_prefix(work_dir, region)
+    command = [
+        '{}/impute2'.format(imp_bin), '-use_prephased_g',
+        '-known_haps_g', prefix + '.haps',
+        '-h', files['hap'], '-l', files['legend'], '-m', files['map'],
+        '-int', str(start), str(end), '-Ne', str(NE),
+        '-o', segment_prefix(work_dir, region, start, end),
+        '-filt_rules_l'] + FILTER_RULES
+    if region == 'nonPAR':
+        command += ['-chrX', '-sample_known_haps_g', prefix + '.sample']
+    elif region in ('PAR1', 'PAR2'):
+        command += ['-Xpar']
+    return command + list(extra)
+
+
+def empty_segment(prefix):
+    """Whether impute2 stopped on a segment because it had no markers."""
+    try:
+        with open(prefix + '_summary') as summary:
+            text = summary.read()
+    except FileNotFoundError:
+        return False
+    return any(message in text for message in EMPTY_SEGMENT)
+
+
+def merge_command(chrom, segment_files, work_dir):
+    """genipe's impute2-merger, writing final_impute2/chrN.imputed.*"""
+    return ['impute2-merger', '--impute2'] + segment_files + [
+        '--chr', chrom,
+        '--probability', str(MERGE_PROBABILITY),
+        '--completion', str(MERGE_COMPLETION),
+        '--info', str(MERGE_INFO),
+        '--prefix', os.path.join(work_dir, 'final_impute2',
+                                 'chr{}.imputed'.format(chrom))]
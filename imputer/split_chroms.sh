@@ -0,0 +1,26 @@
+#!/bin/bash
+
+# write one plink fileset per chromosome, so each genipe run only reads
+# its own slice. chrX (23) keeps the pseudo-autosomal variants (25).
+# plink fails on a chromosome the member has no variants on; that
+# chromosome gets no fileset and genipe reads the genome-wide one.
+oh_id="$1"
+shift
+for chrom in "$@"
+do
+if [[ $chrom = 23 ]]
+then
+chr_codes=23,25
+else
+chr_codes="$chrom"
+fi
+out="$DATA_DIR"/"$oh_id"/member."$oh_id".chr"$chrom".plink.gt
+if ! "$IMP_BIN"/plink \
+--bfile "$DATA_DIR"/"$oh_id"/member."$oh_id".plink.gt \
+--chr "$chr_codes" \
+--make-bed \
+--out "$out"
+then
+rm -f "$out".bed "$out".bim "$out".fam
+fi
+done
@@ -0,0 +1,215 @@
+"""
+Synthetic imputation data at realistic scale, for benchmarks: genipe's
+final .impute2/.impute2_info/.sample, the vcf plink2 makes of them, a
+reference fasta and the genotyping-array vcfs members upload.
+"""
+import bz2
+import gzip
+
+import numpy as np
+import pandas as pd
+
+from imputer.formatting import format_rounded, join_fields, rewrite_ids
+from imputer.segments import CHROM_LENGTHS
+from imputer.vcf import (IMPUTE_COLS, VCF_COLS, hard_calls, header,
+                         vcf_chrom)
+
+ALLELES = np.array(['A', 'C', 'G', 'T'])
+
+
+def genotype_probabilities(rows, seed=0):
+    """Three probabilities per row that sum to 1, given to 3 digits."""
+    rng = np.random.RandomState(seed)
+    probs = rng.dirichlet([0.2, 0.2, 0.2], size=rows).round(3)
+    probs[:, 2] = (1 - probs[:, 0] - probs[:, 1]).clip(0).round(3)
+    return probs
+
+
+def annotated_vcf_frame(rows, chrom=1, seed=0):
+    """
+    The frame process_chrom annotates: vcf columns from plink2 merged with
+    the GP probabilities and info metric, indexed by ID.
+    """
+    rng = np.random.RandomState(seed)
+    positions = np.sort(rng.randint(10000, 249000000, size=rows))
+    ref = ALLELES[rng.randint(0, 4, size=rows)]
+    alt = ALLELES[(rng.randint(1, 4, size=rows) +
+                   np.searchsorted(ALLELES, ref)) % 4]
+    probs = genotype_probabilities(rows, seed)
+    ids = pd.Series(positions.astype(str)).radd('{}:'.format(chrom)) + \
+        '_' + ref + '_' + alt
+    calls = np.array(['0/0', '0/1', '1/1'])[probs.argmax(axis=1)]
+    df = pd.DataFrame({
+        'CHROM': chrom,
+        'POS': positions,
+        'ID': ids,
+        'REF': ref,
+        'ALT': alt,
+        'QUAL': '.',
+        'FILTER': '.',
+        'INFO': np.where(rng.rand(rows) < 0.01, 'PR', '.'),
+        'FORMAT': 'GT',
+        'MEMBER': calls,
+        'a0a0_p': probs[:, 0],
+        'a0a1_p': probs[:, 1],
+        'a1a1_p': probs[:, 2],
+        'info': rng.beta(5, 1, size=rows),
+    })
+    return df.set_index(['ID'])
+
+
+# the 1000 Genomes phase 3 panel has about one site every 40 bases
+SITE_SPACING = 40
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+INFO_COLS = ['chr', 'name', 'position', 'a0', 'a1', 'exp_freq_a1', 'info',
+             'certainty', 'type', 'info_type0', 'concord_type0', 'r2_type0']
+
+
+def chrom_rows(chrom, scale=1.0):
+    """Imputed sites of a chromosome at panel density, times scale."""
+    return int(CHROM_LENGTHS[chrom] / SITE_SPACING * scale)
+
+
+def write_reference(fasta, chrom, seed=0, line_bases=60):
+    """
+    Append a random hg19-sized contig for chrom to fasta and its .fai.
+    Returns the bases as uint8.
+    """
+    length = CHROM_LENGTHS[chrom]
+    bases = BASES[np.random.RandomState(seed).randint(0, 4, size=length)]
+    name = vcf_chrom(chrom)
+    head = '>{}\n'.format(name).encode()
+    full = length // line_bases
+    lines = np.hstack([bases[:full * line_bases].reshape(full, line_bases),
+                       np.full((full, 1), ord('\n'), dtype=np.uint8)])
+    with open(fasta, 'ab') as out:
+        offset = out.tell() + len(head)
+        out.write(head)
+        out.write(lines.tobytes())
+        if length % line_bases:
+            out.write(bases[full * line_bases:].tobytes() + b'\n')
+    with open(fasta + '.fai', 'a') as fai:
+        fai.write('{}\t{}\t{}\t{}\t{}\n'.format(name, length, offset,
+                                                 line_bases, line_bases + 1))
+    return bases
+
+
+def impute2_sites(chrom, rows, reference, seed=0):
+    """
+    rows sites of a chrN.imputed.impute2 in genipe's layout, spread evenly
+    over the reference bases and named chrom:position:a0:a1. a0 is the
+    reference base except at a tenth of the sites, which are returned as
+    the swap mask.
+    """
+    rng = np.random.RandomState(seed)
+    step = len(reference) // rows
+    positions = np.arange(rows) * step + rng.randint(0, step, size=rows) + 1
+    ref = reference[positions - 1]
+    alt = BASES[(np.searchsorted(BASES, ref) +
+                 rng.randint(1, 4, size=rows)) % 4]
+    swap = rng.rand(rows) < 0.1
+    a0 = np.where(swap, alt, ref).view('S1').astype(str)
+    a1 = np.where(swap, ref, alt).view('S1').astype(str)
+    probs = genotype_probabilities(rows, seed)
+    names = pd.Series(positions.astype(str)).radd('{}:'.format(chrom)) + \
+        ':' + a0 + ':' + a1
+    sites = pd.DataFrame({
+        'chr': chrom, 'name': names.values, 'position': positions,
+        'a0': a0, 'a1': a1, 'a0a0_p': probs[:, 0], 'a0a1_p': probs[:, 1],
+        'a1a1_p': probs[:, 2]}, columns=IMPUTE_COLS)
+    return sites, swap
+
+
+def write_impute2(path, sites):
+    fields = []
+    for column in IMPUTE_COLS[:5]:
+        fields += [sites[column].values, b' ']
+    fields += [format_rounded(sites['a0a0_p']), b' ',
+               format_rounded(sites['a0a1_p']), b' ',
+               format_rounded(sites['a1a1_p']), b'\n']
+    with open(path, 'wb') as out:
+        out.write(join_fields(fields))
+
+
+def write_impute2_info(path, sites, keep=0.9, seed=0):
+    """
+    The .impute2_info of the sites that pass genipe's filters, a keep
+    fraction of them. Returns the mask of kept sites.
+    """
+    rng = np.random.RandomState(seed)
+    kept = rng.rand(len(sites)) < keep
+    rows = int(kept.sum())
+    info = sites[kept]
+    dosage = info['a0a1_p'].values + 2 * info['a1a1_p'].values
+    fields = []
+    for column in INFO_COLS[:5]:
+        fields += [info[column].values, b'\t']
+    fields += [format_rounded(dosage / 2), b'\t',
+               format_rounded(rng.beta(5, 1, size=rows)), b'\t',
+               format_rounded(rng.beta(8, 1, size=rows)), b'\t0\t-1\t-1\t-1\n']
+    with open(path, 'wb') as out:
+        out.write(('\t'.join(INFO_COLS) + '\n').encode())
+        out.write(join_fields(fields))
+    return kept
+
+
+def write_sample(path, fid='member', iid='member'):
+    with open(path, 'w') as out:
+        out.write('ID_1 ID_2 missing father mother sex plink_pheno\n'
+                  '0 0 0 D D D B\n'
+                  '{} {} 0 0 0 0 -9\n'.format(fid, iid))
+
+
+def write_plink2_vcf(path, sites, swap, chrom, sample='member'):
+    """
+    What output_vcf.sh gets from plink2 for the filtered sites: hard calls
+    and REF/ALT set from the reference, IDs as process_chrom rewrites them.
+    """
+    p00, p01, p11 = (sites[col].values
+                     for col in ['a0a0_p', 'a0a1_p', 'a1a1_p'])
+    a0 = sites['a0'].values.astype('S')
+    a1 = sites['a1'].values.astype('S')
+    calls = np.where(swap, hard_calls(p11, p01, p00),
+                     hard_calls(p00, p01, p11))
+    with open(path, 'wb') as out:
+        out.write(header(chrom, sample, CHROM_LENGTHS[chrom]).encode())
+        out.write(join_fields([
+            vcf_chrom(chrom).encode() + b'\t', sites['position'].values,
+            b'\t', rewrite_ids(sites['name']).values, b'\t',
+            np.where(swap, a1, a0), b'\t', np.where(swap, a0, a1),
+            b'\t.\t.\t.\tGT\t', calls, b'\n']))
+
+
+def write_member_vcf(path, sites=600000, codec='bz2', seed=0):
+    """
+    A genotyping-array vcf like the ones members upload, across all
+    chromosomes, compressed with codec (bz2, gzip or None). Returns the
+    uncompressed size.
+    """
+    rng = np.random.RandomState(seed)
+    chroms = sorted(CHROM_LENGTHS, key=int)
+    lengths = np.array([CHROM_LENGTHS[chrom] for chrom in chroms])
+    counts = np.floor(sites * lengths / lengths.sum()).astype(int)
+    lines = ['##fileformat=VCFv4.2\n'] + [
+        '##contig=<ID={},length={}>\n'.format(vcf_chrom(chrom), length)
+        for chrom, length in zip(chroms, lengths)]
+    lines.append('#{}\tMEMBER\n'.format('\t'.join(VCF_COLS[:-1])))
+    text = [''.join(lines).encode()]
+    rsid = 1
+    for chrom, length, count in zip(chroms, lengths, counts):
+        positions = np.sort(rng.randint(1, length, size=count))
+        ref = BASES[rng.randint(0, 4, size=count)]
+        alt = BASES[(np.searchsorted(BASES, ref) +
+                     rng.randint(1, 4, size=count)) % 4]
+        calls = np.array([b'0/0', b'0/1', b'1/1'])[
+            rng.choice(3, size=count, p=[0.6, 0.3, 0.1])]
+        text.append(join_fields([
+            vcf_chrom(chrom).encode() + b'\t', positions, b'\trs',
+            np.arange(rsid, rsid + count), b'\t', ref.view('S1'), b'\t',
+            alt.view('S1'), b'\t.\tPASS\t.\tGT\t', calls, b'\n']))
+        rsid += count
+    data = b''.join(text)
+    opener = {'bz2': bz2.open, 'gzip': gzip.open, None: open}[codec]
+    with opener(path, 'wb') as out:
+        out.write(data)
+    return len(data)
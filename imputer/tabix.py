@@ -0,0 +1,174 @@
+"""
+Tabix (.tbi) index of a bgzf vcf, built while the vcf is written.
+
+The index follows the tabix format of the SAM/BAM specification (section
+5.2): per chromosome, the chunks of virtual offsets that hold the records
+of each bin of the UCSC binning scheme, plus a linear index of the first
+record overlapping every 16 kb window. A region query reads the index and
+decompresses only the blocks those chunks point to.
+
+Records are indexed as they pass through TabixWriter, by byte position in
+the uncompressed stream, and the positions become virtual offsets when the
+compressor has written every block. The vcf must be grouped by chromosome
+and sorted by position within each, as the per-chromosome vcfs are.
+"""
+import struct
+
+from imputer.compression import BgzfCompressor
+
+# tabix format header: preset vcf, sequence, begin and end columns (end 0,
+# vcf ends come from REF), meta character and lines to skip
+TBX_VCF = 2
+TABIX_HEADER = struct.Struct('<4s7i')
+# the bin holding the chromosome's extent and record counts
+PSEUDO_BIN = 37450
+# 16 kb windows of the linear index
+LINEAR_SHIFT = 14
+
+
+def reg2bin(beg, end):
+    """The smallest bin holding the 0-based, half open [beg, end)."""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class _Reference:
+    """The bins and linear index of one chromosome, in stream positions."""
+
+    def __init__(self):
+        # bin: [[start, stop], ...]
+        self.bins = {}
+        self.linear = []
+        self.records = 0
+        self.first = None
+        self.last = None
+
+    def add(self, beg, end, start, stop):
+        chunks = self.bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+        last_window = (end - 1) >> LINEAR_SHIFT
+        if last_window >= len(self.linear):
+            self.linear.extend([None] * (last_window + 1 - len(self.linear)))
+        for window in range(beg >> LINEAR_SHIFT, last_window + 1):
+            if self.linear[window] is None:
+                self.linear[window] = start
+        if self.first is None:
+            self.first = start
+        self.last = stop
+        self.records += 1
+
+    def pack(self, virtual_offset):
+        parts = [struct.pack('<i', len(self.bins) + 1)]
+        for bin_id, chunks in sorted(self.bins.items()):
+            parts.append(struct.pack('<Ii', bin_id, len(chunks)))
+            parts.extend(struct.pack('<QQ', virtual_offset(start),
+                                     virtual_offset(stop))
+                         for start, stop in chunks)
+        parts.append(struct.pack('<IiQQQQ', PSEUDO_BIN, 2,
+                                 virtual_offset(self.first),
+                                 virtual_offset(self.last),
+                                 self.records, 0))
+        # windows without records of their own start where the one before
+        # them does; those before the first record at the first record
+        linear = []
+        previous = self.first
+        for start in self.linear:
+            previous = previous if start is None else start
+            linear.append(virtual_offset(previous))
+        parts.append(struct.pack('<i{}Q'.format(len(linear)), len(linear),
+                                 *linear))
+        return b''.join(parts)
+
+
+class TabixIndex:
+    def __init__(self):
+        self.names = []
+        self.references = {}
+        self.current = None
+
+    def add(self, line, start, stop):
+        """Index the vcf record line found at [start, stop) of the stream."""
+        chrom, pos, _, ref = line.split(b'\t', 4)[:4]
+        if chrom != self.current:
+            if chrom in self.references:
+                raise ValueError('vcf records of {} are not together'.format(
+                    chrom.decode()))
+            self.names.append(chrom)
+            self.references[chrom] = _Reference()
+            self.current = chrom
+        beg = int(pos) - 1
+        self.references[chrom].add(beg, beg + max(len(ref), 1), start, stop)
+
+    def pack(self, virtual_offset):
+        """The uncompressed .tbi, virtual_offset mapping stream positions."""
+        names = b''.join(name + b'\0' for name in self.names)
+        parts = [TABIX_HEADER.pack(b'TBI\1', len(self.names), TBX_VCF,
+                                   1, 2, 0, ord('#'), 0),
+                 struct.pack('<i', len(names)), names]
+        parts.extend(self.references[name].pack(virtual_offset)
+                     for name in self.names)
+        # records without coordinates
+        parts.append(struct.pack('<Q', 0))
+        return b''.join(parts)
+
+
+class TabixWriter:
+    """
+    A write-only binary file around a BgzfCompressor: the vcf text written
+    is compressed as is, its records are indexed, and closing writes the
+    index to index_path.
+    """
+
+    def __init__(self, compressor, index_path):
+        self.compressor = compressor
+        self.index_path = index_path
+        self.index = TabixIndex()
+        # an unfinished line, and its position in the stream
+        self.partial = b''
+        self.start = 0
+
+    def write(self, data):
+        self.compressor.write(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        position = self.start
+        for line in lines:
+            stop = position + len(line) + 1
+            if line and not line.startswith(b'#'):
+                self.index.add(line, position, stop)
+            position = stop
+        self.start = position
+        return len(data)
+
+    def close(self):
+        if self.partial and not self.partial.startswith(b'#'):
+            self.index.add(self.partial, self.start,
+                           self.start + len(self.partial))
+            self.partial = b''
+        self.compressor.close()
+        with BgzfCompressor(open(self.index_path, 'wb'),
+                            workers=1) as index_file:
+            index_file.write(self.index.pack(
+                self.compressor.virtual_offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        self.compressor.__exit__(exc_type, exc, tb)
@@ -6,20 +6,48 @@ These tasks:
 """
 import os
 import logging
-import requests
-from celery import chain, group
-from subprocess import run, PIPE
-from ohapi import api
+from contextlib import contextmanager
+from celery import chain, chord, group
 from os import environ
 import pandas as pd
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from open_humans.client import get_client
 from open_humans.models import OpenHumansMember
+from main.tasks import invalidate_member_data
 from datauploader.tasks import process_source
 from openhumansimputer.settings import CHROMOSOMES
-from imputer.models import ImputerMember
-import bz2
-import gzip
-from shutil import copyfileobj
+from imputer.admission import Demand, admit, capacity, demand
+from imputer.batch import (member_info, reconcile_alleles, split_impute2,
+                           split_sample)
+from imputer.models import (ChromosomeProgress, ChromosomeRuntime,
+                            ImputationBatch, ImputerMember, PipelineCheckpoint,
+                            TaskMetric)
+from imputer.merge_join import merge_sorted
+from imputer.panel_cache import PanelCache, panel_budget
+from imputer.result_cache import ResultCache, combined_key, genotype_keys
+from imputer.retention import prune, valid_vcf
+from imputer.runner import CommandFailed, GenipeProgress, log_path, run
+from imputer.compression import open_compressed, suffix
+from imputer.download import DownloadError, download_vcf
+from imputer.formatting import format_annotated_records, rewrite_ids
+from imputer.scheduling import (PANEL_VARIANTS, estimated_costs,
+                                order_by_cost, priorities)
+from imputer.tabix import TabixWriter
+from imputer.segments import (check_command, chrom_segments, empty_segment,
+                              extract_command, final_command, flip_command,
+                              impute_command, merge_command, panel,
+                              phase_command, phased_prefix, prephase_lists,
+                              regions, segment_prefix, strand_issues,
+                              write_list)
+from imputer.vcf import (IMPUTE_COLS, IMPUTE_DTYPES, INFO_DTYPES, VCF_COLS,
+                         Reference, write_annotated_vcf)
+import hashlib
+import json
+from shutil import copyfile, copyfileobj, disk_usage, rmtree
 from itertools import takewhile
 import time
 import datetime
@@ -37,86 +65,379 @@ OUT_DIR = environ.get('OUT_DIR')
 # Set up logging.
 logger = logging.getLogger('oh')
 
+# read size when copying per-chromosome vcfs into the final file
+ASSEMBLY_BUFFER = 1024 * 1024
+# impute2 segment length genipe-launcher is run with
+GENIPE_SEGMENT_LENGTH = 5000000
+# set while an admission check is scheduled
+ADMISSION_TIMER_KEY = 'imputer-admission-timer'
+
+
+def _script(name):
+    """Absolute path of one of the pipeline's shell scripts."""
+    return os.path.join(settings.BASE_DIR, 'imputer', name)
+
+
+def _scratch_dir(*parts):
+    """
+    Create and return a working directory under OUT_DIR. Subprocesses get
+    it as cwd and TMPDIR, so tasks never share the process-wide cwd.
+    """
+    path = os.path.join(OUT_DIR, *[str(part) for part in parts])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _scratch_env(path):
+    return dict(os.environ, TMPDIR=path)
+
+
+def _member_bfile(oh_id, chrom):
+    """
+    The member's plink fileset for one chromosome, written by prepare_data
+    when settings.SPLIT_CHROMS is on, else the genome-wide one.
+    """
+    chrom_bfile = '{}/{}/member.{}.chr{}.plink.gt'.format(
+        DATA_DIR, oh_id, oh_id, chrom)
+    if settings.SPLIT_CHROMS and os.path.exists(chrom_bfile + '.bed'):
+        return chrom_bfile
+    return '{}/{}/member.{}.plink.gt'.format(DATA_DIR, oh_id, oh_id)
+
+
+def panel_cache_budget():
+    """settings.PANEL_CACHE_BUDGET, or the size of the panel when unset."""
+    return settings.PANEL_CACHE_BUDGET or panel_budget(
+        panel('1', 'chr1', REF_PANEL, REF_PANEL_X)['sample'],
+        sum(PANEL_VARIANTS.values()))
+
+
+@contextmanager
+def _panel_cache():
+    """
+    The PanelCache of settings.PANEL_CACHE_DIR (None when it is not set),
+    keeping the entries looked up in it until the block is left.
+    """
+    if not settings.PANEL_CACHE_DIR:
+        yield None
+        return
+    with PanelCache(settings.PANEL_CACHE_DIR, settings.PANEL_VERSION,
+                    panel_cache_budget()) as cache:
+        yield cache
+
+
+def _panel_files(chrom, region, segment=None, cache=None):
+    """
+    Reference panel files for a chromosome region, from cache (see
+    panel_cache) when there is one. segment is (start, end) for the slice
+    impute2 needs on one -int window.
+    """
+    files = panel(chrom, region, REF_PANEL, REF_PANEL_X)
+    if cache is None:
+        return files
+    if segment:
+        return cache.segment(files, *segment)
+    return cache.whole(files)
+
+
+def _stage_outputs(oh_id, stage, chrom=''):
+    """The files a pipeline stage leaves behind for the stages after it."""
+    member = '{}/{}/member.{}'.format(DATA_DIR, oh_id, oh_id)
+    if stage == 'get_vcf':
+        return [member + '.vcf']
+    if stage == 'prepare_data':
+        return [member + '.plink.gt' + ext for ext in ['.bed', '.bim', '.fam']]
+    if stage == 'impute':
+        return [_final_impute2(oh_id, chrom, 'imputed.' + ext)
+                for ext in ['impute2', 'impute2_info', 'sample']]
+    if stage == 'process':
+        outputs = [_final_impute2(oh_id, chrom, 'member.imputed.vcf'),
+                   _final_impute2(oh_id, chrom, 'header.txt')]
+        if chrom == '5':
+            outputs.append('{}/{}/header.txt'.format(OUT_DIR, oh_id))
+        return outputs
+    # stages without local outputs, like deliver
+    return []
+
+
+def _checksum(paths):
+    """
+    md5 over the size and modification time of the files in order, None
+    when one of them is missing. Stages write files of many GB, so they are
+    told apart by their metadata rather than read again.
+    """
+    digest = hashlib.md5()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        digest.update('{}\t{}\t{}\n'.format(
+            path, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _checkpoint(oh_id, stage, chrom=''):
+    """Record a finished stage, if the files it should write are there."""
+    checksum = _checksum(_stage_outputs(oh_id, stage, chrom))
+    if checksum is None:
+        logger.warning('{}: {} chr{} left no outputs, not '
+                       'checkpointed'.format(oh_id, stage, chrom))
+        return
+    member = ImputerMember.objects.get(oh_id=oh_id, active=True)
+    PipelineCheckpoint.record(member, stage, checksum, chrom)
+
+
+def _completed_stages(member):
+    """(stage, chrom) of every checkpoint whose outputs still validate."""
+    return {(checkpoint.stage, checkpoint.chrom)
+            for checkpoint in member.pipelinecheckpoint_set.all()
+            if _checksum(_stage_outputs(member.oh_id, checkpoint.stage,
+                                        checkpoint.chrom)) ==
+            checkpoint.checksum}
+
 
 @app.task(ignore_result=False)
 def submit_chrom(chrom, oh_id, num_submit=0, **kwargs):
     """
     Build and run the genipe-launcher command in subprocess run.
-    rate_limit='1/m' sets the number of tasks per minute.
-    This is important because impute2 writes a file to a shared directory that
-    genipe-launcher tries to delete. If multiple tasks launch at the same time,
-    celery task silently fails.
+    impute2 writes files into its working directory that genipe-launcher
+    later deletes, so every chromosome runs with its own scratch directory
+    as cwd and TMPDIR. Nothing here changes the worker's cwd, so all
+    chromosomes of a member can start at once, also from threads of one
+    worker process.
     """
-    # this silly block of code runs impute2 because genipe-launcher deletes
-    # two unneccesary files before they are available.
     imputer_record = ImputerMember.objects.get(oh_id=oh_id, active=True)
     imputer_record.step = 'submit_chrom'
     imputer_record.save()
 
-    os.makedirs('{}/{}/chr{}'.format(OUT_DIR,
-                                     oh_id, chrom), exist_ok=True)
-    os.chdir('{}/{}/chr{}'.format(OUT_DIR, oh_id, chrom))
+    work_dir = _scratch_dir(oh_id, 'chr{}'.format(chrom))
+    started = time.monotonic()
+    with _panel_cache() as cache:
+        command = _genipe_command(chrom, _member_bfile(oh_id, chrom),
+                                  work_dir, cache=cache)
+        run(command, log_path(oh_id, 'chr{}'.format(chrom)),
+            progress=_genipe_progress(chrom, [oh_id]), cwd=work_dir,
+            env=_scratch_env(work_dir))
+    ChromosomeRuntime.record(chrom, time.monotonic() - started)
+    ChromosomeProgress.record(oh_id, chrom, 'imputed')
+    _checkpoint(oh_id, 'impute', chrom)
+
+
+def _genipe_progress(chrom, oh_ids):
+    """Follow a genipe-launcher run into the members' progress records."""
+    total = len(chrom_segments(chrom, GENIPE_SEGMENT_LENGTH))
+    for oh_id in oh_ids:
+        ChromosomeProgress.record(oh_id, chrom, 'starting', 0, total)
+
+    def update(stage, done, total):
+        for oh_id in oh_ids:
+            ChromosomeProgress.record(oh_id, chrom, stage, done, total)
+    return GenipeProgress(total, update)
+
+
+def _genipe_command(chrom, bfile, output_dir, nind=1, cache=None):
+    """
+    genipe-launcher for one chromosome of bfile, imputing nind samples,
+    with the panel files of cache.
+    """
     if chrom == '23':
+        par1 = _panel_files(chrom, 'PAR1', cache=cache)
+        par2 = _panel_files(chrom, 'PAR2', cache=cache)
+        files = _panel_files(chrom, 'nonPAR', cache=cache)
         command = [
             'genipe-launcher',
             '--chrom', '{}'.format(chrom),
-            '--bfile', '{}/{}/member.{}.plink.gt'.format(
-                DATA_DIR, oh_id, oh_id),
+            '--bfile', bfile,
             '--shapeit-bin', '{}/shapeit'.format(IMP_BIN),
             '--impute2-bin', '{}/impute2'.format(IMP_BIN),
             '--plink-bin', '{}/plink'.format(IMP_BIN),
             '--reference', '{}/hg19.fasta'.format(REF_FA),
-            '--hap-nonPAR', '{}/1000GP_Phase3_chrX_NONPAR.hap.gz'.format(REF_PANEL_X),
-            '--hap-PAR1', '{}/1000GP_Phase3_chrX_PAR1.hap.gz'.format(REF_PANEL_X),
-            '--hap-PAR2', '{}/1000GP_Phase3_chrX_PAR2.hap.gz'.format(REF_PANEL_X),
-            '--legend-nonPAR', '{}/1000GP_Phase3_chrX_NONPAR.legend.gz'.format(REF_PANEL_X),
-            '--legend-PAR1', '{}/1000GP_Phase3_chrX_PAR1.legend.gz'.format(REF_PANEL_X),
-            '--legend-PAR2', '{}/1000GP_Phase3_chrX_PAR2.legend.gz'.format(REF_PANEL_X),
-            '--map-nonPAR', '{}/genetic_map_chrX_nonPAR_combined_b37.txt'.format(REF_PANEL_X),
-            '--map-PAR1', '{}/genetic_map_chrX_PAR1_combined_b37.txt'.format(REF_PANEL_X),
-            '--map-PAR2', '{}/genetic_map_chrX_PAR2_combined_b37.txt'.format(REF_PANEL_X),
-            '--sample-file', '{}/1000GP_Phase3.sample'.format(REF_PANEL),
-            '--map-template', '{}/genetic_map_chrX_nonPAR_combined_b37.txt'.format(REF_PANEL_X),
-            '--legend-template', '{}/1000GP_Phase3_chrX_NONPAR.legend.gz'.format(REF_PANEL_X),
-            '--hap-template', '{}/1000GP_Phase3_chrX_NONPAR.hap.gz'.format(REF_PANEL_X),
+            '--hap-nonPAR', files['hap'],
+            '--hap-PAR1', par1['hap'],
+            '--hap-PAR2', par2['hap'],
+            '--legend-nonPAR', files['legend'],
+            '--legend-PAR1', par1['legend'],
+            '--legend-PAR2', par2['legend'],
+            '--map-nonPAR', files['map'],
+            '--map-PAR1', par1['map'],
+            '--map-PAR2', par2['map'],
+            '--sample-file', files['sample'],
+            '--map-template', files['map'],
+            '--legend-template', files['legend'],
+            '--hap-template', files['hap'],
             '--filtering-rules', 'ALL<0.01', 'ALL>0.99',
-            '--segment-length', '5e+06',
-            '--impute2-extra', '-nind 1',
+            '--segment-length', '{:g}'.format(GENIPE_SEGMENT_LENGTH),
+            '--impute2-extra', '-nind {}'.format(nind),
             '--report-title', '"Test"',
             '--report-number', '"Test Report"',
-            '--output-dir', '{}/{}/chr{}'.format(OUT_DIR,
-                                                 oh_id, chrom),
-            '--shapeit-extra', '-R {}/1000GP_Phase3_chrX_NONPAR.hap.gz {}/1000GP_Phase3_chrX_NONPAR.legend.gz {}/1000GP_Phase3.sample --exclude-snp {}/{}/chr{}/chr{}/chr{}.alignments.snp.strand.exclude'.format(
-                REF_PANEL_X, REF_PANEL_X, REF_PANEL, OUT_DIR, oh_id, chrom, chrom, chrom)
+            '--output-dir', output_dir,
+            '--shapeit-extra', '-R {} {} {} --exclude-snp {}/chr{}/chr{}.alignments.snp.strand.exclude'.format(
+                files['hap'], files['legend'], files['sample'], output_dir, chrom, chrom)
         ]
     else:
+        files = _panel_files(chrom, 'chr{}'.format(chrom), cache=cache)
         command = [
             'genipe-launcher',
             '--chrom', '{}'.format(chrom),
-            '--bfile', '{}/{}/member.{}.plink.gt'.format(
-                DATA_DIR, oh_id, oh_id),
+            '--bfile', bfile,
             '--shapeit-bin', '{}/shapeit'.format(IMP_BIN),
             '--impute2-bin', '{}/impute2'.format(IMP_BIN),
             '--plink-bin', '{}/plink'.format(IMP_BIN),
             '--reference', '{}/hg19.fasta'.format(REF_FA),
-            '--hap-template', '{}/1000GP_Phase3_chr{}.hap.gz'.format(
-                REF_PANEL, chrom),
-            '--legend-template', '{}/1000GP_Phase3_chr{}.legend.gz'.format(
-                REF_PANEL, chrom),
-            '--map-template', '{}/genetic_map_chr{}_combined_b37.txt'.format(
-                REF_PANEL, chrom),
-            '--sample-file', '{}/1000GP_Phase3.sample'.format(REF_PANEL),
+            '--hap-template', files['hap'],
+            '--legend-template', files['legend'],
+            '--map-template', files['map'],
+            '--sample-file', files['sample'],
             '--filtering-rules', 'ALL<0.01', 'ALL>0.99',
-            '--segment-length', '5e+06',
-            '--impute2-extra', '-nind 1',
+            '--segment-length', '{:g}'.format(GENIPE_SEGMENT_LENGTH),
+            '--impute2-extra', '-nind {}'.format(nind),
             '--report-title', '"Test"',
             '--report-number', '"Test Report"',
-            '--output-dir', '{}/{}/chr{}'.format(OUT_DIR,
-                                                 oh_id, chrom),
-            '--shapeit-extra', '-R {}/1000GP_Phase3_chr{}.hap.gz {}/1000GP_Phase3_chr{}.legend.gz {}/1000GP_Phase3.sample --exclude-snp {}/{}/chr{}/chr{}/chr{}.alignments.snp.strand.exclude'.format(
-                REF_PANEL, chrom, REF_PANEL, chrom, REF_PANEL, OUT_DIR, oh_id, chrom, chrom, chrom)
+            '--output-dir', output_dir,
+            '--shapeit-extra', '-R {} {} {} --exclude-snp {}/chr{}/chr{}.alignments.snp.strand.exclude'.format(
+                files['hap'], files['legend'], files['sample'], output_dir, chrom, chrom)
         ]
-    run(command, stdout=PIPE, stderr=PIPE)
+    return command
+
+
+def _segment_dir(oh_id, chrom):
+    """genipe-launcher's per-chromosome output directory."""
+    return _scratch_dir(oh_id, 'chr{}'.format(chrom), 'chr{}'.format(chrom))
+
+
+def _phase_step(command, log, work_dir, check=True):
+    run(command, log, check=check, cwd=work_dir, env=_scratch_env(work_dir))
+
+
+@app.task(ignore_result=False)
+def phase_chrom(chrom, oh_id):
+    """
+    Phase the member's chromosome with shapeit, once per region (chrX has
+    PAR1, nonPAR and PAR2), for the impute_segment tasks to share.
+    """
+    imputer_record = ImputerMember.objects.get(oh_id=oh_id, active=True)
+    imputer_record.step = 'submit_chrom'
+    imputer_record.save()
+
+    work_dir = _segment_dir(oh_id, chrom)
+    for directory in ['phased', 'segments', 'final_impute2']:
+        os.makedirs(os.path.join(work_dir, directory), exist_ok=True)
+    # merge_chrom, maybe on another host, times the chromosome from here
+    with open(_phase_started_fp(work_dir), 'w') as started:
+        started.write(str(time.time()))
+    ChromosomeProgress.record(
+        oh_id, chrom, 'phasing', 0,
+        len(chrom_segments(chrom, settings.SEGMENT_LENGTH)))
+    reference = Reference('{}/hg19.fasta'.format(REF_FA))
+    bfile = _member_bfile(oh_id, chrom)
+    log = log_path(oh_id, 'chr{}'.format(chrom))
+    for region, _, _, _ in regions(chrom):
+        with _panel_cache() as cache:
+            _phase_region(chrom, region, bfile, _panel_files(
+                chrom, region, cache=cache), reference, work_dir, log)
+        if not os.path.exists(phased_prefix(work_dir, region) + '.haps'):
+            logger.info('{}: no phased chr{} {} markers'.format(
+                oh_id, chrom, region))
+    ChromosomeProgress.record(oh_id, chrom, 'imputing')
+
+
+def _phase_started_fp(work_dir):
+    return os.path.join(work_dir, 'phase.started')
+
+
+def _phase_region(chrom, region, bfile, files, reference, work_dir, log):
+    """genipe's marker checks and shapeit phasing of one region."""
+    prefix = phased_prefix(work_dir, region)
+    # genipe's steps: leave out ambiguous and duplicated markers, flip
+    # those on the reverse strand of hg19, then flip what shapeit -check
+    # still finds reversed and exclude what stays mismatched
+    lists = prephase_lists(bfile + '.bim', chrom, region, reference)
+    for name, names in lists.items():
+        write_list('{}.{}'.format(prefix, name), names)
+    _phase_step(extract_command(
+        bfile, prefix, IMP_BIN, flip=bool(lists['flip']),
+        update_chr=bool(lists['update_chr'])), log, work_dir)
+    # shapeit -check exits non-zero when it finds strand problems, the
+    # lists it writes are what the next step needs
+    _phase_step(check_command(region, prefix + '.input',
+                              prefix + '.alignments', files, IMP_BIN),
+                log, work_dir, check=False)
+    write_list(prefix + '.to_flip',
+               strand_issues(prefix + '.alignments.snp.strand'))
+    _phase_step(flip_command(prefix, IMP_BIN), log, work_dir)
+    _phase_step(check_command(
+        region, prefix + '.flipped', prefix + '.to_exclude.alignments',
+        files, IMP_BIN), log, work_dir, check=False)
+    write_list(prefix + '.to_exclude', strand_issues(
+        prefix + '.to_exclude.alignments.snp.strand'))
+    _phase_step(final_command(prefix, IMP_BIN, region), log, work_dir)
+    _phase_step(phase_command(region, files, work_dir, IMP_BIN,
+                              threads=settings.PHASE_THREADS),
+                log, work_dir)
+
+
+@app.task(ignore_result=False)
+def impute_segment(chrom, oh_id, region, start, end):
+    """Run impute2 on one segment of a phased chromosome."""
+    work_dir = _segment_dir(oh_id, chrom)
+    if not os.path.exists(phased_prefix(work_dir, region) + '.haps'):
+        return
+    scratch = _scratch_dir(oh_id, 'chr{}'.format(chrom),
+                           'segment.{}.{}'.format(region, start))
+    with _panel_cache() as cache:
+        files = _panel_files(chrom, region, (start, end), cache=cache)
+        command = impute_command(region, start, end, files, work_dir,
+                                 IMP_BIN, extra=['-nind', '1'])
+        # the segments of a chromosome run at once, each writes its own log
+        log = log_path(oh_id, 'chr{}.segment.{}.{}'.format(chrom, region,
+                                                            start))
+        process = run(command, log, check=False, cwd=scratch,
+                      env=_scratch_env(scratch))
+    if process.returncode != 0 and not empty_segment(
+            segment_prefix(work_dir, region, start, end)):
+        logger.error('{}: impute2 failed on chr{} {}:{}-{}'.format(
+            oh_id, chrom, region, start, end))
+        raise CommandFailed(command, process.returncode, log,
+                            process.stderr.decode('utf-8'))
+    ChromosomeProgress.segment_done(oh_id, chrom)
+
+
+@app.task(ignore_result=False)
+def merge_chrom(chrom, oh_id):
+    """
+    Merge the segments with impute2-merger into the final_impute2 files
+    process_chrom reads. The chromosome's time from phasing to here goes
+    to its ChromosomeRuntime.
+    """
+    work_dir = _segment_dir(oh_id, chrom)
+    segment_files = [
+        segment_prefix(work_dir, region, start, end)
+        for region, start, end in chrom_segments(
+            chrom, settings.SEGMENT_LENGTH)]
+    segment_files = [fp for fp in segment_files if os.path.exists(fp)]
+    command = merge_command(chrom, segment_files, work_dir)
+    ChromosomeProgress.record(oh_id, chrom, 'merging')
+    run(command, log_path(oh_id, 'chr{}'.format(chrom)), cwd=work_dir,
+        env=_scratch_env(work_dir))
+    # every region's .sample lists the same member
+    region = 'nonPAR' if chrom == '23' else regions(chrom)[0][0]
+    copyfile(phased_prefix(work_dir, region) + '.sample',
+             _final_impute2(oh_id, chrom, 'imputed.sample'))
+    with open(_phase_started_fp(work_dir)) as started:
+        ChromosomeRuntime.record(chrom, time.time() - float(started.read()))
+    ChromosomeProgress.record(oh_id, chrom, 'imputed')
+    _checkpoint(oh_id, 'impute', chrom)
+
+
+def _fanout_chrom(chrom, oh_id, **options):
+    """Phase, then all segments in parallel, then the merge."""
+    return chain(
+        phase_chrom.si(chrom, oh_id).set(**options),
+        chord([impute_segment.si(chrom, oh_id, region, start, end).set(
+                   **options)
+               for region, start, end in chrom_segments(
+                   chrom, settings.SEGMENT_LENGTH)],
+              merge_chrom.si(chrom, oh_id).set(**options)))
 
 
 @app.task()
@@ -127,42 +448,45 @@ def get_vcf(data_source_id, oh_id):
     imputer_record.step = 'get_vcf'
     imputer_record.save()
     logger.info('Downloading vcf for member {}'.format(oh_id))
-    user_details = api.exchange_oauth2_member(oh_member.get_access_token())
+    client = get_client()
+    user_details = client.exchange_member(oh_member.get_access_token())
     for data_source in user_details['data']:
         if str(data_source['id']) == str(data_source_id):
             data_file_url = data_source['download_url']
-    datafile = requests.get(data_file_url)
     os.makedirs('{}/{}'.format(DATA_DIR, oh_id), exist_ok=True)
-    with open('{}/{}/member.{}.vcf'.format(DATA_DIR, oh_id, oh_id), 'wb') as handle:
-        try:
-            textobj = bz2.decompress(datafile.content)
-            handle.write(textobj)
-        except OSError:
-            textobj = gzip.decompress(datafile.content)
-            handle.write(textobj)
-        except OSError:
-            for block in datafile.iter_content(1024):
-                handle.write(block)
-        except:
-            logger.critical('your data source file is malformated')
-    time.sleep(5)  # download takes a few seconds
+    try:
+        kind = download_vcf(
+            data_file_url,
+            '{}/{}/member.{}.vcf'.format(DATA_DIR, oh_id, oh_id),
+            session=client.session, timeout=client.timeout)
+    except DownloadError:
+        logger.critical('your data source file is malformated')
+        raise
+    logger.info('{}: downloaded {} vcf'.format(oh_id, kind))
+    _checkpoint(oh_id, 'get_vcf')
 
 
-@app.task
+@app.task(ignore_result=False)
 def prepare_data(oh_id):
     """Process the member's .vcf."""
     imputer_record = ImputerMember.objects.get(oh_id=oh_id, active=True)
     imputer_record.step = 'prepare_data'
     imputer_record.save()
-    os.chdir(settings.BASE_DIR)
+    work_dir = _scratch_dir(oh_id)
 
     command = [
-        'imputer/prepare_genotypes.sh', '{}'.format(oh_id)
+        _script('prepare_genotypes.sh'), '{}'.format(oh_id)
     ]
-    process = run(command, stdout=PIPE, stderr=PIPE)
-    if process.stderr:
-        logger.debug(process.stderr)
+    run(command, log_path(oh_id, 'prepare'), cwd=work_dir,
+        env=_scratch_env(work_dir))
+
+    if settings.SPLIT_CHROMS:
+        split_command = [_script('split_chroms.sh'),
+                         '{}'.format(oh_id)] + CHROMOSOMES
+        run(split_command, log_path(oh_id, 'prepare'), cwd=work_dir,
+            env=_scratch_env(work_dir))
     logger.info('finished preparing {} plink data'.format(oh_id))
+    _checkpoint(oh_id, 'prepare_data')
 
 
 def _rreplace(s, old, new, occurrence):
@@ -170,49 +494,91 @@ def _rreplace(s, old, new, occurrence):
     return new.join(li)
 
 
-@app.task(ignore_result=False)
-def process_chrom(chrom, oh_id, num_submit=0, **kwargs):
+def _final_impute2(oh_id, chrom, suffix):
+    return '{}/{}/chr{}/chr{}/final_impute2/chr{}.{}'.format(
+        OUT_DIR, oh_id, chrom, chrom, chrom, suffix)
+
+
+def _output_vcf(oh_id, chrom):
+    """Convert the filtered .impute2 to vcf with plink2."""
+    work_dir = _scratch_dir(oh_id, 'chr{}'.format(chrom))
+    output_vcf_cmd = [
+        _script('output_vcf.sh'), '{}'.format(oh_id), '{}'.format(chrom)
+    ]
+    run(output_vcf_cmd, log_path(oh_id, 'chr{}'.format(chrom)), cwd=work_dir,
+        env=_scratch_env(work_dir))
+
+
+def _capture_header(vcf_file, oh_id, chrom):
     """
-    1. read .impute2 files (w/ genotype probabilities)
-    2. read .impute2_info files (with "info" field for filtering)
-    3. filter the genotypes in .impute2_info
-    4. merge on right (.impute2_info), acts like a filter for the left.
+    Keep the plink2 style header of a chromosome's vcf, which is dropped when
+    the annotated records are written. chr5's copy is used for the member's
+    combined file.
     """
-    print('{} Imputation has completed, now processing results.'.format(oh_id))
-    impute_cols = ['chr', 'name', 'position',
-                   'a0', 'a1', 'a0a0_p', 'a0a1_p', 'a1a1_p']
+    with open(vcf_file, 'r') as vcf:
+        headiter = takewhile(lambda s: s.startswith('#'), vcf)
+        header = list(headiter)
+    header_fps = [_final_impute2(oh_id, chrom, 'header.txt')]
+    if chrom == '5':
+        header_fps.append('{}/{}/header.txt'.format(OUT_DIR, oh_id))
+    for header_fp in header_fps:
+        with open(header_fp, 'w') as headerobj:
+            headerobj.write(''.join(header))
+
+
+def _annotate(dfvcf):
+    """Add genotype probabilities and the info metric to merged vcf rows."""
+    # currently using custom annotation for "dosage"
+    dfvcf['MEMBER'] = dfvcf['MEMBER'] + ':' + dfvcf['a0a0_p'].round(3).astype(
+        str) + ',' + dfvcf['a0a1_p'].round(3).astype(str) + ',' + dfvcf['a1a1_p'].round(3).astype(str)
+    dfvcf['FORMAT'] = dfvcf['FORMAT'].astype(str) + ':GP'
+    dfvcf['INFO'] = dfvcf['INFO'].astype(
+        str) + ';INFO=' + dfvcf['info'].round(3).astype(str)
+    dfvcf.reset_index(inplace=True)
+    return dfvcf[VCF_COLS]
+
+
+def _write_annotated(dfvcf, out):
+    if settings.VECTORIZED_ANNOTATION:
+        out.write(format_annotated_records(dfvcf))
+    else:
+        _annotate(dfvcf).to_csv(out, sep='\t', header=None, index=False)
+
+
+def _rewrite_ids(names):
+    if settings.VECTORIZED_ANNOTATION:
+        return rewrite_ids(names)
+    return names.apply(_rreplace, args=(':', '_', 2))
+
 
+def _process_chrom_in_memory(chrom, oh_id):
     df = pd.DataFrame()
     df_gp = pd.DataFrame()  # hold genotype probabilities
-    df_impute = pd.read_csv('{}/{}/chr{}/chr{}/final_impute2/'
-                            'chr{}.imputed.impute2'
-                            .format(OUT_DIR, oh_id, chrom, chrom, chrom),
+    df_impute = pd.read_csv(_final_impute2(oh_id, chrom, 'imputed.impute2'),
                             sep=' ',
                             header=None,
-                            names=impute_cols)
+                            names=IMPUTE_COLS)
 
-    df_info = pd.read_csv(
-        '{}/{}/chr{}/chr{}/final_impute2/chr{}.imputed.impute2_info'.format(
-            OUT_DIR, oh_id, chrom, chrom, chrom),
-        sep='\t')
+    df_info = pd.read_csv(_final_impute2(oh_id, chrom, 'imputed.impute2_info'),
+                          sep='\t')
 
     # combine impute2 and impute2_info to induce filter
     df = df_impute.merge(
         df_info, on=['chr', 'position', 'a0', 'a1'], how='right')
     df.rename(columns={'name_x': 'name'}, inplace=True)
     df_gp = pd.concat([df_gp, df])
-    df = df[impute_cols]
+    df = df[IMPUTE_COLS]
 
-    df_gp['name'] = df_gp['name'].apply(_rreplace, args=(':', '_', 2))
-    df['name'] = df['name'].apply(_rreplace, args=(':', '_', 2))
+    df_gp['name'] = _rewrite_ids(df_gp['name'])
+    df['name'] = df_gp['name']
 
-    df_gp.to_csv('{}/{}/chr{}/chr{}/final_impute2/chr{}.imputed.impute2.GP'.format(OUT_DIR, oh_id, chrom, chrom, chrom),
+    df_gp.to_csv(_final_impute2(oh_id, chrom, 'imputed.impute2.GP'),
                  header=True,
                  index=False,
                  sep=' ')
 
     # dump all chromosomes as an .impute2
-    df.to_csv('{}/{}/chr{}/chr{}/final_impute2/chr{}.imputed.impute2'.format(OUT_DIR, oh_id, chrom, chrom, chrom),
+    df.to_csv(_final_impute2(oh_id, chrom, 'imputed.impute2'),
               header=False,
               index=False,
               sep=' ')
@@ -220,30 +586,16 @@ def process_chrom(chrom, oh_id, num_submit=0, **kwargs):
     del df
 
     # convert to vcf
-    os.chdir(settings.BASE_DIR)
-    output_vcf_cmd = [
-        'imputer/output_vcf.sh', '{}'.format(oh_id), '{}'.format(chrom)
-    ]
-    process = run(output_vcf_cmd, stdout=PIPE, stderr=PIPE)
-    if process.stderr:
-        logger.debug(process.stderr)
+    _output_vcf(oh_id, chrom)
 
     # annotate genotype probabilities and info metric
-    vcf_file = '{}/{}/chr{}/chr{}/final_impute2/chr{}.member.imputed.vcf'.format(
-        OUT_DIR, oh_id, chrom, chrom, chrom)
-    cols = ['CHROM', 'POS', 'ID', 'REF', 'ALT',
-            'QUAL', 'FILTER', 'INFO', 'FORMAT', 'MEMBER']
+    vcf_file = _final_impute2(oh_id, chrom, 'member.imputed.vcf')
 
     # capture header
-    if chrom == '5':
-        with open(vcf_file, 'r') as vcf:
-            headiter = takewhile(lambda s: s.startswith('#'), vcf)
-            header = list(headiter)
-            with open('{}/{}/header.txt'.format(OUT_DIR, oh_id), 'w') as headerobj:
-                headerobj.write(''.join(header))
+    _capture_header(vcf_file, oh_id, chrom)
 
     dfvcf = pd.read_csv(vcf_file, sep='\t', header=None,
-                        comment='#', names=cols)
+                        comment='#', names=VCF_COLS)
 
     df_gp.rename(columns={'name': 'ID'}, inplace=True)
     df_gp.set_index(['ID'], inplace=True)
@@ -251,23 +603,190 @@ def process_chrom(chrom, oh_id, num_submit=0, **kwargs):
     dfvcf = dfvcf.merge(
         df_gp[['a0a0_p', 'a0a1_p', 'a1a1_p', 'info']], left_index=True, right_index=True)
     del df_gp
-    # currently using custom annotation for "dosage"
-    dfvcf['MEMBER'] = dfvcf['MEMBER'] + ':' + dfvcf['a0a0_p'].round(3).astype(
-        str) + ',' + dfvcf['a0a1_p'].round(3).astype(str) + ',' + dfvcf['a1a1_p'].round(3).astype(str)
-    dfvcf['FORMAT'] = dfvcf['FORMAT'].astype(str) + ':GP'
-    dfvcf['INFO'] = dfvcf['INFO'].astype(
-        str) + ';INFO=' + dfvcf['info'].round(3).astype(str)
-    dfvcf.reset_index(inplace=True)
 
-    dfvcf[cols].to_csv(vcf_file, sep='\t',
-                       header=None, index=False)
+    with open(vcf_file, 'w') as vcf_out:
+        _write_annotated(dfvcf, vcf_out)
+
+
+def _process_chrom_streaming(chrom, oh_id, chunksize):
+    """
+    Same steps and output as _process_chrom_in_memory, but every join is a
+    single pass over position-sorted files, chunksize rows at a time.
+    Rewritten files go to a .tmp sibling and are moved into place at the end,
+    since the .impute2 and the vcf are read and replaced by the same step.
+    """
+    impute_fp = _final_impute2(oh_id, chrom, 'imputed.impute2')
+    gp_fp = _final_impute2(oh_id, chrom, 'imputed.impute2.GP')
+    df_impute = pd.read_csv(impute_fp, sep=' ', header=None,
+                            names=IMPUTE_COLS, dtype=IMPUTE_DTYPES,
+                            chunksize=chunksize)
+    df_info = pd.read_csv(_final_impute2(oh_id, chrom, 'imputed.impute2_info'),
+                          sep='\t', dtype=INFO_DTYPES, chunksize=chunksize)
+
+    header = True
+    with open(gp_fp, 'w') as gp_out, open(impute_fp + '.tmp', 'w') as impute_out:
+        for df in merge_sorted(df_impute, df_info, 'position', 'position',
+                               on=['chr', 'position', 'a0', 'a1'],
+                               how='right'):
+            df.rename(columns={'name_x': 'name'}, inplace=True)
+            df['name'] = _rewrite_ids(df['name'])
+            df.to_csv(gp_out, header=header, index=False, sep=' ')
+            df[IMPUTE_COLS].to_csv(impute_out, header=False, index=False,
+                                   sep=' ')
+            header = False
+    os.replace(impute_fp + '.tmp', impute_fp)
+
+    # convert to vcf
+    _output_vcf(oh_id, chrom)
+
+    # annotate genotype probabilities and info metric
+    vcf_file = _final_impute2(oh_id, chrom, 'member.imputed.vcf')
+    _capture_header(vcf_file, oh_id, chrom)
+
+    dfvcf = pd.read_csv(vcf_file, sep='\t', header=None, comment='#',
+                        names=VCF_COLS, chunksize=chunksize)
+    df_gp = pd.read_csv(gp_fp, sep=' ', dtype={'name': str},
+                        usecols=['name', 'position', 'a0a0_p', 'a0a1_p',
+                                 'a1a1_p', 'info'],
+                        chunksize=chunksize)
+    dfvcf = (chunk.set_index(['ID']) for chunk in dfvcf)
+    df_gp = (chunk.rename(columns={'name': 'ID'}).set_index(['ID'])
+             for chunk in df_gp)
+    with open(vcf_file + '.tmp', 'w') as vcf_out:
+        for df in merge_sorted(dfvcf, df_gp, 'POS', 'position',
+                               left_index=True, right_index=True):
+            _write_annotated(df, vcf_out)
+    os.replace(vcf_file + '.tmp', vcf_file)
+
+
+def _process_chrom_native(chrom, oh_id):
+    """Write the annotated vcf in one pass, without plink2."""
+    vcf_file = _final_impute2(oh_id, chrom, 'member.imputed.vcf')
+    write_annotated_vcf(_final_impute2(oh_id, chrom, 'imputed.impute2'),
+                        _final_impute2(oh_id, chrom, 'imputed.impute2_info'),
+                        _final_impute2(oh_id, chrom, 'imputed.sample'),
+                        vcf_file, chrom,
+                        Reference('{}/hg19.fasta'.format(REF_FA)),
+                        settings.PROCESS_CHUNK_SIZE)
+    _capture_header(vcf_file, oh_id, chrom)
 
 
 @app.task(ignore_result=False)
-def upload_to_oh(oh_id):
-    logger.info('{}: now uploading to OpenHumans'.format(oh_id))
+def process_chrom(chrom, oh_id, num_submit=0, **kwargs):
+    """
+    1. read .impute2 files (w/ genotype probabilities)
+    2. read .impute2_info files (with "info" field for filtering)
+    3. filter the genotypes in .impute2_info
+    4. merge on right (.impute2_info), acts like a filter for the left.
+    With settings.PROCESS_STREAMING the merges run chunk by chunk over the
+    sorted files, so memory no longer grows with chromosome size.
+    With settings.NATIVE_VCF_WRITER the final vcf is written directly from
+    the impute2/info pair, skipping the plink2 round trip.
+    """
+    print('{} Imputation has completed, now processing results.'.format(oh_id))
+    ChromosomeProgress.record(oh_id, chrom, 'processing')
+    if settings.NATIVE_VCF_WRITER:
+        _process_chrom_native(chrom, oh_id)
+    elif settings.PROCESS_STREAMING:
+        _process_chrom_streaming(chrom, oh_id, settings.PROCESS_CHUNK_SIZE)
+    else:
+        _process_chrom_in_memory(chrom, oh_id)
+    _checkpoint(oh_id, 'process', chrom)
+    _store_result(oh_id, chrom)
+    _prune_chrom(oh_id, chrom)
+    ChromosomeProgress.record(oh_id, chrom, 'processed')
 
-    with open('{}/{}/header.txt'.format(OUT_DIR, oh_id), 'r') as headerobj:
+
+def _prune_chrom(oh_id, chrom):
+    """
+    Drop a processed chromosome's intermediates, keeping what
+    settings.SCRATCH_RETENTION asks for, once its vcf checks out.
+    """
+    if settings.SCRATCH_RETENTION == 'all':
+        return
+    vcf_file = _final_impute2(oh_id, chrom, 'member.imputed.vcf')
+    if not valid_vcf(vcf_file):
+        logger.warning('{}: chr{} vcf is incomplete, keeping its '
+                       'intermediates'.format(oh_id, chrom))
+        return
+    keep = _stage_outputs(oh_id, 'process', chrom)
+    if settings.SCRATCH_RETENTION == 'impute2':
+        keep += _stage_outputs(oh_id, 'impute', chrom)
+    freed = prune(os.path.join(OUT_DIR, str(oh_id), 'chr{}'.format(chrom)),
+                  keep)
+    logger.info('{}: removed {:.1f} MB of chr{} intermediates'.format(
+        oh_id, freed / 1024 ** 2, chrom))
+
+
+def _result_cache():
+    if not settings.RESULT_CACHE_DIR:
+        return None
+    return ResultCache(settings.RESULT_CACHE_DIR,
+                       settings.RESULT_CACHE_BUDGET)
+
+
+def _result_salt():
+    """Everything besides the genotypes that changes the imputed output."""
+    return '|'.join([
+        settings.PANEL_VERSION, settings.IMPUTATION_VERSION,
+        'segments-{}'.format(settings.SEGMENT_LENGTH)
+        if settings.SEGMENT_FANOUT else 'genipe',
+        'native' if settings.NATIVE_VCF_WRITER else 'plink2'])
+
+
+def _result_keys_fp(oh_id):
+    return '{}/{}/result_keys.json'.format(OUT_DIR, oh_id)
+
+
+def _result_files(oh_id, chrom):
+    """A chromosome's cached files and where process_chrom leaves them."""
+    return {'member.imputed.vcf': _final_impute2(oh_id, chrom,
+                                                 'member.imputed.vcf'),
+            'header.txt': _final_impute2(oh_id, chrom, 'header.txt')}
+
+
+def _store_result(oh_id, chrom):
+    cache = _result_cache()
+    if cache is None or not os.path.exists(_result_keys_fp(oh_id)):
+        return
+    with open(_result_keys_fp(oh_id)) as keys_file:
+        keys = json.load(keys_file)
+    cache.put(keys[chrom], _result_files(oh_id, chrom))
+
+
+@app.task(ignore_result=False)
+def plan_imputation(oh_id):
+    """
+    With settings.RESULT_CACHE_DIR: restore every chromosome whose
+    genotypes were imputed before from the result cache, then start the
+    pipeline for the rest.
+    """
+    keys = genotype_keys('{}/{}/member.{}.plink.gt'.format(
+        DATA_DIR, oh_id, oh_id), CHROMOSOMES, _result_salt())
+    with open(_result_keys_fp(oh_id), 'w') as keys_file:
+        json.dump(keys, keys_file)
+    cache = _result_cache()
+    missing = []
+    for chrom in CHROMOSOMES:
+        _scratch_dir(oh_id, 'chr{}'.format(chrom), 'chr{}'.format(chrom),
+                     'final_impute2')
+        if not cache.get(keys[chrom], _result_files(oh_id, chrom)):
+            missing.append(chrom)
+            continue
+        if chrom == '5':
+            copyfile(_final_impute2(oh_id, chrom, 'header.txt'),
+                     '{}/{}/header.txt'.format(OUT_DIR, oh_id))
+        _checkpoint(oh_id, 'process', chrom)
+    logger.info('{}: {} of {} chromosomes from the result cache'.format(
+        oh_id, len(CHROMOSOMES) - len(missing), len(CHROMOSOMES)))
+    deliver = CHROMOSOMES if settings.PROGRESSIVE_DELIVERY else []
+    chain(*_imputation_tasks(oh_id, missing, missing, deliver)).on_error(
+        release_reservation.si(oh_id)).apply_async()
+
+
+def _member_header(header_fp):
+    """Build the final vcf header from the header captured in process_chrom."""
+    with open(header_fp, 'r') as headerobj:
         headiter = takewhile(lambda s: s.startswith('#'), headerobj)
         header = list(headiter)
 
@@ -280,65 +799,602 @@ def upload_to_oh(oh_id):
     header.insert(-2, new_header[0])
     header.insert(-4, new_header[1])
     header.insert(1, new_header[2])
-    header = ''.join(header)
+    return ''.join(header)
 
-    # combine all vcfs
-    os.chdir(settings.BASE_DIR)
-    combine_command = [
-        'imputer/combine_chrom.sh', '{}'.format(oh_id)
-    ]
-    process = run(combine_command, stdout=PIPE, stderr=PIPE)
-    logger.debug(process.stderr)
 
-    member_vcf_fp = '{}/{}/member.imputed.vcf'.format(OUT_DIR, oh_id)
-    # add the header to the combined vcf file.
-    with open(member_vcf_fp, 'r') as original:
-        data = original.read()
-    with open(member_vcf_fp, 'w') as modified:
-        modified.write(header + data)
+def _copy_vcf_body(vcf_fp, output):
+    """Copy a vcf into output without its header lines."""
+    with open(vcf_fp, 'rb') as body:
+        line = body.readline()
+        while line.startswith(b'#'):
+            line = body.readline()
+        output.write(line)
+        copyfileobj(body, output, ASSEMBLY_BUFFER)
+
+
+def _write_member_vcf(oh_id, header, output):
+    """
+    Stream the header and then every chromosome's vcf into output, in
+    settings.CHROMOSOMES order, so the combined vcf is never on disk.
+    """
+    output.write(header.encode())
+    for chrom in CHROMOSOMES:
+        _copy_vcf_body(_final_impute2(oh_id, chrom, 'member.imputed.vcf'),
+                       output)
+
+
+def _compressed_output(oh_id, basename):
+    """
+    The compressed file OUT_DIR/<oh_id>/<basename>, with a tabix index
+    next to it when settings.OUTPUT_CODEC is bgzf.
+    """
+    path = '{}/{}/{}'.format(OUT_DIR, oh_id, basename)
+    output = open_compressed(path, codec=settings.OUTPUT_CODEC,
+                             level=settings.OUTPUT_COMPRESSLEVEL,
+                             workers=settings.COMPRESS_WORKERS,
+                             block_size=settings.COMPRESS_BLOCK_SIZE)
+    if settings.OUTPUT_CODEC == 'bgzf':
+        return TabixWriter(output, _index_path(path))
+    return output
+
+
+def _index_path(path):
+    return path + '.tbi'
+
+
+def _output_files(oh_id, basename):
+    """basename and, for bgzf output, its index, with their paths."""
+    path = '{}/{}/{}'.format(OUT_DIR, oh_id, basename)
+    files = {basename: path}
+    if settings.OUTPUT_CODEC == 'bgzf':
+        files[basename + '.tbi'] = _index_path(path)
+    return files
+
 
-    # bzip the file
-    with open(member_vcf_fp, 'rb') as input_:
-        with bz2.BZ2File(member_vcf_fp + '.bz2', 'wb', compresslevel=9) as output:
-            copyfileobj(input_, output)
+def _upload_index(oh_id, basename, description):
+    if settings.OUTPUT_CODEC == 'bgzf':
+        process_source(oh_id, basename + '.tbi', description=description)
 
-    # upload file to OpenHumans
-    process_source(oh_id)
+
+def _chrom_basename(chrom):
+    return 'chr{}.member.imputed.vcf{}'.format(
+        chrom, suffix(settings.OUTPUT_CODEC))
+
+
+@app.task(ignore_result=False)
+def deliver_chrom(chrom, oh_id):
+    """
+    Compress one chromosome's finished vcf and upload it to Open Humans
+    right away, when settings.PROGRESSIVE_DELIVERY is on.
+    """
+    basename = _chrom_basename(chrom)
+    header = _member_header(_final_impute2(oh_id, chrom, 'header.txt'))
+    with _compressed_output(oh_id, basename) as output:
+        output.write(header.encode())
+        _copy_vcf_body(_final_impute2(oh_id, chrom, 'member.imputed.vcf'),
+                       output)
+    process_source(oh_id, basename,
+                   description='Imputed genotypes from Imputer, '
+                               'chromosome {}'.format(chrom))
+    _upload_index(oh_id, basename,
+                  'Tabix index of the imputed genotypes from Imputer, '
+                  'chromosome {}'.format(chrom))
+    logger.info('{}: delivered chromosome {}'.format(oh_id, chrom))
+    _checkpoint(oh_id, 'deliver', chrom)
+
+
+def _write_manifest(oh_id, basename):
+    """List the delivered chromosome files with their sizes and md5sums."""
+    files = []
+    for chrom in CHROMOSOMES:
+        chrom_fp = '{}/{}/{}'.format(OUT_DIR, oh_id, _chrom_basename(chrom))
+        md5 = hashlib.md5()
+        with open(chrom_fp, 'rb') as chrom_file:
+            for block in iter(lambda: chrom_file.read(ASSEMBLY_BUFFER), b''):
+                md5.update(block)
+        entry = {'chromosome': chrom,
+                 'basename': _chrom_basename(chrom),
+                 'size': os.path.getsize(chrom_fp),
+                 'md5': md5.hexdigest()}
+        if settings.OUTPUT_CODEC == 'bgzf':
+            entry['index'] = _chrom_basename(chrom) + '.tbi'
+        files.append(entry)
+    with open('{}/{}/{}'.format(OUT_DIR, oh_id, basename), 'w') as manifest:
+        json.dump({'imputerdate': datetime.date.today().isoformat(),
+                   'files': files}, manifest, indent=2)
+
+
+@app.task(ignore_result=False)
+def upload_to_oh(oh_id):
+    logger.info('{}: now uploading to OpenHumans'.format(oh_id))
+
+    if settings.PROGRESSIVE_DELIVERY:
+        # chromosomes are already up, describe them
+        _write_manifest(oh_id, 'member.imputed.manifest.json')
+        process_source(oh_id, 'member.imputed.manifest.json',
+                       description='Index of the imputed chromosome files '
+                                   'from Imputer')
+
+    if not settings.PROGRESSIVE_DELIVERY or settings.PROGRESSIVE_COMBINED:
+        # combine all vcfs straight into the compressor
+        basename = 'member.imputed.vcf' + suffix(settings.OUTPUT_CODEC)
+        cache, key = _result_cache(), None
+        if cache is not None and os.path.exists(_result_keys_fp(oh_id)):
+            with open(_result_keys_fp(oh_id)) as keys_file:
+                keys = json.load(keys_file)
+            key = combined_key(keys, basename, settings.OUTPUT_CODEC,
+                               settings.OUTPUT_COMPRESSLEVEL)
+        output_files = _output_files(oh_id, basename)
+        if key is None or not cache.get(key, output_files):
+            header = _member_header('{}/{}/header.txt'.format(OUT_DIR,
+                                                              oh_id))
+            with _compressed_output(oh_id, basename) as output:
+                _write_member_vcf(oh_id, header, output)
+            if key is not None:
+                cache.put(key, output_files)
+
+        # upload file to OpenHumans
+        process_source(oh_id, basename)
+        _upload_index(oh_id, basename, 'Tabix index of the imputed '
+                                       'genotypes from Imputer')
 
     # Message Member
     oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
     project_page = environ.get('OH_ACTIVITY_PAGE')
-    api.message('Open Humans Imputation Complete',
-                'Check {} to see your imputed genotype results from Open Humans.'.format(
-                    project_page),
-                oh_member.access_token,
-                project_member_ids=[oh_id])
+    get_client().message(
+        'Open Humans Imputation Complete',
+        'Check {} to see your imputed genotype results from Open Humans.'.format(
+            project_page),
+        oh_member.get_access_token(),
+        project_member_ids=[oh_id])
     logger.info('{} emailed member'.format(oh_id))
 
     # clean users files
     if not settings.DEBUG:
-        os.chdir(settings.BASE_DIR)
         clean_command = [
-            'imputer/clean_files.sh', '{}'.format(oh_id)
+            _script('clean_files.sh'), '{}'.format(oh_id)
         ]
-        process = run(clean_command, stdout=PIPE, stderr=PIPE)
-        logger.debug(process.stderr)
+        run(clean_command, log_path(oh_id, 'upload'), cwd=settings.BASE_DIR)
         logger.info('{} finished removing files'.format(oh_id))
 
     imputer_record = ImputerMember.objects.get(oh_id=oh_id, active=True)
     imputer_record.step = 'complete'
     imputer_record.active = False
     imputer_record.save()
+    invalidate_member_data(oh_id)
+    if settings.ADMISSION_CONTROL:
+        # the member's reservation is free now
+        admit_members.delay()
+
+
+def _chrom_order(chroms):
+    """
+    chroms in the order to enqueue them, with each one's task options:
+    longest expected runtime first with settings.COST_ORDERING, and
+    broker priorities by cost with settings.COST_PRIORITY.
+    """
+    options = {chrom: {} for chrom in chroms}
+    if settings.COST_ORDERING:
+        costs = estimated_costs(chroms, ChromosomeRuntime.runtimes())
+        chroms = order_by_cost(chroms, costs)
+        if settings.COST_PRIORITY:
+            levels = priorities(chroms, costs)
+            options = {chrom: {'priority': levels[chrom]} for chrom in chroms}
+    return chroms, options
+
+
+def _submit_chroms(oh_id, chroms=None):
+    """
+    The imputation group: a submit_chrom per chromosome, or with
+    settings.SEGMENT_FANOUT a phase/segments/merge canvas per chromosome,
+    in the order of _chrom_order. chroms defaults to all of them.
+    """
+    chroms, options = _chrom_order(chroms or CHROMOSOMES)
+    if settings.SEGMENT_FANOUT:
+        return group(_fanout_chrom(chrom, oh_id, **options[chrom])
+                     for chrom in chroms)
+    return group(submit_chrom.si(chrom, oh_id).set(**options[chrom])
+                 for chrom in chroms)
+
+
+def _batch_dirs(batch_id):
+    """The batch's merged plink data and its genipe output."""
+    name = 'batch.{}'.format(batch_id)
+    data_dir = os.path.join(DATA_DIR, name)
+    os.makedirs(data_dir, exist_ok=True)
+    return data_dir, _scratch_dir(name)
+
+
+def _member_ids(oh_id):
+    """The member's own FID and IID, which merge_batch replaced."""
+    with open('{}/{}/member.{}.plink.gt.fam'.format(
+            DATA_DIR, oh_id, oh_id)) as fam:
+        return fam.readline().split()[:2]
+
+
+def _set_batch_step(batch_id, step):
+    ImputerMember.objects.filter(batch_id=batch_id, active=True).update(
+        step=step)
+
+
+def queue_for_batch():
+    """
+    Called after a member is saved with step 'queued'. Flushes at once when
+    a batch is full, else after settings.BATCH_WAIT seconds at the latest.
+    """
+    queued = ImputerMember.objects.filter(
+        active=True, step='queued', batch__isnull=True).count()
+    if queued >= settings.BATCH_SIZE:
+        flush_batch.delay()
+    else:
+        flush_batch.apply_async(countdown=settings.BATCH_WAIT)
+
+
+@app.task
+def flush_batch():
+    """Claim up to settings.BATCH_SIZE queued members and start a batch."""
+    with transaction.atomic():
+        queued = list(ImputerMember.objects.select_for_update().filter(
+            active=True, step='queued', batch__isnull=True).order_by(
+            'id')[:settings.BATCH_SIZE])
+        if not queued:
+            return
+        batch = ImputationBatch.objects.create()
+        ImputerMember.objects.filter(id__in=[m.id for m in queued]).update(
+            batch=batch, step='batched')
+    logger.info('batch {}: members {}'.format(
+        batch.id, ', '.join(str(m.oh_id) for m in queued)))
+    batch_pipeline(batch.id, [(m.data_source_id, m.oh_id) for m in queued])
+
+
+@app.task
+def admit_members(timer=False):
+    """
+    Start the pipelines of the waiting members that fit in what the
+    admitted ones left of the node's budget, see imputer/admission.py.
+    Members waiting to resume (step 'resume') restart from their
+    checkpoints. While members wait, checks again every
+    settings.ADMISSION_INTERVAL seconds.
+    """
+    budget = capacity(settings.ADMISSION_CPUS, settings.ADMISSION_MEMORY,
+                      settings.ADMISSION_DISK, OUT_DIR)
+    peaks, cores = TaskMetric.chrom_profile()
+    needed = demand(CHROMOSOMES, peaks, cores, settings.ADMISSION_PARALLEL,
+                    settings.ADMISSION_TASK_MEMORY,
+                    settings.ADMISSION_DISK_PER_VARIANT)
+    since = timezone.now() - datetime.timedelta(
+        seconds=settings.ADMISSION_STALE)
+    with transaction.atomic():
+        waiting = list(ImputerMember.objects.select_for_update().filter(
+            active=True, step__in=['waiting', 'resume']).order_by('id'))
+        free = Demand(*(total - held for total, held in zip(
+            budget, ImputerMember.reserved(since))))
+        # scratch written by anything else counts against the budget too
+        free = free._replace(disk=min(free.disk, disk_usage(OUT_DIR).free))
+        admitted, skipped = admit(
+            [(member, needed, member.admission_skips) for member in waiting],
+            free, not ImputerMember.admitted(since).exists(),
+            settings.ADMISSION_MAX_SKIPS)
+        ImputerMember.objects.filter(id__in=[m.id for m in skipped]).update(
+            admission_skips=F('admission_skips') + 1)
+        resumed = {member.id for member in admitted
+                   if member.step == 'resume'}
+        for member in admitted:
+            member.step = 'launch'
+            member.admitted_at = timezone.now()
+            member.reserved_cpus = needed.cpus
+            member.reserved_memory = needed.memory
+            member.reserved_disk = needed.disk
+            member.save()
+    for member in admitted:
+        logger.info('{}: admitted with {:.1f} cpus, {:.1f} GB memory, '
+                    '{:.1f} GB disk'.format(member.oh_id, needed.cpus,
+                                            needed.memory / 1024 ** 3,
+                                            needed.disk / 1024 ** 3))
+        if member.id in resumed:
+            resume, plan = _resume_tasks(member)
+            _start_resumed(member.oh_id, resume)
+            logger.info('{}: resumed with {}'.format(member.oh_id, plan))
+        else:
+            pipeline(member.data_source_id, member.oh_id)
+
+    if len(admitted) == len(waiting):
+        if timer:
+            cache.delete(ADMISSION_TIMER_KEY)
+        return
+    # one timer at a time; the timer's own run always renews it
+    interval = settings.ADMISSION_INTERVAL
+    if timer:
+        cache.set(ADMISSION_TIMER_KEY, True, 2 * interval)
+    elif not cache.add(ADMISSION_TIMER_KEY, True, 2 * interval):
+        return
+    admit_members.apply_async(kwargs={'timer': True}, countdown=interval)
+
+
+@app.task
+def release_reservation(oh_id):
+    """
+    link_error of a member's pipeline: a failed run holds none of the
+    node's budget any more, so waiting members may be admitted. The member
+    stays active, for resume_imputation.
+    """
+    released = ImputerMember.objects.filter(
+        oh_id=oh_id, active=True, admitted_at__isnull=False).update(
+        admitted_at=None, reserved_cpus=0, reserved_memory=0,
+        reserved_disk=0)
+    if released:
+        logger.info('{}: failed, reservation released'.format(oh_id))
+        admit_members.delay()
+
+
+@app.task(ignore_result=False)
+def merge_batch(batch_id):
+    """
+    Merge the plink data of the batch's prepared members into one
+    multi-sample fileset. Variants plink cannot merge are flipped or left
+    out only for the members that disagree with the others, see
+    imputer.batch.reconcile_alleles.
+    """
+    _set_batch_step(batch_id, 'merge')
+    data_dir, work_dir = _batch_dirs(batch_id)
+    oh_ids = [str(member.oh_id)
+              for member in ImputationBatch.objects.get(
+                  id=batch_id).members()]
+    command = [_script('merge_batch.sh'), data_dir] + oh_ids
+    log = log_path('batch-{}'.format(batch_id), 'merge')
+    missnp = os.path.join(data_dir, 'batch.plink.gt-merge.missnp')
+    run(command, log, check=False, cwd=work_dir, env=_scratch_env(work_dir))
+    if not os.path.exists(missnp):
+        return
+    with open(missnp) as conflicts:
+        names = {line.strip() for line in conflicts if line.strip()}
+    lists = reconcile_alleles({
+        oh_id: os.path.join(data_dir, oh_id + '.bim') for oh_id in oh_ids},
+        names)
+    for oh_id, (flip, exclude) in lists.items():
+        write_list(os.path.join(data_dir, oh_id + '.flip'), flip)
+        write_list(os.path.join(data_dir, oh_id + '.exclude'), exclude)
+    logger.info('batch {}: reconciled {} conflicting variants'.format(
+        batch_id, len(names)))
+    os.remove(missnp)
+    run(command, log, cwd=work_dir, env=_scratch_env(work_dir))
+
+
+@app.task(ignore_result=False)
+def submit_batch_chrom(chrom, batch_id):
+    """
+    genipe-launcher on one chromosome of every member of a batch. Each
+    member's share of the time goes to the chromosome's ChromosomeRuntime.
+    """
+    _set_batch_step(batch_id, 'submit_chrom')
+    data_dir, work_dir = _batch_dirs(batch_id)
+    members = ImputationBatch.objects.get(id=batch_id).members()
+    chrom_dir = _scratch_dir(os.path.basename(work_dir),
+                             'chr{}'.format(chrom))
+    started = time.monotonic()
+    with _panel_cache() as cache:
+        command = _genipe_command(
+            chrom, os.path.join(data_dir, 'batch.plink.gt'), chrom_dir,
+            nind=len(members), cache=cache)
+        run(command,
+            log_path('batch-{}'.format(batch_id), 'chr{}'.format(chrom)),
+            progress=_genipe_progress(chrom, [m.oh_id for m in members]),
+            cwd=chrom_dir, env=_scratch_env(chrom_dir))
+    ChromosomeRuntime.record(chrom,
+                             (time.monotonic() - started) / len(members))
+    for member in members:
+        ChromosomeProgress.record(member.oh_id, chrom, 'imputed')
+
+
+@app.task(ignore_result=False)
+def split_batch_chrom(chrom, batch_id):
+    """
+    Write every member's final_impute2 files for the chromosome from the
+    batch run, where process_chrom expects them.
+    """
+    _, work_dir = _batch_dirs(batch_id)
+    batch_final = '{}/chr{}/chr{}/final_impute2/chr{}.imputed.'.format(
+        work_dir, chrom, chrom, chrom)
+    members = ImputationBatch.objects.get(id=batch_id).members()
+    for member in members:
+        _scratch_dir(member.oh_id, 'chr{}'.format(chrom),
+                     'chr{}'.format(chrom), 'final_impute2')
+    split_sample(batch_final + 'sample', {
+        str(member.oh_id): _final_impute2(member.oh_id, chrom,
+                                          'imputed.sample')
+        for member in members}, {
+        str(member.oh_id): _member_ids(member.oh_id) for member in members})
+    split_impute2(batch_final + 'impute2', batch_final + 'sample', {
+        str(member.oh_id): _final_impute2(member.oh_id, chrom,
+                                          'imputed.impute2')
+        for member in members}, settings.PROCESS_CHUNK_SIZE)
+    # the batch's info, certainty and frequencies are over every member's
+    # samples; each member's INFO and filter get their own
+    for member in members:
+        member_info(batch_final + 'impute2_info',
+                    _final_impute2(member.oh_id, chrom, 'imputed.impute2'),
+                    _final_impute2(member.oh_id, chrom,
+                                   'imputed.impute2_info'),
+                    settings.PROCESS_CHUNK_SIZE)
+        _checkpoint(member.oh_id, 'impute', chrom)
+    if settings.SCRATCH_RETENTION != 'all':
+        # every member has its own copy now
+        rmtree(os.path.join(work_dir, 'chr{}'.format(chrom)),
+               ignore_errors=True)
+
+
+@app.task(ignore_result=False)
+def clean_batch(batch_id):
+    """Remove the batch's merged data once every member is uploaded."""
+    if not settings.DEBUG:
+        for path in _batch_dirs(batch_id):
+            rmtree(path, ignore_errors=True)
+    logger.info('batch {} finished'.format(batch_id))
+
+
+@app.task
+def batch_member_prepared(batch_id, oh_id):
+    """The member's plink data is ready for its batch."""
+    ImputerMember.objects.filter(batch_id=batch_id, oh_id=oh_id,
+                                 active=True).update(step='prepared')
+    _continue_batch(batch_id)
+
+
+@app.task
+def batch_member_failed(batch_id, oh_id):
+    """
+    link_error of a batch member's own tasks: the member leaves the batch
+    and its run ends, so it can be launched again, while the others go on.
+    """
+    logger.error('batch {}: member {} failed'.format(batch_id, oh_id))
+    ImputerMember.objects.filter(batch_id=batch_id, oh_id=oh_id,
+                                 active=True).update(active=False,
+                                                     step='failed')
+    _continue_batch(batch_id)
+
+
+def _continue_batch(batch_id):
+    """
+    Impute the batch once none of its members is still being prepared,
+    with the ones that were. The member settling last starts it.
+    """
+    with transaction.atomic():
+        ImputationBatch.objects.select_for_update().get(id=batch_id)
+        members = ImputerMember.objects.filter(batch_id=batch_id,
+                                               active=True)
+        if members.exclude(step='prepared').exists():
+            return
+        oh_ids = [m.oh_id for m in members.order_by('id')]
+        members.update(step='merge')
+    if not oh_ids:
+        logger.info('batch {}: no member left'.format(batch_id))
+        clean_batch.delay(batch_id)
+        return
+    _impute_batch(batch_id, oh_ids)
+
+
+def batch_pipeline(batch_id, members):
+    """
+    members is a list of (data source id, oh_id). Downloads and plink
+    conversion stay per member; a member whose preparation fails leaves
+    the batch (batch_member_failed) and the others are imputed without it.
+    """
+    for vcf_id, oh_id in members:
+        chain(get_vcf.si(vcf_id, oh_id), prepare_data.si(oh_id),
+              batch_member_prepared.si(batch_id, oh_id)).on_error(
+            batch_member_failed.si(batch_id, oh_id)).apply_async()
+
+
+def _impute_batch(batch_id, oh_ids):
+    """
+    Imputation once per chromosome for the prepared members, in the
+    order and with the priorities of a single run, then for each of them
+    the steps a single run has after imputation.
+    """
+    chroms, options = _chrom_order(CHROMOSOMES)
+    impute = group(submit_batch_chrom.si(chrom, batch_id).set(
+        **options[chrom]) for chrom in chroms)
+    split = group(split_batch_chrom.si(chrom, batch_id)
+                  for chrom in CHROMOSOMES)
+    deliver_chroms = CHROMOSOMES if settings.PROGRESSIVE_DELIVERY else []
+    deliver = group(chain(*_imputation_tasks(
+        oh_id, [], CHROMOSOMES, deliver_chroms)).on_error(
+        batch_member_failed.si(batch_id, oh_id)) for oh_id in oh_ids)
+    chain(merge_batch.si(batch_id), impute, split, deliver,
+          clean_batch.si(batch_id)).apply_async()
+
+
+def _imputation_tasks(oh_id, impute_chroms, process_chroms, deliver_chroms):
+    """
+    Everything after prepare_data: imputation of impute_chroms, then
+    process_chrom and, with progressive delivery, deliver_chrom for the
+    chromosomes that need them, then upload_to_oh.
+    """
+    tasks = []
+    if impute_chroms:
+        tasks.append(_submit_chroms(oh_id, impute_chroms))
+    per_chrom = []
+    for chrom in CHROMOSOMES:
+        steps = []
+        if chrom in process_chroms:
+            steps.append(process_chrom.si(chrom, oh_id))
+        if chrom in deliver_chroms:
+            steps.append(deliver_chrom.si(chrom, oh_id))
+        if steps:
+            per_chrom.append(chain(*steps) if len(steps) > 1 else steps[0])
+    if per_chrom:
+        tasks.append(group(per_chrom))
+    tasks.append(upload_to_oh.si(oh_id))
+    return tasks
+
+
+def resume_pipeline(oh_id):
+    """
+    Restart an interrupted run from its checkpoints: only the stages and
+    chromosomes without a checkpoint whose outputs still match it are run
+    again. Returns the (stage, chromosomes) scheduled. With
+    settings.ADMISSION_CONTROL the member gives up its reservation and
+    waits (step 'resume') to be admitted like a new launch.
+    """
+    member = ImputerMember.objects.get(oh_id=oh_id, active=True)
+    resume, plan = _resume_tasks(member)
+    if settings.ADMISSION_CONTROL:
+        ImputerMember.objects.filter(id=member.id).update(
+            step='resume', admitted_at=None, reserved_cpus=0,
+            reserved_memory=0, reserved_disk=0)
+        logger.info('{}: waiting for admission to resume with {}'.format(
+            oh_id, plan))
+        admit_members.delay()
+        return plan
+    _start_resumed(oh_id, resume)
+    logger.info('{}: resumed with {}'.format(oh_id, plan))
+    return plan
+
+
+def _start_resumed(oh_id, tasks):
+    chain(*tasks).on_error(release_reservation.si(oh_id)).apply_async()
+
+
+def _resume_tasks(member):
+    """The tasks still to run for the member, and their plan."""
+    oh_id = member.oh_id
+    done = _completed_stages(member)
+    tasks = []
+    plan = []
+    if ('prepare_data', '') not in done:
+        if ('get_vcf', '') not in done:
+            if not member.data_source_id:
+                raise ValueError('{} has no data source to download '
+                                 'again'.format(oh_id))
+            tasks.append(get_vcf.si(member.data_source_id, oh_id))
+            plan.append(('get_vcf', []))
+        tasks.append(prepare_data.si(oh_id))
+        plan.append(('prepare_data', []))
+        # new plink data invalidates every later stage
+        done = {('get_vcf', '')}
+    # a processed chromosome whose vcf still matches needs no impute2
+    # files, settings.SCRATCH_RETENTION may have removed them
+    impute = [c for c in CHROMOSOMES
+              if ('impute', c) not in done and ('process', c) not in done]
+    process = [c for c in CHROMOSOMES
+               if c in impute or ('process', c) not in done]
+    deliver = []
+    if settings.PROGRESSIVE_DELIVERY:
+        deliver = [c for c in CHROMOSOMES
+                   if c in process or ('deliver', c) not in done]
+    plan += [('impute', impute), ('process', process), ('deliver', deliver)]
+    return tasks + _imputation_tasks(oh_id, impute, process, deliver), plan
 
 
 def pipeline(vcf_id, oh_id):
     task1 = get_vcf.si(vcf_id, oh_id)
     task2 = prepare_data.si(oh_id)
-    async_chroms = group(submit_chrom.si(chrom, oh_id)
-                         for chrom in CHROMOSOMES)
-    async_process = group(process_chrom.si(chrom, oh_id)
-                          for chrom in CHROMOSOMES)
-    task3 = chain(async_chroms, async_process, upload_to_oh.si(oh_id))
+    deliver = CHROMOSOMES if settings.PROGRESSIVE_DELIVERY else []
+    if settings.RESULT_CACHE_DIR:
+        task3 = [plan_imputation.si(oh_id)]
+    else:
+        task3 = _imputation_tasks(oh_id, CHROMOSOMES, CHROMOSOMES, deliver)
 
-    pipeline = chain(task1, task2, task3)
+    pipeline = chain(task1, task2, *task3)
+    pipeline.on_error(release_reservation.si(oh_id))
     pipeline.apply_async()
@@ -0,0 +1,928 @@
+import bz2
+import datetime
+import gzip
+import hashlib
+import lzma
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import requests
+from celery import group
+from celery.canvas import _chain, _chord
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from imputer import tasks
+from imputer.batch import member_info, reconcile_alleles
+from imputer.compression import (BGZF_BLOCK_SIZE, BGZF_EOF,
+                                 BgzfCompressor, open_compressed)
+from imputer.download import DownloadError, download_vcf
+from imputer.merge_join import merge_sorted
+from imputer.models import (ChromosomeProgress, ChromosomeRuntime,
+                            ImputationBatch, ImputerMember)
+from imputer.panel_cache import PanelCache, panel_budget
+from imputer.runner import CommandFailed
+from imputer.scheduling import smoothed
+from imputer.segments import prephase_lists, strand_issues
+from imputer.tabix import TabixWriter
+from imputer.vcf import (IMPUTE_COLS, VCF_COLS, Reference, format_records,
+                         hard_calls, header, sample_id, write_annotated_vcf)
+
+
+def _chunks(frame, size):
+    return (frame.iloc[start:start + size]
+            for start in range(0, len(frame), size))
+
+
+class MergeSortedTests(SimpleTestCase):
+    """The windowed merge gives the rows and order of the full merge."""
+
+    CHUNK_SIZES = [1, 2, 3, 5, 8, 1000]
+
+    def setUp(self):
+        # repeated positions are multi-allelic sites, which must stay in
+        # one window; info drops some sites and has one impute2 lacks
+        self.impute = pd.DataFrame({
+            'chr': ['1'] * 10,
+            'position': [10, 20, 20, 20, 35, 40, 40, 55, 60, 70],
+            'a0': list('AACGTAGCTA'),
+            'a1': list('GTGACGCATC'),
+            'name': ['rs{}'.format(i) for i in range(10)],
+            'p': [i / 10 for i in range(10)],
+        })
+        self.info = pd.DataFrame({
+            'chr': ['1'] * 8,
+            'position': [10, 20, 20, 40, 40, 50, 60, 70],
+            'a0': list('AACAGTTA'),
+            'a1': list('GTGCCAAC'),
+            'name': ['info{}'.format(i) for i in range(8)],
+            'info': [0.5 + i / 20 for i in range(8)],
+        })
+
+    def assertSameMerge(self, windows, expected, keep_index=False):
+        merged = pd.concat(list(windows))
+        if not keep_index:
+            # every window's merge numbers its rows from 0
+            merged = merged.reset_index(drop=True)
+            expected = expected.reset_index(drop=True)
+        pd.testing.assert_frame_equal(merged, expected)
+
+    def test_column_join(self):
+        keys = ['chr', 'position', 'a0', 'a1']
+        for how in ['inner', 'right']:
+            expected = self.impute.merge(self.info, on=keys, how=how)
+            for left_size in self.CHUNK_SIZES:
+                for right_size in self.CHUNK_SIZES:
+                    with self.subTest(how=how, left=left_size,
+                                      right=right_size):
+                        self.assertSameMerge(merge_sorted(
+                            _chunks(self.impute, left_size),
+                            _chunks(self.info, right_size),
+                            'position', 'position', on=keys, how=how),
+                            expected)
+
+    def test_index_join(self):
+        vcf = self.impute.rename(columns={'position': 'POS'}).set_index(
+            'name')
+        gp = self.impute[['name', 'position', 'p']].iloc[::2].rename(
+            columns={'p': 'gp'}).set_index('name')
+        expected = vcf.merge(gp, left_index=True, right_index=True)
+        for size in self.CHUNK_SIZES:
+            with self.subTest(size=size):
+                self.assertSameMerge(merge_sorted(
+                    _chunks(vcf, size), _chunks(gp, size), 'POS', 'position',
+                    left_index=True, right_index=True), expected,
+                    keep_index=True)
+
+
+IMPUTE2 = [
+    '1 1:1:A:G 1 A G 0.9 0.1 0',
+    '1 1:2:T:C 2 T C 0.1 0.2 0.7',  # hg19 has C: alleles swap
+    '1 1:3:A:T 3 A T 0 0 1',  # hg19 has G: provisional REF
+    '1 1:4:TA:T 4 TA T 0.3 0.4 0.3',
+    '1 1:6:C:G 6 C G 0.5 0.5 0',
+    '1 1:7:G:A 7 G A 1 0 0',  # not in the info file
+]
+INFO = [
+    'chr\tname\tposition\ta0\ta1\texp_freq_a1\tinfo\tcertainty\t'
+    'info_type0\tconcord_type0\tr2_type0',
+    '1\t1:1:A:G\t1\tA\tG\t0.05\t0.9\t0.95\t-1\t-1\t-1',
+    '1\t1:2:T:C\t2\tT\tC\t0.8\t0.8123\t0.9\t-1\t-1\t-1',
+    '1\t1:3:A:T\t3\tA\tT\t1\t1\t1\t-1\t-1\t-1',
+    '1\t1:4:TA:T\t4\tTA\tT\t0.5\t0.5\t0.7\t-1\t-1\t-1',
+    '1\t1:6:C:G\t6\tC\tG\t0.25\t0.35\t0.75\t-1\t-1\t-1',
+]
+# what plink2 --export vcf --ref-from-fa writes for IMPUTE2 after the
+# info filter, which the plink2 path then annotates
+PLINK2_RECORDS = [
+    '1\t1\t1:1_A_G\tA\tG\t.\t.\t.\tGT\t0/0',
+    '1\t2\t1:2_T_C\tC\tT\t.\t.\t.\tGT\t0/0',
+    '1\t3\t1:3_A_T\tA\tT\t.\t.\tPR\tGT\t1/1',
+    '1\t4\t1:4_TA_T\tTA\tT\t.\t.\t.\tGT\t0/1',
+    '1\t6\t1:6_C_G\tC\tG\t.\t.\t.\tGT\t./.',
+]
+
+
+class VcfWriterTests(SimpleTestCase):
+    """The native writer against plink2's hard calls and REF/ALT."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        fasta = os.path.join(self.tmp, 'hg19.fasta')
+        with open(fasta, 'w') as ref:
+            ref.write('>1\n' + 'ACGTACGTAC\n' * 3)
+        with open(fasta + '.fai', 'w') as fai:
+            fai.write('1\t30\t3\t10\t11\n')
+        self.reference = Reference(fasta)
+
+    def path(self, name, lines):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as out:
+            out.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def test_hard_call_threshold(self):
+        # alt dosages 0.4, 0.41, 0.6, 0.5, 1.6, 1.59 and no probability
+        probs = np.array([[0.6, 0.4, 0], [0.59, 0.41, 0], [0.4, 0.6, 0],
+                          [0.5, 0.5, 0], [0, 0.4, 0.6], [0, 0.41, 0.59],
+                          [0, 0, 0]])
+        self.assertEqual(hard_calls(*probs.T).tolist(), [
+            b'0/0', b'./.', b'0/1', b'./.', b'1/1', b'./.', b'./.'])
+        # probabilities are normalised: the alt dosage is 1.5, not 0.75
+        self.assertEqual(hard_calls(np.array([0.0]), np.array([0.25]),
+                                    np.array([0.25])).tolist(), [b'./.'])
+
+    def test_records(self):
+        df = pd.read_csv(self.path('chr1.impute2', IMPUTE2[:5]), sep=' ',
+                         header=None, names=IMPUTE_COLS)
+        df['info'] = [0.9, 0.8123, 1, 0.5, 0.35]
+        records = format_records(df, '1', self.reference)
+        self.assertEqual(records.splitlines(), [
+            '1\t1\t1:1_A_G\tA\tG\t.\t.\t.;INFO=0.9\tGT:GP\t0/0:0.9,0.1,0.0',
+            # the alt dosage of T is 0.4: called, and GP keeps a0/a1 order
+            '1\t2\t1:2_T_C\tC\tT\t.\t.\t.;INFO=0.812\tGT:GP\t0/0:0.1,0.2,0.7',
+            '1\t3\t1:3_A_T\tA\tT\t.\t.\tPR;INFO=1.0\tGT:GP\t1/1:0.0,0.0,1.0',
+            '1\t4\t1:4_TA_T\tTA\tT\t.\t.\t.;INFO=0.5\tGT:GP\t0/1:0.3,0.4,0.3',
+            '1\t6\t1:6_C_G\tC\tG\t.\t.\t.;INFO=0.35\tGT:GP\t./.:0.5,0.5,0.0',
+        ])
+
+    def test_header(self):
+        sample = self.path('chr1.sample', [
+            'ID_1 ID_2 missing', '0 0 0', 'member member 0'])
+        lines = header('1', sample_id(sample), 30).splitlines()
+        self.assertEqual(lines[0], '##fileformat=VCFv4.2')
+        self.assertIn('##contig=<ID=1,length=30>', lines)
+        self.assertEqual(lines[-1], '#' + '\t'.join(VCF_COLS[:-1]) +
+                         '\tmember')
+        self.assertEqual(header('23', 'member', 5).count('##contig=<ID=X,'),
+                         1)
+
+    def test_same_as_plink2_path(self):
+        out = os.path.join(self.tmp, 'out')
+        final = os.path.join(out, '1', 'chr1', 'chr1', 'final_impute2')
+        impute2 = self.path(os.path.join(final, 'chr1.imputed.impute2'),
+                            IMPUTE2)
+        info = self.path(os.path.join(final, 'chr1.imputed.impute2_info'),
+                         INFO)
+        sample = self.path(os.path.join(final, 'chr1.imputed.sample'), [
+            'ID_1 ID_2 missing', '0 0 0', 'member member 0'])
+        native = os.path.join(self.tmp, 'native.vcf')
+        write_annotated_vcf(impute2, info, sample, native, '1',
+                            self.reference, chunksize=2)
+
+        def plink2(oh_id, chrom):
+            self.path(os.path.join(final, 'chr1.member.imputed.vcf'),
+                      ['#CHROM'] + PLINK2_RECORDS)
+
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized), \
+                    mock.patch.object(tasks, 'OUT_DIR', out), \
+                    mock.patch.object(tasks, '_output_vcf', plink2), \
+                    self.settings(VECTORIZED_ANNOTATION=vectorized):
+                self.path(os.path.join(final, 'chr1.imputed.impute2'),
+                          IMPUTE2)
+                tasks._process_chrom_in_memory('1', '1')
+                with open(os.path.join(
+                        final, 'chr1.member.imputed.vcf')) as vcf:
+                    expected = vcf.read().splitlines()
+                with open(native) as vcf:
+                    records = [line for line in vcf.read().splitlines()
+                               if not line.startswith('#')]
+                self.assertEqual(records, expected)
+
+
+DECOMPRESS = {'bz2': bz2.decompress, 'gzip': gzip.decompress,
+              'xz': lzma.decompress, 'bgzf': gzip.decompress}
+
+
+class CompressionTests(SimpleTestCase):
+    """Block-parallel output reads back with the standard library."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'member.vcf')
+        # text like a vcf's, broken by runs that do not compress
+        rows = b''.join(b'1\t%d\trs%d\tA\tG\t.\t.\t.\tGT:GP\t0/1:0.1,0.8,0.1\n'
+                        % (i, i) for i in range(3000))
+        self.data = rows + os.urandom(70000) + rows
+
+    def compress(self, codec, writes, block_size=1000):
+        with open_compressed(self.path, codec, level=6, workers=3,
+                             block_size=block_size) as out:
+            for data in writes:
+                out.write(data)
+        with open(self.path, 'rb') as compressed:
+            return out, compressed.read()
+
+    def test_round_trip(self):
+        sizes = [1, 999, 1000, 1001, 4096, 100000]
+        writes, start = [], 0
+        while start < len(self.data):
+            size = sizes[len(writes) % len(sizes)]
+            writes.append(self.data[start:start + size])
+            start += size
+        for codec in DECOMPRESS:
+            with self.subTest(codec=codec):
+                out, compressed = self.compress(codec, writes)
+                self.assertGreater(out.blocks, 1)
+                self.assertEqual(DECOMPRESS[codec](compressed), self.data)
+
+    def test_short_and_empty(self):
+        for codec in DECOMPRESS:
+            for data in [b'1\t10\trs1\n', b'']:
+                with self.subTest(codec=codec, size=len(data)):
+                    out, compressed = self.compress(codec, [data])
+                    self.assertEqual(out.blocks, 1)
+                    self.assertEqual(DECOMPRESS[codec](compressed), data)
+
+    def test_bgzf_blocks(self):
+        out, compressed = self.compress('bgzf', [self.data])
+        self.assertTrue(compressed.endswith(BGZF_EOF))
+        # every block's BSIZE leads to the next one, then to the EOF block
+        offset = 0
+        for expected in out.offsets[:-1]:
+            self.assertEqual(offset, expected)
+            self.assertEqual(compressed[offset + 12:offset + 14], b'BC')
+            offset += struct.unpack('<H', compressed[
+                offset + 16:offset + 18])[0] + 1
+        self.assertEqual(offset, out.offsets[-1])
+        self.assertEqual(len(compressed), offset + len(BGZF_EOF))
+        for position in [0, 1, BGZF_BLOCK_SIZE - 1, BGZF_BLOCK_SIZE,
+                         2 * BGZF_BLOCK_SIZE + 7, len(self.data) - 1]:
+            with self.subTest(position=position):
+                virtual = out.virtual_offset(position)
+                block = zlib.decompressobj(31).decompress(
+                    compressed[virtual >> 16:])
+                within = virtual & 0xffff
+                self.assertEqual(block[within:within + 100],
+                                 self.data[position:position + 100][
+                                     :len(block) - within])
+
+
+def _reg2bins(beg, end):
+    """The bins that can hold records overlapping [beg, end), per SAM spec."""
+    end -= 1
+    bins = [0]
+    for shift, first in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+def _read_tbi(path):
+    """{chrom: (bins, linear)} of a .tbi, with the header fields."""
+    data = gzip.decompress(open(path, 'rb').read())
+    magic, n_ref, *header = struct.unpack_from('<4s7i', data)
+    names_size, = struct.unpack_from('<i', data, 32)
+    names = data[36:36 + names_size].split(b'\0')[:n_ref]
+    offset = 36 + names_size
+    references = {}
+    for name in names:
+        bins = {}
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            bins[bin_id] = [struct.unpack_from('<QQ', data, offset + 16 * i)
+                            for i in range(n_chunk)]
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        linear = struct.unpack_from('<{}Q'.format(n_intv), data, offset + 4)
+        offset += 4 + 8 * n_intv
+        references[name] = (bins, linear)
+    return magic, header, names, references
+
+
+class TabixTests(SimpleTestCase):
+    """Region queries through the index find exactly the records."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'member.imputed.vcf.gz')
+        self.records = []
+        for chrom, count in [(b'21', 3000), (b'22', 2500), (b'X', 10)]:
+            for i in range(count):
+                ref = b'ACGTACGTAC' * (i % 7 == 0) or b'A'
+                self.records.append(
+                    b'%s\t%d\trs%d\t%s\tG\t.\t.\t.\tGT\t0/1'
+                    % (chrom, 10000 + 97 * i, i, ref))
+
+    def write(self, records):
+        compressor = BgzfCompressor(open(self.path, 'wb'), workers=2)
+        with TabixWriter(compressor, self.path + '.tbi') as out:
+            out.write(b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\n')
+            # writes that cut records in two
+            text = b'\n'.join(records) + b'\n'
+            for start in range(0, len(text), 1000):
+                out.write(text[start:start + 1000])
+
+    def read(self, virtual_start, virtual_stop):
+        """The uncompressed bytes between two virtual offsets."""
+        with open(self.path, 'rb') as vcf:
+            compressed = vcf.read()
+        blocks, data, offset = {}, b'', 0
+        while offset < len(compressed):
+            blocks[offset] = len(data)
+            size = struct.unpack('<H', compressed[offset + 16:
+                                                  offset + 18])[0] + 1
+            data += zlib.decompress(compressed[offset:offset + size], 31)
+            offset += size
+
+        def position(virtual):
+            return blocks[virtual >> 16] + (virtual & 0xffff)
+        return data[position(virtual_start):position(virtual_stop)]
+
+    def query(self, chrom, beg, end):
+        """The records overlapping 1-based, inclusive beg-end."""
+        bins, linear = _read_tbi(self.path + '.tbi')[3][chrom]
+        window = (beg - 1) >> 14
+        smallest = linear[min(window, len(linear) - 1)]
+        found = []
+        for bin_id in _reg2bins(beg - 1, end):
+            for start, stop in bins.get(bin_id, []):
+                if stop <= smallest:
+                    continue
+                for line in self.read(start, stop).splitlines():
+                    _, pos, _, ref = line.split(b'\t')[:4]
+                    if int(pos) <= end and int(pos) + len(ref) > beg:
+                        found.append(line)
+        return sorted(found)
+
+    def test_region_queries(self):
+        self.write(self.records)
+        magic, header, names, _ = _read_tbi(self.path + '.tbi')
+        self.assertEqual((magic, header, names), (
+            b'TBI\1', [2, 1, 2, 0, ord('#'), 0], [b'21', b'22', b'X']))
+        # an indel's REF reaching into the region, a single position
+        for chrom, beg, end in [(b'21', 1, 20000), (b'21', 10005, 10005),
+                                (b'21', 10097, 10097), (b'21', 10098, 10193),
+                                (b'21', 150000, 200000),
+                                (b'22', 60000, 60500), (b'22', 1, 10 ** 7),
+                                (b'X', 10485, 10485), (b'X', 20000, 30000)]:
+            with self.subTest(chrom=chrom, beg=beg, end=end):
+                expected = sorted(
+                    record for record in self.records
+                    if record.split(b'\t')[0] == chrom and
+                    int(record.split(b'\t')[1]) <= end and
+                    int(record.split(b'\t')[1]) +
+                    len(record.split(b'\t')[3]) > beg)
+                self.assertEqual(self.query(chrom, beg, end), expected)
+
+    def test_chromosomes_not_together(self):
+        with self.assertRaises(ValueError):
+            self.write(self.records + self.records[:1])
+        self.assertFalse(os.path.exists(self.path + '.tbi'))
+
+
+class _Source(BaseHTTPRequestHandler):
+    """Serves the server's body, headers and cut (bytes left unsent)."""
+
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in self.server.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body[:len(body) - self.server.cut])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTests(SimpleTestCase):
+    """get_vcf's download from a local server standing in for S3."""
+
+    VCF = b''.join(b'1\t%d\trs%d\tA\tG\t.\t.\t.\tGT\t0/1\n' % (i, i)
+                   for i in range(5000))
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dest = os.path.join(tmp.name, 'member.vcf')
+
+    def download(self, body, headers={}, cut=0, **kwargs):
+        server = HTTPServer(('127.0.0.1', 0), _Source)
+        server.body, server.headers, server.cut = body, headers, cut
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        self.addCleanup(server.server_close)
+        try:
+            return download_vcf('http://127.0.0.1:{}/member.vcf'.format(
+                server.server_port), self.dest, timeout=5, chunk_size=1000,
+                **kwargs)
+        finally:
+            thread.join()
+
+    def assertDownloaded(self, kind, body, **kwargs):
+        self.assertEqual(self.download(body, **kwargs), kind)
+        with open(self.dest, 'rb') as vcf:
+            self.assertEqual(vcf.read(), self.VCF)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def assertFailed(self, body, **kwargs):
+        with self.assertRaises((DownloadError, requests.RequestException)):
+            self.download(body, **kwargs)
+        self.assertEqual(os.listdir(os.path.dirname(self.dest)), [])
+
+    def test_formats(self):
+        self.assertDownloaded('plain', self.VCF)
+        self.assertDownloaded('bz2', bz2.compress(self.VCF))
+        self.assertDownloaded('gzip', gzip.compress(self.VCF))
+
+    def test_concatenated_streams(self):
+        half = len(self.VCF) // 2
+        for kind, compress in [('gzip', gzip.compress),
+                               ('bz2', bz2.compress)]:
+            with self.subTest(kind=kind):
+                self.assertDownloaded(kind, compress(self.VCF[:half]) +
+                                      compress(self.VCF[half:]))
+
+    def test_checksums(self):
+        body = bz2.compress(self.VCF)
+        md5 = hashlib.md5(body).hexdigest()
+        self.assertDownloaded('bz2', body, headers={'ETag': '"%s"' % md5})
+        self.assertDownloaded('bz2', body, md5=md5)
+        # multipart ETags are not an md5 of the body and are not checked
+        self.assertDownloaded('bz2', body, headers={'ETag': '"%s-3"' % md5})
+
+    def test_bad_checksums(self):
+        body = gzip.compress(self.VCF)
+        self.assertFailed(body, headers={'ETag': '"{}"'.format('0' * 32)})
+        self.assertFailed(body, md5='0' * 32)
+
+    def test_truncated(self):
+        for kind, body in [('plain', self.VCF),
+                           ('bz2', bz2.compress(self.VCF)),
+                           ('gzip', gzip.compress(self.VCF))]:
+            with self.subTest(kind=kind):
+                self.assertFailed(body, cut=100)
+
+    def test_stream_ends_early(self):
+        # a complete response holding an incomplete compressed stream
+        for body in [bz2.compress(self.VCF)[:-100],
+                     gzip.compress(self.VCF)[:-100]]:
+            with self.subTest(head=body[:2]):
+                self.assertFailed(body)
+
+
+# stands in for plink --chr ... --make-bed: fails, after starting its
+# .bed, on the chromosomes listed in $EMPTY
+FAKE_PLINK = '''#!/bin/bash
+while [[ $# -gt 0 ]]; do
+case $1 in --chr) chr=$2;; --out) out=$2;; esac
+shift
+done
+touch "$out".bed
+[[ " $EMPTY " = *" $chr "* ]] && exit 1
+touch "$out".bim "$out".fam
+'''
+
+
+class SplitChromsTests(SimpleTestCase):
+    def test_chromosomes_without_variants(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        plink = os.path.join(tmp.name, 'plink')
+        with open(plink, 'w') as script:
+            script.write(FAKE_PLINK)
+        os.chmod(plink, 0o755)
+        os.makedirs(os.path.join(tmp.name, '1'))
+        env = dict(os.environ, IMP_BIN=tmp.name, DATA_DIR=tmp.name,
+                   EMPTY='2 23,25')
+        # the last chromosome failing does not fail the script either
+        subprocess.run([tasks._script('split_chroms.sh'), '1', '1', '2',
+                        '3', '23'], env=env, check=True)
+        with mock.patch.object(tasks, 'DATA_DIR', tmp.name), \
+                self.settings(SPLIT_CHROMS=True):
+            self.assertEqual(
+                {chrom: os.path.basename(tasks._member_bfile('1', chrom))
+                 for chrom in ['1', '2', '3', '23']},
+                {'1': 'member.1.chr1.plink.gt', '2': 'member.1.plink.gt',
+                 '3': 'member.1.chr3.plink.gt', '23': 'member.1.plink.gt'})
+
+
+class ChromosomeRuntimeTests(TestCase):
+    def test_record_folds_every_run(self):
+        expected = 0
+        for runs, seconds in enumerate([100, 200, 50]):
+            ChromosomeRuntime.record('1', seconds)
+            expected = smoothed(expected, seconds, runs)
+        runtime = ChromosomeRuntime.objects.get(chrom='1')
+        self.assertEqual(runtime.runs, 3)
+        self.assertAlmostEqual(runtime.mean_seconds, expected)
+
+    def out_dir(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ['OUT_DIR', 'DATA_DIR']:
+            patcher = mock.patch.object(tasks, name, tmp.name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ['run', 'time']:
+            patcher = mock.patch.object(tasks, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_fanout_runs_recorded(self):
+        # from phase_chrom's start to the end of merge_chrom
+        self.out_dir()
+        with open(tasks._phase_started_fp(
+                tasks._segment_dir(1, '22')), 'w') as started:
+            started.write('1000.5')
+        self.time.time.return_value = 1300.5
+        with mock.patch.object(tasks, 'copyfile'), \
+                mock.patch.object(tasks, '_checkpoint'):
+            tasks.merge_chrom('22', 1)
+        runtime = ChromosomeRuntime.objects.get(chrom='22')
+        self.assertEqual((runtime.runs, runtime.mean_seconds), (1, 300))
+
+    def test_batch_runs_recorded(self):
+        # every member's share of the batch's run
+        self.out_dir()
+        batch = ImputationBatch.objects.create()
+        for oh_id in [1, 2, 3, 4]:
+            ImputerMember.objects.create(oh_id=oh_id, active=True,
+                                         step='submit_chrom', batch=batch)
+        self.time.monotonic.side_effect = [100, 500]
+        with mock.patch.object(tasks, '_genipe_command'), \
+                self.settings(PANEL_CACHE_DIR=''):
+            tasks.submit_batch_chrom('22', batch.id)
+        runtime = ChromosomeRuntime.objects.get(chrom='22')
+        self.assertEqual((runtime.runs, runtime.mean_seconds), (1, 100))
+
+
+class PrephaseTests(SimpleTestCase):
+    """genipe's marker exclusion and flipping before phasing."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        fasta = os.path.join(self.tmp.name, 'ref.fasta')
+        with open(fasta, 'w') as ref:
+            ref.write('>1\nACGTA\nCGTAC\n')
+        with open(fasta + '.fai', 'w') as fai:
+            fai.write('1\t10\t3\t5\t6\n')
+        self.reference = Reference(fasta)
+
+    def path(self, name, lines):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as out:
+            out.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def test_lists(self):
+        bim = self.path('member.bim', [
+            '1\tsame\t0\t1\tA\tG',  # ref A
+            '1\tambiguous\t0\t2\tA\tT',
+            '1\treversed\t0\t3\tA\tC',  # ref G, complement of C
+            '1\tduplicate\t0\t3\tC\tT',
+            '1\tmismatch\t0\t4\tA\tC',  # ref T, complement of A
+            '1\tforward\t0\t7\tA\tG',  # ref G
+            '1\tother\t0\t8\tA\tC',  # ref T
+            '1\tindel\t0\t9\tI\tD',
+            '2\telsewhere\t0\t1\tA\tG',
+        ])
+        lists = prephase_lists(bim, '1', 'chr1', self.reference)
+        self.assertEqual(lists['extract'], [
+            'same', 'ambiguous', 'reversed', 'duplicate', 'mismatch',
+            'forward', 'other', 'indel'])
+        self.assertEqual(lists['exclude'], ['ambiguous', 'duplicate'])
+        self.assertEqual(lists['flip'], ['reversed', 'mismatch', 'other'])
+        self.assertEqual(lists['update_chr'], [])
+
+    def test_neither_strand(self):
+        # genipe stops on a marker matching neither strand
+        bim = self.path('member.bim', ['1\tgg\t0\t1\tG\tG'])
+        lists = prephase_lists(bim, '1', 'chr1', self.reference)
+        self.assertEqual(lists['exclude'], ['gg'])
+        self.assertEqual(lists['flip'], [])
+
+    def test_strand_issues(self):
+        # rows have one more leading column than the header names
+        strand = self.path('chr1.alignments.snp.strand', [
+            'type\tpos\tmain_id',
+            '3\tStrand\t10\trs1',
+            '4\tMissing\t11\trs2',
+            '5\tStrand\t12\trs3',
+        ])
+        self.assertEqual(strand_issues(strand), ['rs1', 'rs3'])
+        self.assertEqual(strand_issues(strand + '.missing'), [])
+
+
+class ImputeSegmentTests(SimpleTestCase):
+    def test_failure(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        failed_run = subprocess.CompletedProcess(
+            [], 1, stderr=b'ERROR: bad haplotypes')
+        with mock.patch.object(tasks, 'OUT_DIR', tmp.name), \
+                self.settings(PANEL_CACHE_DIR='',
+                              PIPELINE_LOG_DIR=tmp.name), \
+                mock.patch.object(tasks, 'run',
+                                  return_value=failed_run) as run:
+            phased = tasks.phased_prefix(tasks._segment_dir(1, '22'),
+                                         'chr22')
+            os.makedirs(os.path.dirname(phased))
+            open(phased + '.haps', 'w').close()
+            with self.assertRaises(CommandFailed) as failed:
+                tasks.impute_segment('22', 1, 'chr22', 1, 5000000)
+        self.assertEqual(failed.exception.returncode, 1)
+        self.assertEqual(failed.exception.tail, 'ERROR: bad haplotypes')
+        self.assertEqual(failed.exception.log_path, run.call_args[0][1])
+        self.assertTrue(failed.exception.log_path.endswith(
+            'chr22.segment.chr22.1.log'))
+
+
+class PanelCacheTests(SimpleTestCase):
+    """Entries a task holds survive eviction however old they are."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.files = {}
+        for kind, lines in [
+                ('hap', ['0 1 1 0\n'] * 4),
+                ('legend', ['id position a0 a1\n'] + [
+                    'rs{0} {0}00 A G\n'.format(i) for i in range(1, 5)])]:
+            path = os.path.join(self.tmp.name, 'panel_chr1.{}.gz'.format(
+                kind))
+            with gzip.open(path, 'wt') as out:
+                out.writelines(lines)
+            self.files[kind] = path
+        self.files['sample'] = os.path.join(self.tmp.name, 'panel.sample')
+        with open(self.files['sample'], 'w') as sample:
+            sample.write('ID POP GROUP SEX\nA x x 1\nB x x 2\n')
+
+    def cache(self):
+        return PanelCache(self.tmp.name, 'v1', 0, buffer=50)
+
+    def test_held_entries_are_kept(self):
+        with self.cache() as reader:
+            files = reader.segment(self.files, 100, 200)
+            self.assertTrue(os.path.exists(files['hap']))
+            # the whole chromosome was only held to cut the slice
+            self.assertEqual(self.cache().evict(), _held_size(reader))
+            self.assertTrue(os.path.exists(files['hap']))
+        self.assertEqual(self.cache().evict(), 0)
+        self.assertFalse(os.path.exists(files['hap']))
+
+    def test_evicted_entries_are_rebuilt(self):
+        with self.cache() as reader:
+            reader.whole(self.files)
+        with self.cache() as reader:
+            self.cache().evict()
+            files = reader.whole(self.files)
+            with open(files['hap']) as hap:
+                self.assertEqual(len(hap.readlines()), 4)
+
+    def test_budget(self):
+        # 2 samples: 4 haplotype columns of 2 bytes per variant
+        self.assertEqual(panel_budget(self.files['sample'], 10),
+                         int(10 * (8 + 64) * 2.2))
+
+
+def _held_size(cache):
+    return sum(size for _, size, path in cache.entries()
+               if path in cache.holds)
+
+
+class MemberInfoTests(SimpleTestCase):
+    """A batch member's impute2_info holds only its own statistics."""
+
+    def test_member_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            info_fp = os.path.join(tmp, 'batch.impute2_info')
+            with open(info_fp, 'w') as info:
+                info.write('\t'.join([
+                    'chr', 'name', 'position', 'a0', 'a1', 'exp_freq_a1',
+                    'info', 'certainty', 'type', 'info_type0',
+                    'concord_type0', 'r2_type0']) + '\n')
+                for pos, typed in [(10, '0'), (20, '2'), (30, '0')]:
+                    info.write('1\trs{0}\t{0}\tA\tG\t0.250\t0.800\t'
+                               '0.900\t{1}\t0.700\t0.950\t0.600\n'.format(
+                                   pos, typed))
+            impute2_fp = os.path.join(tmp, 'member.impute2')
+            with open(impute2_fp, 'w') as impute2:
+                impute2.write('1 rs10 10 A G 0.2 0.8 0\n'
+                              '1 rs20 20 A G 0 0 1\n')
+            info_out = os.path.join(tmp, 'member.impute2_info')
+            member_info(info_fp, impute2_fp, info_out, 2)
+            df = pd.read_csv(info_out, sep='\t', dtype=str)
+        # e = 0.8, f = 0.8, theta = 0.4: 1 - 0.16 / 0.48
+        self.assertEqual(list(df.loc[0, ['exp_freq_a1', 'info', 'certainty',
+                                          'info_type0', 'r2_type0']]),
+                         ['0.400', '0.667', '0.800', '-1', '-1'])
+        self.assertEqual(list(df.loc[1, ['exp_freq_a1', 'info', 'certainty',
+                                          'type']]),
+                         ['1.000', '1.000', '1.000', '2'])
+        # a site the member has no probabilities for is left out
+        self.assertEqual(len(df), 2)
+
+
+class BatchTests(TestCase):
+    def test_reconcile_alleles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bims = {}
+            for member, rows in [
+                    ('1', ['rs1 A G', 'rs2 A C', 'rs3 A G', 'rs4 0 T']),
+                    ('2', ['rs1 A G', 'rs2 A C', 'rs3 A G', 'rs4 C T']),
+                    ('3', ['rs1 T C', 'rs2 A G', 'rs3 0 G', 'rs4 C T'])]:
+                bims[member] = os.path.join(tmp, member + '.bim')
+                with open(bims[member], 'w') as bim:
+                    bim.writelines('1 {} 0 {} {} {}\n'.format(
+                        row.split()[0], i + 1, *row.split()[1:])
+                        for i, row in enumerate(rows))
+            lists = reconcile_alleles(bims, {'rs1', 'rs2', 'rs3', 'rs4'})
+        self.assertEqual(lists, {'1': ([], []), '2': ([], []),
+                                 '3': (['rs1'], ['rs2'])})
+
+    def test_failed_member_leaves_batch(self):
+        batch = ImputationBatch.objects.create()
+        for oh_id in [1, 2, 3]:
+            ImputerMember.objects.create(oh_id=oh_id, active=True,
+                                         step='prepare_data', batch=batch)
+        with mock.patch.object(tasks, '_impute_batch') as impute:
+            tasks.batch_member_prepared(batch.id, 1)
+            tasks.batch_member_failed(batch.id, 2)
+            impute.assert_not_called()
+            tasks.batch_member_prepared(batch.id, 3)
+            impute.assert_called_once_with(batch.id, [1, 3])
+            # a late call does not start the batch again
+            tasks.batch_member_prepared(batch.id, 3)
+            impute.assert_called_once_with(batch.id, [1, 3])
+        failed = ImputerMember.objects.get(oh_id=2)
+        self.assertEqual((failed.active, failed.step), (False, 'failed'))
+        self.assertEqual([m.oh_id for m in batch.members()], [1, 3])
+
+    def test_progressive_delivery(self):
+        # each member's chromosomes are delivered before its upload, as
+        # upload_to_oh's manifest lists the delivered files
+        with self.settings(PROGRESSIVE_DELIVERY=True), \
+                mock.patch.object(_chain, 'apply_async',
+                                  autospec=True) as apply:
+            tasks._impute_batch(5, [1, 2])
+        steps = _steps(apply.call_args[0][0])
+        for oh_id in [1, 2]:
+            upload = steps.index(('upload_to_oh', (oh_id,)))
+            for chrom in tasks.CHROMOSOMES:
+                self.assertLess(steps.index(('process_chrom', (chrom, oh_id))),
+                                steps.index(('deliver_chrom', (chrom, oh_id))))
+                self.assertLess(steps.index(('deliver_chrom', (chrom, oh_id))),
+                                upload)
+        self.assertLess(steps.index(('split_batch_chrom', ('1', 5))),
+                        steps.index(('process_chrom', ('1', 1))))
+
+    def test_cost_ordering(self):
+        # measured runs put chr21 ahead of the larger chromosomes
+        ChromosomeRuntime.record('21', 10 ** 6)
+        ChromosomeRuntime.record('2', 1)
+        with self.settings(COST_ORDERING=True, COST_PRIORITY=True), \
+                mock.patch.object(_chain, 'apply_async',
+                                  autospec=True) as apply:
+            tasks._impute_batch(5, [1])
+            single = tasks._submit_chroms(1)
+        batch = apply.call_args[0][0].tasks[1]
+        self.assertEqual([(sig.args[0], sig.options) for sig in batch.tasks],
+                         [(sig.args[0], sig.options) for sig in single.tasks])
+        self.assertEqual(batch.tasks[0].args, ('21', 5))
+
+    def test_settings_rejected(self):
+        for setting in ['ADMISSION_CONTROL', 'SEGMENT_FANOUT']:
+            with self.subTest(setting=setting):
+                imported = subprocess.run(
+                    [sys.executable, '-c',
+                     'import openhumansimputer.settings'],
+                    env=dict(os.environ, BATCH_IMPUTATION='true',
+                             **{setting: 'true'}),
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                self.assertIn(b'ImproperlyConfigured', imported.stderr)
+
+
+def _steps(canvas):
+    """The (task name, args) of a canvas's signatures in order."""
+    if isinstance(canvas, (_chain, group, _chord)):
+        steps = [step for task in canvas.tasks for step in _steps(task)]
+        if isinstance(canvas, _chord):
+            steps += _steps(canvas.body)
+        return steps
+    return [(canvas.task.split('.')[-1], tuple(canvas.args))]
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        self.member = ImputerMember.objects.create(
+            oh_id=1, active=True, step='submit_chrom',
+            admitted_at=timezone.now(), reserved_cpus=4,
+            reserved_memory=8, reserved_disk=16)
+        self.since = timezone.now() + datetime.timedelta(seconds=1)
+        ImputerMember.objects.filter(id=self.member.id).update(
+            updated_at=self.since - datetime.timedelta(days=2))
+
+    def test_progress_keeps_reservation(self):
+        self.assertEqual(ImputerMember.reserved(self.since), (0, 0, 0))
+        with mock.patch.object(timezone, 'now', return_value=self.since):
+            ChromosomeProgress.record(1, '1', 'imputing', 0, 10)
+        self.assertEqual(ImputerMember.reserved(self.since), (4, 8, 16))
+
+    def test_failure_releases_reservation(self):
+        since = self.since - datetime.timedelta(days=3)
+        with mock.patch.object(tasks.admit_members, 'delay') as admit:
+            tasks.release_reservation(1)
+            admit.assert_called_once_with()
+        self.assertEqual(ImputerMember.reserved(since), (0, 0, 0))
+        self.assertTrue(ImputerMember.objects.get(id=self.member.id).active)
+
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ['OUT_DIR', 'DATA_DIR']:
+            patcher = mock.patch.object(tasks, name, tmp.name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.member = ImputerMember.objects.create(
+            oh_id=1, active=True, step='submit_chrom', data_source_id='5')
+        self.vcf, = tasks._stage_outputs(1, 'get_vcf')
+        os.makedirs(os.path.dirname(self.vcf))
+        with open(self.vcf, 'w') as vcf:
+            vcf.write('##fileformat=VCFv4.2\n')
+
+    def test_outputs_not_read(self):
+        # validated by size and mtime, changes still undo the checkpoint
+        with mock.patch('builtins.open', side_effect=AssertionError):
+            tasks._checkpoint(1, 'get_vcf')
+            self.assertEqual(tasks._completed_stages(self.member),
+                             {('get_vcf', '')})
+        with open(self.vcf, 'a') as vcf:
+            vcf.write('#CHROM\n')
+        self.assertEqual(tasks._completed_stages(self.member), set())
+        os.remove(self.vcf)
+        self.assertIsNone(tasks._checksum([self.vcf]))
+
+    def test_resumed_through_admission(self):
+        tasks._checkpoint(1, 'get_vcf')
+        ImputerMember.objects.filter(id=self.member.id).update(
+            admitted_at=timezone.now(), reserved_cpus=4)
+        with self.settings(ADMISSION_CONTROL=True), \
+                mock.patch.object(tasks.admit_members, 'delay') as admit, \
+                mock.patch.object(_chain, 'apply_async') as started:
+            plan = tasks.resume_pipeline(1)
+            admit.assert_called_once_with()
+            started.assert_not_called()
+        self.assertEqual(plan[0], ('prepare_data', []))
+        member = ImputerMember.objects.get(id=self.member.id)
+        self.assertEqual((member.step, member.admitted_at,
+                          member.reserved_cpus), ('resume', None, 0))
+
+        budget = tasks.Demand(64.0, 2 ** 40, 2 ** 50)
+        with mock.patch.object(tasks, 'capacity', return_value=budget), \
+                mock.patch.object(tasks, 'disk_usage') as usage, \
+                mock.patch.object(tasks, 'pipeline') as pipeline, \
+                mock.patch.object(_chain, 'apply_async', autospec=True) \
+                as started:
+            usage.return_value.free = 2 ** 50
+            tasks.admit_members()
+        pipeline.assert_not_called()
+        # from its checkpoints: no new download
+        steps = _steps(started.call_args[0][0])
+        self.assertEqual(steps[0], ('prepare_data', (1,)))
+        self.assertNotIn('get_vcf', [name for name, _ in steps])
+        member = ImputerMember.objects.get(id=self.member.id)
+        self.assertEqual(member.step, 'launch')
+        self.assertIsNotNone(member.admitted_at)
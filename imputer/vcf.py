@@ -0,0 +1,178 @@
+"""
+Write the member's annotated vcf straight from the impute2/info pair.
+
+This replaces the .impute2 rewrite, output_vcf.sh (plink2 --export vcf) and
+the reparse of plink2's vcf in process_chrom. Hard calls follow plink2's
+--hard-call-threshold rule and REF/ALT follow --ref-from-fa: the allele
+matching hg19 is REF, and a variant where neither allele matches keeps its
+provisional REF and gets the PR flag.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from imputer.formatting import format_rounded, join_fields, rewrite_ids
+from imputer.merge_join import merge_sorted
+
+IMPUTE_COLS = ['chr', 'name', 'position',
+               'a0', 'a1', 'a0a0_p', 'a0a1_p', 'a1a1_p']
+IMPUTE_DTYPES = {'name': str, 'a0': str, 'a1': str,
+                 'a0a0_p': float, 'a0a1_p': float, 'a1a1_p': float}
+# genipe's impute2_info columns that hold floats on a whole chromosome,
+# pinned so that every chunk is written the way the full table would be.
+INFO_DTYPES = {'name': str, 'a0': str, 'a1': str, 'exp_freq_a1': float,
+               'info': float, 'certainty': float, 'info_type0': float,
+               'concord_type0': float, 'r2_type0': float}
+VCF_COLS = ['CHROM', 'POS', 'ID', 'REF', 'ALT',
+            'QUAL', 'FILTER', 'INFO', 'FORMAT', 'MEMBER']
+
+HARD_CALL_THRESHOLD = 0.4
+# plink2 holds dosages in 1/16384ths of an allele
+DOSAGE_UNITS = 2 ** 14
+GENOTYPES = np.array([b'0/0', b'0/1', b'1/1'])
+
+
+class Reference:
+    """
+    Random access to an indexed fasta (samtools faidx .fai alongside it).
+    The file is memory mapped, so looking up a base costs a page read.
+    """
+
+    def __init__(self, fasta):
+        self.contigs = {}
+        with open(fasta + '.fai') as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = \
+                    line.split('\t')[:5]
+                self.contigs[name] = (int(length), int(offset),
+                                      int(line_bases), int(line_width))
+        self.sequence = np.memmap(fasta, dtype=np.uint8, mode='r')
+
+    def contig(self, chrom):
+        """The fasta name used for an imputer chromosome ('1'..'23')."""
+        names = [chrom, 'chr{}'.format(chrom)]
+        if chrom == '23':
+            names += ['X', 'chrX']
+        for name in names:
+            if name in self.contigs:
+                return name
+        raise KeyError('chromosome {} is not in the reference'.format(chrom))
+
+    def length(self, chrom):
+        return self.contigs[self.contig(chrom)][0]
+
+    def bases(self, chrom, positions):
+        """Upper-case reference bases at 1-based positions, as uint8."""
+        length, offset, line_bases, line_width = \
+            self.contigs[self.contig(chrom)]
+        index = np.asarray(positions, dtype=np.int64) - 1
+        inside = (index >= 0) & (index < length)
+        index = np.where(inside, index, 0)
+        seq = self.sequence[offset + (index // line_bases) * line_width +
+                            index % line_bases]
+        seq = np.where((seq >= ord('a')) & (seq <= ord('z')), seq - 32, seq)
+        return np.where(inside, seq, ord('N')).astype(np.uint8)
+
+    def matches(self, chrom, positions, alleles):
+        """Whether each allele (a bytes array) is the reference sequence."""
+        chars = alleles.view(np.uint8).reshape(len(alleles), -1)
+        single = np.count_nonzero(chars, axis=1) == 1
+        found = np.zeros(len(alleles), dtype=bool)
+        found[single] = self.bases(chrom, positions[single]) == \
+            chars[single, 0]
+        for i in np.flatnonzero(~single):
+            allele = np.frombuffer(alleles[i], dtype=np.uint8)
+            span = positions[i] + np.arange(len(allele))
+            found[i] = (self.bases(chrom, span) == allele).all()
+        return found
+
+
+def hard_calls(p_ref_ref, p_het, p_alt_alt, threshold=HARD_CALL_THRESHOLD):
+    """
+    plink2's hard calls from genotype probabilities: the alt dosage is
+    called when it lies within threshold of 0, 1 or 2, otherwise missing.
+    Like plink2, the dosage is compared at a resolution of 1/DOSAGE_UNITS,
+    so a dosage of 0.4 summed from rounded probabilities is still called.
+    """
+    total = p_ref_ref + p_het + p_alt_alt
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dosage = np.rint(np.nan_to_num(
+            (p_het + 2 * p_alt_alt) / total * DOSAGE_UNITS))
+    nearest = np.rint(dosage / DOSAGE_UNITS).clip(0, 2).astype(np.int64)
+    called = (total > 0) & (np.abs(dosage - nearest * DOSAGE_UNITS) <=
+                            np.rint(threshold * DOSAGE_UNITS))
+    return np.where(called, GENOTYPES[nearest], b'./.')
+
+
+def sample_id(sample_fp):
+    """The vcf sample name plink2 gives the one member in a .sample file."""
+    with open(sample_fp) as sample:
+        fid, iid = sample.readlines()[2].split()[:2]
+    if fid in (iid, '0'):
+        return iid
+    return '{}_{}'.format(fid, iid)
+
+
+def vcf_chrom(chrom):
+    return 'X' if chrom == '23' else chrom
+
+
+def header(chrom, sample, contig_length):
+    """A header laid out like plink2's, which upload_to_oh builds on."""
+    return ''.join([
+        '##fileformat=VCFv4.2\n',
+        '##fileDate={}\n'.format(datetime.date.today().strftime('%Y%m%d')),
+        '##source=openhumansimputer\n',
+        '##contig=<ID={},length={}>\n'.format(vcf_chrom(chrom),
+                                              contig_length),
+        '##INFO=<ID=PR,Number=0,Type=Flag,Description="Provisional reference '
+        'allele, may not be based on real reference genome">\n',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+        '#{}\t{}\n'.format('\t'.join(VCF_COLS[:-1]), sample),
+    ])
+
+
+def format_records(df, chrom, reference):
+    """Render merged impute2/info rows as annotated vcf text."""
+    positions = df['position'].values
+    a0 = df['a0'].values.astype('S')
+    a1 = df['a1'].values.astype('S')
+    a0_is_ref = reference.matches(chrom, positions, a0)
+    a1_is_ref = ~a0_is_ref & reference.matches(chrom, positions, a1)
+    # neither allele in hg19: keep a0 as the provisional REF
+    swap = a1_is_ref
+    p00, p01, p11 = (df[col].values for col in ['a0a0_p', 'a0a1_p', 'a1a1_p'])
+    calls = np.where(swap, hard_calls(p11, p01, p00),
+                     hard_calls(p00, p01, p11))
+    flags = np.where(a0_is_ref | a1_is_ref, b'.', b'PR')
+    return join_fields([
+        vcf_chrom(chrom).encode() + b'\t', positions, b'\t',
+        rewrite_ids(df['name']), b'\t',
+        np.where(swap, a1, a0), b'\t', np.where(swap, a0, a1), b'\t.\t.\t',
+        flags, b';INFO=', format_rounded(df['info']), b'\tGT:GP\t',
+        calls, b':', format_rounded(p00), b',', format_rounded(p01), b',',
+        format_rounded(p11), b'\n']).decode('utf-8')
+
+
+def write_annotated_vcf(impute2_fp, info_fp, sample_fp, vcf_fp, chrom,
+                        reference, chunksize):
+    """
+    Join the impute2 genotypes to the impute2_info sites (the info file
+    acts as the filter, as in process_chrom) and write the final vcf.
+    reference is a Reference for hg19.
+    """
+    impute = pd.read_csv(impute2_fp, sep=' ', header=None, names=IMPUTE_COLS,
+                         dtype=IMPUTE_DTYPES, chunksize=chunksize)
+    info = pd.read_csv(info_fp, sep='\t', dtype=INFO_DTYPES,
+                       chunksize=chunksize)
+    with open(vcf_fp, 'w') as vcf:
+        vcf.write(header(chrom, sample_id(sample_fp),
+                         reference.length(chrom)))
+        for df in merge_sorted(impute, info, 'position', 'position',
+                               on=['chr', 'position', 'a0', 'a1'],
+                               how='right'):
+            df = df.rename(columns={'name_x': 'name'}).dropna(
+                subset=['name'])
+            if not df.empty:
+                vcf.write(format_records(df, chrom, reference))
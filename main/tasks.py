@@ -0,0 +1,64 @@
+"""
+Cached Open Humans member data for the dashboard.
+
+The exchange-member response is kept per member in the Django cache. A
+copy younger than settings.MEMBER_DATA_TTL is used as is. An older one is
+still served while a celery task fetches a new one, so the dashboard only
+waits on Open Humans when there is no copy at all.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from open_humans.client import get_client
+from open_humans.models import OpenHumansMember
+from openhumansimputer.celery import app
+
+logger = logging.getLogger('oh')
+
+# how long a refresh may run before another one can be queued
+REFRESH_LOCK_SECONDS = 60
+
+
+def _key(oh_id):
+    return 'oh-member-data:{}'.format(oh_id)
+
+
+def _store(oh_id, data):
+    cache.set(_key(oh_id), {'data': data, 'fetched': time.time()},
+              settings.MEMBER_DATA_MAX_AGE)
+
+
+def _fetch(oh_member):
+    data = get_client().exchange_member(oh_member.get_access_token())
+    _store(oh_member.oh_id, data)
+    return data
+
+
+def get_member_data(oh_member):
+    """The member's exchange-member data, from the cache when possible."""
+    entry = cache.get(_key(oh_member.oh_id))
+    if entry is None:
+        return _fetch(oh_member)
+    if time.time() - entry['fetched'] > settings.MEMBER_DATA_TTL:
+        # one refresh at a time per member
+        if cache.add(_key(oh_member.oh_id) + ':refresh', True,
+                     REFRESH_LOCK_SECONDS):
+            refresh_member_data.delay(oh_member.oh_id)
+    return entry['data']
+
+
+def invalidate_member_data(oh_id):
+    """Drop the cached copy, when the member's files are about to change."""
+    cache.delete(_key(oh_id))
+
+
+@app.task
+def refresh_member_data(oh_id):
+    try:
+        _fetch(OpenHumansMember.objects.get(oh_id=oh_id))
+    except Exception:
+        logger.warning('{}: could not refresh member data'.format(oh_id))
+    finally:
+        cache.delete(_key(oh_id) + ':refresh')
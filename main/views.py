@@ -1,15 +1,17 @@
-import requests
 import logging
 from django.template.defaulttags import register
 from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse
 from django.shortcuts import render, redirect
 from django.conf import settings
+from open_humans.client import get_client
 from open_humans.models import OpenHumansMember
-from imputer.tasks import pipeline
-from ohapi import api
-from imputer.models import ImputerMember
+from imputer.tasks import admit_members, pipeline, queue_for_batch
+from imputer.metrics import exposition
+from imputer.models import ChromosomeProgress, ImputerMember, TaskMetric
+from main.tasks import get_member_data, invalidate_member_data
 
 
 # Set up logging.
@@ -69,8 +71,7 @@ def dashboard(request):
         'oh_member': oh_member,
     }
     try:
-        oh_member_data = api.exchange_oauth2_member(
-            oh_member.get_access_token())
+        oh_member_data = get_member_data(oh_member)
     except:
         messages.error(request, "You need to re-authenticate with Open Humans")
         logout(request)
@@ -104,18 +105,19 @@ def dashboard(request):
                                            'source_id': source_id}
 
     # check position in queue
-    active_sorted = ImputerMember.objects.filter(active=True).order_by('id')
-    queue_position = None
-    for index, active in enumerate(active_sorted):
-        if int(oh_member.oh_id) == int(active.oh_id):
-            queue_position = index
+    queue_position = ImputerMember.queue_position(oh_member.oh_id)
+    progress = sorted(
+        ChromosomeProgress.objects.filter(member__oh_id=oh_member.oh_id,
+                                          member__active=True),
+        key=lambda row: int(row.chrom))
 
     context = {
         'base_url': request.build_absolute_uri("/").rstrip('/'),
         'section': 'dashboard',
         'all_datasources': requested_sources,
         'matching_sources': matching_sources,
-        'queue_position': queue_position
+        'queue_position': queue_position,
+        'progress': progress
         }
 
     return render(request, 'main/dashboard.html',
@@ -146,6 +148,18 @@ def complete(request):
     return redirect('/')
 
 
+def metrics(request):
+    """
+    Task metrics for Prometheus to scrape.
+    """
+    expected = 'Bearer {}'.format(settings.METRICS_TOKEN)
+    if (settings.METRICS_TOKEN and
+            request.META.get('HTTP_AUTHORIZATION') != expected):
+        return HttpResponse(status=401)
+    return HttpResponse(exposition(TaskMetric.aggregates()),
+                        content_type='text/plain; version=0.0.4')
+
+
 def launch_imputation(request):
     """
     Logic to check whether user exists:
@@ -159,17 +173,42 @@ def launch_imputation(request):
 
     if oh_member:
 
-        exists = len(ImputerMember.objects.filter(oh_id__in=(oh_id,), active=True))
-        # should never be higher than 1
-        if exists >= 1:
+        exists = ImputerMember.objects.filter(oh_id=oh_id,
+                                              active=True).exists()
+        if exists:
             return redirect('/dashboard?duplicate')
         else:
-            new_imputer = ImputerMember(oh_id=oh_id, active=True, step='launch')
-            new_imputer.save()
-
-            logger.debug("Launching {}'s pipeline.".format(oh_member.oh_id))
-
-            pipeline(vcf_id, oh_id)
+            invalidate_member_data(oh_id)
+            if settings.BATCH_IMPUTATION:
+                new_imputer = ImputerMember(oh_id=oh_id, active=True,
+                                            step='queued',
+                                            data_source_id=vcf_id)
+                new_imputer.save()
+
+                logger.debug("Queued {} for batch imputation.".format(
+                    oh_member.oh_id))
+
+                queue_for_batch()
+            elif settings.ADMISSION_CONTROL:
+                new_imputer = ImputerMember(oh_id=oh_id, active=True,
+                                            step='waiting',
+                                            data_source_id=vcf_id)
+                new_imputer.save()
+
+                logger.debug("Holding {} for admission.".format(
+                    oh_member.oh_id))
+
+                admit_members.delay()
+            else:
+                new_imputer = ImputerMember(oh_id=oh_id, active=True,
+                                            step='launch',
+                                            data_source_id=vcf_id)
+                new_imputer.save()
+
+                logger.debug("Launching {}'s pipeline.".format(
+                    oh_member.oh_id))
+
+                pipeline(vcf_id, oh_id)
 
             context = {'oh_member': oh_member,
                        'oh_proj_page': settings.OH_ACTIVITY_PAGE}
@@ -192,15 +231,8 @@ def oh_code_to_member(code):
             'redirect_uri': settings.OPENHUMANS_APP_REDIRECT_URI,
             'code': code,
         }
-        req = requests.post(
-            '{}/oauth2/token/'.format(settings.OPENHUMANS_OH_BASE_URL),
-            data=data,
-            auth=requests.auth.HTTPBasicAuth(
-                settings.OPENHUMANS_CLIENT_ID,
-                settings.OPENHUMANS_CLIENT_SECRET
-            )
-        )
-        data = req.json()
+        data = get_client().token(data, settings.OPENHUMANS_CLIENT_ID,
+                                  settings.OPENHUMANS_CLIENT_SECRET)
 
         if 'access_token' in data:
             oh_id = oh_get_member_data(
@@ -223,8 +255,8 @@ def oh_code_to_member(code):
 
             return oh_member
 
-        elif 'error' in req.json():
-            logger.debug('Error in token exchange: {}'.format(req.json()))
+        elif 'error' in data:
+            logger.debug('Error in token exchange: {}'.format(data))
         else:
             logger.warning('Neither token nor error info in OH response!')
     else:
@@ -236,12 +268,4 @@ def oh_get_member_data(token):
     """
     Exchange OAuth2 token for member data.
     """
-    req = requests.get(
-        '{}/api/direct-sharing/project/exchange-member/'
-        .format(settings.OPENHUMANS_OH_BASE_URL),
-        params={'access_token': token}
-    )
-    if req.status_code == 200:
-        return req.json()
-    raise Exception('Status code {}'.format(req.status_code))
-    return None
+    return get_client().exchange_member(token)
@@ -0,0 +1,196 @@
+"""
+The one HTTP client for Open Humans.
+
+Every call goes through a pooled keep-alive requests session with bounded
+timeouts. Calls to Open Humans retry connection errors for every method,
+and read errors and 429/5xx answers with exponential backoff only for
+idempotent methods, so a POST is never sent twice. File bodies PUT to S3
+are retried here, reopening the file, since urllib3 cannot rewind them.
+The endpoints follow ohapi.api.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('oh')
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# the largest object S3 takes in one PUT
+S3_PUT_LIMIT = 5 * 1024 ** 3
+# PUT is left to put_file, which can reopen the body
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'DELETE'])
+# one client per process, celery's prefork children must not share sockets
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class OpenHumansError(Exception):
+    """An unexpected answer from Open Humans, with its HTTP status."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def _api_retry(retries, backoff):
+    options = dict(total=retries, backoff_factor=backoff,
+                   status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **options)
+
+
+def new_session(base_url, retries, backoff, pool_size):
+    """
+    A session retrying requests to base_url, and only failed connections
+    anywhere else.
+    """
+    session = requests.Session()
+    api = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                      max_retries=_api_retry(retries, backoff))
+    other = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                        max_retries=Retry(total=retries, connect=retries,
+                                          read=0, status=0,
+                                          backoff_factor=backoff))
+    session.mount('https://', other)
+    session.mount('http://', other)
+    session.mount(base_url, api)
+    return session
+
+
+class OpenHumansClient:
+    """
+    Open Humans API calls on one session. base_url can point at a local
+    stand-in server.
+    """
+
+    def __init__(self, base_url, timeout=60, retries=5, backoff=0.5,
+                 pool_size=10, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = session or new_session(self.base_url, retries, backoff,
+                                              pool_size)
+
+    def _url(self, path):
+        return self.base_url + path
+
+    def _check(self, response, expected=200):
+        if response.status_code != expected:
+            try:
+                detail = response.json()
+            except ValueError:
+                detail = response.text[:200]
+            raise OpenHumansError('{} {}: {}'.format(
+                response.request.method, response.status_code, detail),
+                status=response.status_code)
+        return response
+
+    def put_file(self, url, filepath):
+        """
+        PUT a file, streamed from disk. Failed connections, timeouts and
+        5xx answers send it again from its start; a PUT to S3 replaces the
+        object, so a retry is safe.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with open(filepath, 'rb') as body:
+                    response = self.session.put(url, data=body,
+                                                timeout=self.timeout)
+                if (response.status_code not in RETRY_STATUSES or
+                        attempt == self.retries):
+                    return self._check(response)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def token(self, data, client_id, client_secret):
+        """POST /oauth2/token/, for code exchange and refresh."""
+        response = self.session.post(
+            self._url('/oauth2/token/'), data=data,
+            auth=requests.auth.HTTPBasicAuth(client_id, client_secret),
+            timeout=self.timeout)
+        try:
+            return response.json()
+        except ValueError:
+            return {'error': response.status_code}
+
+    def exchange_member(self, access_token):
+        response = self.session.get(
+            self._url('/api/direct-sharing/project/exchange-member/'),
+            params={'access_token': access_token}, timeout=self.timeout)
+        return self._check(response).json()
+
+    def delete_file(self, access_token, project_member_id, file_basename):
+        response = self.session.post(
+            self._url('/api/direct-sharing/project/files/delete/'),
+            params={'access_token': access_token},
+            data={'project_member_id': project_member_id,
+                  'file_basename': file_basename},
+            timeout=self.timeout)
+        return self._check(response)
+
+    def message(self, subject, message, access_token, project_member_ids):
+        response = self.session.post(
+            self._url('/api/direct-sharing/project/message/'),
+            params={'access_token': access_token},
+            data={'subject': subject, 'message': message,
+                  'project_member_ids': project_member_ids},
+            timeout=self.timeout)
+        return self._check(response)
+
+    def upload(self, filepath, metadata, access_token, project_member_id):
+        """
+        Direct upload: register the file, PUT it to S3, complete it.
+        Returns the Open Humans file id. Open Humans hands out one
+        presigned PUT per file, so nothing over S3_PUT_LIMIT goes up.
+        """
+        size = os.path.getsize(filepath)
+        if size == 0:
+            raise OpenHumansError('{} is empty'.format(filepath))
+        if size > S3_PUT_LIMIT:
+            raise OpenHumansError('{} is over the {} bytes of a single '
+                                  'upload'.format(filepath, S3_PUT_LIMIT))
+        params = {'access_token': access_token}
+        response = self._check(self.session.post(
+            self._url('/api/direct-sharing/project/files/upload/direct/'),
+            params=params,
+            data={'project_member_id': project_member_id,
+                  'metadata': json.dumps(metadata),
+                  'filename': os.path.basename(filepath)},
+            timeout=self.timeout), 201).json()
+        self.put_file(response['url'], filepath)
+        self._check(self.session.post(
+            self._url('/api/direct-sharing/project/files/upload/complete/'),
+            params=params,
+            data={'project_member_id': project_member_id,
+                  'file_id': response['id']},
+            timeout=self.timeout))
+        logger.info('uploaded {}'.format(filepath))
+        return response['id']
+
+
+def get_client():
+    """This process's client, configured from settings."""
+    pid = os.getpid()
+    with _clients_lock:
+        if pid not in _clients:
+            _clients.clear()
+            _clients[pid] = OpenHumansClient(
+                settings.OPENHUMANS_OH_BASE_URL,
+                timeout=settings.OH_HTTP_TIMEOUT,
+                retries=settings.OH_HTTP_RETRIES,
+                backoff=settings.OH_HTTP_BACKOFF,
+                pool_size=settings.OH_HTTP_POOL_SIZE)
+        return _clients[pid]
@@ -1,10 +1,12 @@
+import threading
 from datetime import timedelta
 
 import arrow
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-import requests
+from django.db import models, transaction
+
+from open_humans.client import get_client
 
 OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
 OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
@@ -14,6 +16,15 @@ OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
 
 OPENHUMANS_APP_BASE_URL = settings.OPENHUMANS_APP_BASE_URL
 
+# per-member locks, so threads of one process refresh a token only once
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+
+
+def _refresh_lock(oh_id):
+    with _refresh_locks_lock:
+        return _refresh_locks.setdefault(oh_id, threading.Lock())
+
 
 def make_unique_username(base):
     """
@@ -68,31 +79,40 @@ class OpenHumansMember(models.Model):
         return "<OpenHumansMember(oh_id='{}')>".format(
             self.oh_id)
 
+    def _expiring(self):
+        # Also refresh if nearly expired (less than 60s remaining).
+        delta = timedelta(seconds=60)
+        return arrow.get(self.token_expires) - delta < arrow.now()
+
     def get_access_token(self,
                          client_id=settings.OPENHUMANS_CLIENT_ID,
                          client_secret=settings.OPENHUMANS_CLIENT_SECRET):
         """
         Return access token. Refresh first if necessary.
+        Refreshes are coalesced: the member's row is locked and re-read, so
+        when many tasks find the token expiring at once only the first
+        refreshes and the others pick up its new token.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
-        if arrow.get(self.token_expires) - delta < arrow.now():
-            self._refresh_tokens(client_id=client_id,
-                                 client_secret=client_secret)
+        if self._expiring():
+            with _refresh_lock(self.oh_id), transaction.atomic():
+                current = type(self).objects.select_for_update().get(
+                    pk=self.pk)
+                if current._expiring():
+                    current._refresh_tokens(client_id=client_id,
+                                            client_secret=client_secret)
+                self.access_token = current.access_token
+                self.refresh_token = current.refresh_token
+                self.token_expires = current.token_expires
         return self.access_token
 
     def _refresh_tokens(self, client_id, client_secret):
         """
         Refresh access token.
         """
-        response = requests.post(
-            'https://www.openhumans.org/oauth2/token/',
-            data={
-                'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
-            auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
-        if response.status_code == 200:
-            data = response.json()
+        data = get_client().token({
+            'grant_type': 'refresh_token',
+            'refresh_token': self.refresh_token}, client_id, client_secret)
+        if 'access_token' in data:
             self.access_token = data['access_token']
             self.refresh_token = data['refresh_token']
             self.token_expires = self.get_expiration(data['expires_in'])
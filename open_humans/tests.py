@@ -1,3 +1,153 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
-# Create your tests here.
+import arrow
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from open_humans import client
+from open_humans.client import OpenHumansClient, OpenHumansError
+from open_humans.models import OpenHumansMember
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandIn:
+    """
+    A local HTTP server answering from a script: answers maps (method,
+    path) to a list of (status, body) used in turn, the last one repeated.
+    Every request is kept as (method, path, body).
+    """
+
+    def __init__(self, answers, delay=0):
+        self.answers = answers
+        self.delay = delay
+        self.requests = []
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                path = self.path.split('?')[0]
+                with stand_in.lock:
+                    stand_in.requests.append((self.command, path, body))
+                    queue = stand_in.answers[(self.command, path)]
+                    status, answer = queue.pop(0) if len(queue) > 1 \
+                        else queue[0]
+                time.sleep(stand_in.delay)
+                answer = answer.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            do_GET = do_POST = do_PUT = _answer
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def calls(self, method, path):
+        return [body for m, p, body in self.requests
+                if (m, p) == (method, path)]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+EXCHANGE = '/api/direct-sharing/project/exchange-member/'
+MESSAGE = '/api/direct-sharing/project/message/'
+TOKEN = '/oauth2/token/'
+
+
+class ClientRetryTests(SimpleTestCase):
+    """Idempotent calls are retried, POSTs are sent once."""
+
+    def stand_in(self, answers):
+        server = StandIn(answers)
+        self.addCleanup(server.close)
+        return server, OpenHumansClient(server.url, timeout=5, retries=3,
+                                        backoff=0)
+
+    def test_get_retried(self):
+        server, oh = self.stand_in({('GET', EXCHANGE): [
+            (503, '{}'), (502, '{}'), (200, '{"data": []}')]})
+        self.assertEqual(oh.exchange_member('token'), {'data': []})
+        self.assertEqual(len(server.calls('GET', EXCHANGE)), 3)
+
+    def test_post_sent_once(self):
+        server, oh = self.stand_in({('POST', MESSAGE): [
+            (503, '{}'), (200, '{}')]})
+        with self.assertRaises(OpenHumansError) as raised:
+            oh.message('subject', 'message', 'token', [1])
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(len(server.calls('POST', MESSAGE)), 1)
+
+    def test_put_file_resent(self):
+        server, oh = self.stand_in({('PUT', '/bucket/key'): [
+            (500, '{}'), (200, '{}')]})
+        path = self.file(b'0123456789')
+        oh.put_file(server.url + '/bucket/key', path)
+        self.assertEqual(server.calls('PUT', '/bucket/key'),
+                         [b'0123456789', b'0123456789'])
+
+    def file(self, data):
+        handle = tempfile.NamedTemporaryFile(delete=False)
+        handle.write(data)
+        handle.close()
+        self.addCleanup(os.remove, handle.name)
+        return handle.name
+
+
+class TokenRefreshTests(TransactionTestCase):
+    """Tasks finding a member's token expiring refresh it only once."""
+
+    def setUp(self):
+        self.server = StandIn({('POST', TOKEN): [(200, (
+            '{"access_token": "new", "refresh_token": "next", '
+            '"expires_in": 36000}'))]}, delay=0.2)
+        self.addCleanup(self.server.close)
+        client._clients.clear()
+        self.addCleanup(client._clients.clear)
+        user = User.objects.create(username='1_openhumans')
+        OpenHumansMember.objects.create(
+            user=user, oh_id='1', access_token='old', refresh_token='first',
+            token_expires=(arrow.now() - timedelta(minutes=5)).datetime)
+
+    def test_coalesced_refresh(self):
+        members = [OpenHumansMember.objects.get(oh_id='1') for _ in range(8)]
+        tokens = []
+
+        def refresh(member):
+            try:
+                tokens.append(member.get_access_token('id', 'secret'))
+            finally:
+                connection.close()
+
+        with override_settings(OPENHUMANS_OH_BASE_URL=self.server.url):
+            threads = [threading.Thread(target=refresh, args=(member,))
+                       for member in members]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(tokens, ['new'] * 8)
+        self.assertEqual(len(self.server.calls('POST', TOKEN)), 1)
+        self.assertEqual(OpenHumansMember.objects.get(
+            oh_id='1').refresh_token, 'next')
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 from env_tools import apply_env
 import logging
 import sentry_sdk
@@ -70,6 +71,13 @@ OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
 OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
 OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
 
+# Shared Open Humans HTTP client: timeout in seconds per request, retries
+# with exponential backoff, and keep-alive connections per host.
+OH_HTTP_TIMEOUT = int(os.getenv('OH_HTTP_TIMEOUT', 60))
+OH_HTTP_RETRIES = int(os.getenv('OH_HTTP_RETRIES', 5))
+OH_HTTP_BACKOFF = float(os.getenv('OH_HTTP_BACKOFF', 0.5))
+OH_HTTP_POOL_SIZE = int(os.getenv('OH_HTTP_POOL_SIZE', 10))
+
 # Imputer Settings
 # in production this should be False
 TEST_CHROMS = True if os.environ.get(
@@ -82,6 +90,131 @@ else:
     CHROMOSOMES = ["{}".format(i)
                    for i in list(range(1, 24))]
 
+# Join impute2/info/vcf in sorted chunks instead of whole-chromosome frames.
+PROCESS_STREAMING = True if os.environ.get(
+    'PROCESS_STREAMING', '').lower() == 'true' else False
+PROCESS_CHUNK_SIZE = int(os.environ.get('PROCESS_CHUNK_SIZE', 500000))
+# Render the GP/INFO annotation with NumPy instead of pandas string columns.
+VECTORIZED_ANNOTATION = True if os.environ.get(
+    'VECTORIZED_ANNOTATION', '').lower() == 'true' else False
+# Write the final vcf from impute2/info in Python instead of plink2.
+NATIVE_VCF_WRITER = True if os.environ.get(
+    'NATIVE_VCF_WRITER', '').lower() == 'true' else False
+
+# Compression of the final member file: codec is one of bz2, gzip, xz,
+# or bgzf for a .vcf.gz with a tabix .tbi index uploaded next to it.
+# Blocks of COMPRESS_BLOCK_SIZE bytes are compressed on COMPRESS_WORKERS
+# threads (default: all cores).
+OUTPUT_CODEC = os.environ.get('OUTPUT_CODEC', 'bz2')
+OUTPUT_COMPRESSLEVEL = int(os.environ.get('OUTPUT_COMPRESSLEVEL', 9))
+COMPRESS_WORKERS = int(os.environ.get('COMPRESS_WORKERS', 0)) or None
+COMPRESS_BLOCK_SIZE = int(os.environ.get('COMPRESS_BLOCK_SIZE', 8 * 1024 * 1024))
+
+# Upload each chromosome as soon as it is processed. The final step then
+# uploads a manifest, plus the combined file unless PROGRESSIVE_COMBINED
+# is 'false'.
+PROGRESSIVE_DELIVERY = True if os.environ.get(
+    'PROGRESSIVE_DELIVERY', '').lower() == 'true' else False
+PROGRESSIVE_COMBINED = False if os.environ.get(
+    'PROGRESSIVE_COMBINED', '').lower() == 'false' else True
+
+# Split the member's plink data by chromosome once in prepare_data, so
+# each submit_chrom reads only its own chromosome.
+SPLIT_CHROMS = True if os.environ.get(
+    'SPLIT_CHROMS', '').lower() == 'true' else False
+
+# Enqueue submit_chrom longest expected runtime first, and optionally set
+# broker priorities from the same cost model.
+COST_ORDERING = True if os.environ.get(
+    'COST_ORDERING', '').lower() == 'true' else False
+COST_PRIORITY = True if os.environ.get(
+    'COST_PRIORITY', '').lower() == 'true' else False
+
+# Phase each chromosome once and run every impute2 segment as its own task
+# instead of one genipe-launcher per chromosome. The segment tasks of a
+# chromosome can run on any worker and merge_chrom reads what all of them
+# wrote, so every worker host needs the same OUT_DIR (a shared filesystem).
+SEGMENT_FANOUT = True if os.environ.get(
+    'SEGMENT_FANOUT', '').lower() == 'true' else False
+SEGMENT_LENGTH = int(os.environ.get('SEGMENT_LENGTH', 5000000))
+PHASE_THREADS = int(os.environ.get('PHASE_THREADS', 1))
+
+# Decompressed, per-segment copies of the reference panel. Unset to read
+# REF_PANEL/REF_PANEL_X directly. The budget is in bytes, 0 to size it from
+# the panel: every chromosome decompressed plus its segment slices, over
+# 1.5 TB for 1000GP_Phase3.
+PANEL_CACHE_DIR = os.environ.get('PANEL_CACHE_DIR')
+PANEL_VERSION = os.environ.get('PANEL_VERSION', '1000GP_Phase3')
+PANEL_CACHE_BUDGET = int(os.environ.get('PANEL_CACHE_BUDGET', 0))
+
+# Queue members and impute up to BATCH_SIZE of them in one multi-sample
+# run per chromosome, starting at most BATCH_WAIT seconds after the first.
+BATCH_IMPUTATION = True if os.environ.get(
+    'BATCH_IMPUTATION', '').lower() == 'true' else False
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 8))
+BATCH_WAIT = int(os.environ.get('BATCH_WAIT', 600))
+
+# Hold launched members until the cpus, memory and scratch disk (bytes)
+# their chromosomes are expected to need fit the node's budget; 0 detects
+# the node's own. ADMISSION_PARALLEL is how many chromosome tasks of one
+# member run at once, ADMISSION_TASK_MEMORY the peak RSS assumed for a
+# chromosome until one is measured. See imputer/admission.py.
+ADMISSION_CONTROL = True if os.environ.get(
+    'ADMISSION_CONTROL', '').lower() == 'true' else False
+ADMISSION_CPUS = float(os.environ.get('ADMISSION_CPUS', 0))
+ADMISSION_MEMORY = int(os.environ.get('ADMISSION_MEMORY', 0))
+ADMISSION_DISK = int(os.environ.get('ADMISSION_DISK', 0))
+ADMISSION_PARALLEL = int(os.environ.get('ADMISSION_PARALLEL', 3))
+ADMISSION_TASK_MEMORY = int(os.environ.get('ADMISSION_TASK_MEMORY',
+                                           2 * 1024 ** 3))
+ADMISSION_DISK_PER_VARIANT = int(os.environ.get('ADMISSION_DISK_PER_VARIANT',
+                                                500))
+ADMISSION_MAX_SKIPS = int(os.environ.get('ADMISSION_MAX_SKIPS', 3))
+# seconds between admission checks while members wait, and after which an
+# admitted member that stopped updating no longer holds its reservation
+ADMISSION_INTERVAL = int(os.environ.get('ADMISSION_INTERVAL', 300))
+ADMISSION_STALE = int(os.environ.get('ADMISSION_STALE', 24 * 60 * 60))
+
+# A batch runs genipe-launcher once per chromosome for all its members, it
+# is neither admitted member by member nor split into segments.
+if BATCH_IMPUTATION and (ADMISSION_CONTROL or SEGMENT_FANOUT):
+    raise ImproperlyConfigured(
+        'BATCH_IMPUTATION cannot be combined with ADMISSION_CONTROL or '
+        'SEGMENT_FANOUT, see imputer/batch.py')
+
+# Reuse imputed chromosomes of identical genotypes. Keys cover the panel
+# version and IMPUTATION_VERSION, bump it when a tool is upgraded. The
+# budget is in bytes.
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR')
+RESULT_CACHE_BUDGET = int(os.environ.get('RESULT_CACHE_BUDGET',
+                                         200 * 1024 ** 3))
+IMPUTATION_VERSION = os.environ.get(
+    'IMPUTATION_VERSION', 'genipe-1.4;impute2-2.3.2;shapeit-2.r837;plink-1.9')
+
+# The dashboard reuses a member's Open Humans data for MEMBER_DATA_TTL
+# seconds, and serves it while refreshing in the background for up to
+# MEMBER_DATA_MAX_AGE seconds.
+MEMBER_DATA_TTL = int(os.environ.get('MEMBER_DATA_TTL', 300))
+MEMBER_DATA_MAX_AGE = int(os.environ.get('MEMBER_DATA_MAX_AGE', 24 * 60 * 60))
+
+# Output of genipe, plink and the other programs, in rotating logs per
+# member and chromosome.
+PIPELINE_LOG_DIR = os.environ.get('PIPELINE_LOG_DIR',
+                                  os.path.join(LOG_DIR, 'pipeline'))
+PIPELINE_LOG_BYTES = int(os.environ.get('PIPELINE_LOG_BYTES',
+                                        20 * 1024 * 1024))
+PIPELINE_LOG_BACKUPS = int(os.environ.get('PIPELINE_LOG_BACKUPS', 3))
+
+# What a chromosome's scratch keeps once its vcf is written and checks
+# out: 'all', 'impute2' (the merged impute2 files and the vcf) or 'vcf'.
+# See imputer/retention.py.
+SCRATCH_RETENTION = os.environ.get('SCRATCH_RETENTION',
+                                   'all' if DEBUG else 'impute2')
+
+# /metrics serves task metrics in the Prometheus text format. When
+# METRICS_TOKEN is set, scrapers must send it as a bearer token.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 # Applications installed
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -151,6 +284,15 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Shared by the web and worker processes, so a worker can refresh what the
+# dashboard reads. Create the table with manage.py createcachetable.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'imputer_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators